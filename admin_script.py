@@ -1,86 +1,221 @@
 from NBA import create_app
-from app.modelos import db, ParticipaLiga, CartaLiga, Carta, Partido, Historico
+from app.modelos import db
+from app.ingesta import ingestar_ficheros, TAM_BLOQUE
+from app.puntuaciones import recomputar_jornada, jornada_de_hoy
+from app.puntuacion_cartas import puntuar_cartas
+from app.ligas import reconstruir_contadores
+from app.estadisticas_jugador import actualizar_estadisticas
+from app.migraciones import migrar, version_esquema
+from app.cache_fragmentos import cache_fragmentos
+from app.tiradas_preparadas import preparar_tiradas
+from app.trabajos import ejecutar_trabajo, estado_trabajos
+import argparse
 import datetime
+import sys
 
 app = create_app()
 
 with app.app_context():
-    def insertar_partido_y_estadisticas():
-        print("Insertando nuevo partido y estadísticas de jugadores...")
-
-        id_partido = int(input("ID del partido (único): "))
-        fecha_str = input("Fecha del partido (YYYY-MM-DD): ")
-        fecha = datetime.datetime.strptime(fecha_str, "%Y-%m-%d").date()
-        local = input("Equipo local: ")
-        visitante = input("Equipo visitante: ")
-        gana_local_input = input("¿Ganó el equipo local? (s/n): ").strip().lower()
-        gana_local = gana_local_input == "s"
-
-        url = input("URL de highlights: ")
-
-        nuevo_partido = Partido(
-            id_partido=id_partido,
-            fecha=fecha,
-            equipo_local=local,
-            equipo_visitante=visitante,
-            gana_local=gana_local,
-            url=url
-        )
-        db.session.add(nuevo_partido)
-
-        print("\n Añadiendo jugadores al histórico...")
-        while True:
-            id_jugador = int(input("ID del jugador (o 0 para terminar): "))
-            if id_jugador == 0:
-                break
-            tiempo_jugador = int(input("Minutos jugados: "))
-            puntos_marcados = int(input("Puntos anotados: "))
-            puntuacion = float(input("Puntuación global: "))
-
-            registro = Historico(
-                id_partido=id_partido,
-                id_jugador=id_jugador,
-                tiempo_jugador=tiempo_jugador,
-                puntos_marcados=puntos_marcados,
-                puntuacion=puntuacion
-            )
-            db.session.add(registro)
-
-        db.session.commit()
-        print(f"\n Partido {id_partido} y estadísticas insertadas correctamente.\n")
+    def ingestar(ruta_partidos, ruta_historicos, tam_bloque=TAM_BLOQUE):
+        print("Ingestando partidos y estadísticas de jugadores...")
+        resumen = ingestar_ficheros(ruta_partidos, ruta_historicos, tam_bloque)
+
+        for ruta, num_linea, motivo in resumen["rechazadas"]:
+            print(f"  Rechazada {ruta}:{num_linea} → {motivo}")
+        print(f"\n {resumen['filas']} filas ingestadas y {len(resumen['rechazadas'])} rechazadas "
+              f"en {resumen['segundos']:.2f} s ({resumen['filas_por_segundo']:.0f} filas/s).")
+        print(f" Estadísticas actualizadas de {resumen['jugadores_actualizados']} jugadores.\n")
+        # Los perfiles de los jugadores cacheados ya no valen (ver app/cache_fragmentos.py)
+        cache_fragmentos.purgar("historico")
+
+    def insertar_partidos_y_estadisticas():
+        ruta_partidos = input("Fichero de partidos, CSV o JSON lines (vacío para ninguno): ").strip() or None
+        ruta_historicos = input("Fichero de histórico de jugadores (vacío para ninguno): ").strip() or None
+        ingestar(ruta_partidos, ruta_historicos)
 
     def recomputar_puntos():
         print("Recomputando puntuaciones acumuladas...")
-        participaciones = db.session.query(ParticipaLiga).all()
-
-        for pl in participaciones:
-            # Solo las crtas unicas
-            ids_cartas = db.session.query(CartaLiga.id_jugador).filter_by(
-                id_usuario=pl.id_usuario,
-                id_liga=pl.id_liga
-            ).distinct().all()
-
-            ids = [id_j for (id_j,) in ids_cartas]
-
-            puntuaciones = db.session.query(Carta.puntuacion).filter(Carta.id_jugador.in_(ids)).all()
-            suma = sum(p[0] for p in puntuaciones)
-
-            pl.puntuacion_acumulada += suma
-            print(f"Usuario {pl.id_usuario} en liga {pl.id_liga}: + {suma} puntos → total: {pl.puntuacion_acumulada}")
-
-        db.session.commit()
+        jornada = input(f"Jornada (por defecto {jornada_de_hoy()}): ").strip() or None
+        incremental = input("¿Solo las participaciones con cartas modificadas? (s/n): ").strip().lower() == "s"
+        tam_bloque = input("Ligas por bloque (vacío para todas a la vez): ").strip()
+
+        resumen = recomputar_jornada(jornada, incremental=incremental,
+                                     tam_bloque=int(tam_bloque) if tam_bloque else None)
+
+        if resumen["estado"] == "ya aplicada":
+            print(f"La jornada {resumen['jornada']} ya estaba aplicada, no se suma nada.")
+        else:
+            print(f"Jornada {resumen['jornada']} ({resumen['estado']}): "
+                  f"{resumen['participaciones']} participaciones actualizadas en {resumen['bloques']} bloques.")
         print("Recómputo de puntuaciones completado.")
 
+    def puntuar(completo=False):
+        print("Calculando la puntuación de las cartas a partir del histórico...")
+        resumen = puntuar_cartas(completo)
+        print(f"{resumen['jugadores_revisados']} jugadores revisados ({resumen['filas_historico']} filas de histórico), "
+              f"{len(resumen['modificados'])} cartas modificadas.")
+        if resumen["modificados"]:
+            print("Cartas modificadas:", ", ".join(str(id_jugador) for id_jugador in resumen["modificados"]))
+            cache_fragmentos.purgar("cartas")
+
+    def comprobar_contadores():
+        print("Comprobando los contadores de participantes de las ligas...")
+        corregidas = reconstruir_contadores()
+        print(f"{corregidas} ligas tenían el contador desajustado y se han corregido.")
+
+    def recalcular_estadisticas():
+        print("Recalculando las estadísticas de todos los jugadores...")
+        actualizados = actualizar_estadisticas()
+        print(f"Estadísticas de {actualizados} jugadores recalculadas.")
+        cache_fragmentos.purgar("historico")
+
+    def actualizar_base_datos():
+        print(f"Migrando el esquema de la base de datos (versión actual: {version_esquema()})...")
+        for version, descripcion in migrar():
+            print(f"  Aplicada la migración {version}: {descripcion}")
+        print(f"Esquema actualizado a la versión {version_esquema()}.")
+
+    def lanzar_trabajo(nombre, parametros=None, procesos=None, fragmentos=None):
+        # Trabajo repartido en fragmentos entre varios procesos (ver app/trabajos.py). Si falla algun
+        # fragmento, se vuelve a lanzar el mismo comando y solo se ejecutan los que faltan
+        def progreso(r):
+            if r["error"] is None:
+                print(f"  [{r['hechos']}/{r['total']}] fragmento [{r['desde']}, {r['hasta']}): {r['filas']} filas "
+                      f"en {r['segundos']:.2f} s (proceso {r['proceso']})")
+            else:
+                print(f"  FALLO fragmento [{r['desde']}, {r['hasta']}) (proceso {r['proceso']}): {r['error']}")
+
+        print(f"Trabajo {nombre}...")
+        resumen = ejecutar_trabajo(nombre, parametros, procesos, fragmentos, progreso)
+        if resumen["estado"] == "nada que hacer":
+            print(f"{resumen['trabajo']}: no hay nada que hacer.")
+            return resumen
+        if resumen["reanudados"]:
+            print(f"  Reanudado: {resumen['reanudados']} fragmentos ya estaban hechos.")
+        print(f"{resumen['trabajo']} ({resumen['estado']}): {resumen['filas']} filas en {resumen['fragmentos']} "
+              f"fragmentos con {resumen['procesos']} procesos, {resumen['segundos']:.2f} s de tiempo real y "
+              f"{resumen['segundos_fragmentos']:.2f} s sumando los fragmentos.")
+        if resumen["fallidos"]:
+            print(f"{len(resumen['fallidos'])} fragmentos han fallado: vuelve a lanzar el mismo comando para reanudarlo.")
+        return resumen
+
+    def mostrar_trabajos():
+        for trabajo, hechos, pendientes, fallidos, filas, segundos, terminado_en in estado_trabajos():
+            print(f"{trabajo}: {hechos} hechos, {pendientes} pendientes, {fallidos} fallidos, {filas} filas, "
+                  f"{segundos:.2f} s (último fragmento: {terminado_en})")
+
+    def preparar_tiradas_diarias(fecha=None, hilos=None, tam_bloque=None):
+        # Pensado para lanzarse cada noche antes de las 00:00 (p. ej. desde cron:
+        # "30 23 * * * python admin_script.py preparar-tiradas")
+        print("Preparando las tiradas diarias de los usuarios activos...")
+        resumen = preparar_tiradas(fecha, tam_bloque, hilos,
+                                   progreso=lambda hechos, total: print(f"  {hechos}/{total} usuarios"))
+        print(f"Tiradas del {resumen['fecha']}: {resumen['cartas']} cartas de {resumen['usuarios']} usuarios "
+              f"en {resumen['bloques']} bloques, {resumen['segundos']:.2f} s "
+              f"({resumen['usuarios_por_segundo']:.0f} usuarios/s).")
+        if resumen["caducadas"]:
+            print(f"Borradas {resumen['caducadas']} cartas de tiradas de días anteriores sin reclamar.")
+
+    def preparar_tiradas_interactivo():
+        fecha = input("Fecha (AAAA-MM-DD, vacío para mañana): ").strip()
+        preparar_tiradas_diarias(datetime.date.fromisoformat(fecha) if fecha else None)
+
+
+    # Modo no interactivo: python admin_script.py ingestar --partidos partidos.csv --historicos historicos.jsonl
+    # (ingestar, puntuar-cartas, recomputar, reconstruir-contadores y estadisticas-jugadores se reparten
+    # en fragmentos entre --procesos procesos, ver app/trabajos.py)
+    if len(sys.argv) > 1:
+        parser = argparse.ArgumentParser(description="Panel de administrador")
+        # Opciones de los comandos que se ejecutan como trabajos repartidos en fragmentos (app/trabajos.py)
+        opciones_trabajo = argparse.ArgumentParser(add_help=False)
+        opciones_trabajo.add_argument("--procesos", type=int,
+                                      help="Procesos entre los que se reparten los fragmentos "
+                                           "(por defecto TRABAJOS_PROCESOS; 0 en este proceso)")
+        opciones_trabajo.add_argument("--fragmentos", type=int,
+                                      help="Fragmentos (por defecto TRABAJOS_FRAGMENTOS_POR_PROCESO por proceso)")
+        subcomandos = parser.add_subparsers(dest="comando", required=True)
+        parser_ingestar = subcomandos.add_parser("ingestar", parents=[opciones_trabajo],
+                                                 help="Ingesta ficheros de partidos y/o histórico")
+        parser_ingestar.add_argument("--partidos", help="Fichero CSV o JSON lines de partidos")
+        parser_ingestar.add_argument("--historicos", help="Fichero CSV o JSON lines de histórico de jugadores")
+        parser_ingestar.add_argument("--tam-bloque", type=int, default=TAM_BLOQUE, help="Filas por bloque")
+        parser_puntuar = subcomandos.add_parser("puntuar-cartas", parents=[opciones_trabajo],
+                                                help="Calcula la puntuación de las cartas")
+        parser_puntuar.add_argument("--completo", action="store_true",
+                                    help="Recalcula todas las cartas, no solo las de jugadores con histórico nuevo")
+        parser_recomputar = subcomandos.add_parser("recomputar", parents=[opciones_trabajo],
+                                                   help="Recomputa las puntuaciones acumuladas de las ligas")
+        parser_recomputar.add_argument("--jornada", help=f"Jornada (por defecto {jornada_de_hoy()})")
+        parser_recomputar.add_argument("--incremental", action="store_true",
+                                       help="Solo las participaciones con cartas modificadas")
+        parser_recomputar.add_argument("--forzar", action="store_true",
+                                       help="Recalcula la jornada entera aunque ya estuviera aplicada")
+        subcomandos.add_parser("reconstruir-contadores", parents=[opciones_trabajo],
+                               help="Corrige los contadores de participantes de las ligas")
+        subcomandos.add_parser("migrar", help="Aplica las migraciones pendientes del esquema")
+        subcomandos.add_parser("estadisticas-jugadores", parents=[opciones_trabajo],
+                               help="Recalcula las estadísticas agregadas de todos los jugadores")
+        subcomandos.add_parser("trabajos", help="Muestra los puntos de control de los trabajos")
+        parser_tiradas = subcomandos.add_parser("preparar-tiradas",
+                                                help="Prepara las tiradas diarias de los usuarios activos")
+        parser_tiradas.add_argument("--fecha", type=datetime.date.fromisoformat,
+                                    help="Día de las tiradas, AAAA-MM-DD (por defecto, mañana)")
+        parser_tiradas.add_argument("--hilos", type=int, help="Bloques que se preparan a la vez")
+        parser_tiradas.add_argument("--tam-bloque", type=int, help="Usuarios por bloque")
+        args = parser.parse_args()
+
+        resumen = {}
+        if args.comando == "ingestar":
+            # Las lineas rechazadas salen en el log de cada fragmento
+            resumen = lanzar_trabajo("ingestar", {"ruta_partidos": args.partidos, "ruta_historicos": args.historicos,
+                                                  "tam_bloque": args.tam_bloque},
+                                     args.procesos, args.fragmentos)
+            cache_fragmentos.purgar("historico")
+        elif args.comando == "puntuar-cartas":
+            resumen = lanzar_trabajo("puntuar-cartas", {"completo": args.completo}, args.procesos, args.fragmentos)
+            if resumen.get("filas"):
+                cache_fragmentos.purgar("cartas")
+        elif args.comando == "recomputar":
+            resumen = lanzar_trabajo("recomputar-jornada", {"jornada": args.jornada, "incremental": args.incremental,
+                                                            "forzar": args.forzar},
+                                     args.procesos, args.fragmentos)
+        elif args.comando == "reconstruir-contadores":
+            resumen = lanzar_trabajo("reconstruir-contadores", None, args.procesos, args.fragmentos)
+        elif args.comando == "migrar":
+            actualizar_base_datos()
+        elif args.comando == "estadisticas-jugadores":
+            resumen = lanzar_trabajo("estadisticas-jugadores", None, args.procesos, args.fragmentos)
+            cache_fragmentos.purgar("historico")
+        elif args.comando == "trabajos":
+            mostrar_trabajos()
+        elif args.comando == "preparar-tiradas":
+            preparar_tiradas_diarias(args.fecha, args.hilos, args.tam_bloque)
+        sys.exit(1 if resumen.get("estado") == "fallido" else 0)
 
     print("===== PANEL DE ADMINISTRADOR =====")
-    print("1 → Insertar partido + histórico")
+    print("1 → Ingestar ficheros de partidos + histórico")
     print("2 → Recomputar puntuaciones acumuladas")
+    print("3 → Migrar el esquema de la base de datos")
+    print("4 → Calcular puntuación de las cartas")
+    print("5 → Comprobar contadores de participantes")
+    print("6 → Recalcular estadísticas de los jugadores")
+    print("7 → Preparar las tiradas diarias de mañana")
     print("\n")
-    opcion = input("Selecciona una opción (1 o 2): ").strip()
+    opcion = input("Selecciona una opción (1-7): ").strip()
 
     if opcion == "1":
-        insertar_partido_y_estadisticas()
+        insertar_partidos_y_estadisticas()
     elif opcion == "2":
         recomputar_puntos()
+    elif opcion == "3":
+        actualizar_base_datos()
+    elif opcion == "4":
+        puntuar()
+    elif opcion == "5":
+        comprobar_contadores()
+    elif opcion == "6":
+        recalcular_estadisticas()
+    elif opcion == "7":
+        preparar_tiradas_interactivo()
     else:
         print("Opción inválida.")
@@ -2,39 +2,67 @@ from flask import Flask
 from flask_bootstrap import Bootstrap5
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
-from config import ConfiguracionFlask
+from config import configuracion_activa
 from flask_login import LoginManager
+from sqlalchemy.engine import make_url
+from .instrumentacion import Instrumentacion
+from .replicas import SesionEnrutada, configurar_replicas, registrar_escrituras
 
 # Los distintos objetos de la aplicacion se crean fuera del metodo create_app, para que esten
 # disponibles para importar del resto de paquetes.
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": SesionEnrutada})
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 # FIXME: por que funciona el auth.login si no hay ningun blueprint? Preguntar al profe
 #   login_manager.login_view = 'sign_in'
 bootstrap = Bootstrap5()
 csrf = CSRFProtect()
+instrumentacion = Instrumentacion()
 
 
-def create_app() -> Flask:
+def create_app(configuracion=None) -> Flask:
     """
-    Funcion que crea la instancia de la aplicacion de Flask
+    Funcion que crea la instancia de la aplicacion de Flask. Por defecto usa el perfil de
+    configuracion de la variable de entorno NBA_PERFIL (ver config.py), pero se le puede pasar
+    otra clase de configuracion (por ejemplo, para usar otra base de datos en los benchmarks).
     """
+    configuracion = configuracion or configuracion_activa()
     # Declaramos la instancia de la app de Flask
     app = Flask(__name__)
 
     # Configuramos la app utilizando el objeto que hemos declarado previamente
-    app.config.from_object(ConfiguracionFlask())
+    app.config.from_object(configuracion())
+    app.logger.setLevel(app.config.get("NIVEL_LOG", "INFO"))
 
     # Inicializamos los distintos componentes de la app
     bootstrap.init_app(app)
     login_manager.init_app(app)
     csrf.init_app(app)
+    configurar_replicas(app)
     db.init_app(app)
+    instrumentacion.init_app(app)
+    with app.app_context():
+        registrar_escrituras(app, db.engine)
 
     # Vinculamos las rutas del modulo "rutas"
     with app.app_context():
         from . import modelos
         from . import rutas
+        from .api import api
+        app.register_blueprint(api)
+        from .pool_cartas import pool_cartas
+        from .sesion_usuario import usuarios_en_cache
+        from .cache_fragmentos import cache_fragmentos
+        from .catalogo import catalogo
+        instrumentacion.registrar_fuente("pool_cartas", pool_cartas.estadisticas)
+        instrumentacion.registrar_fuente("usuarios_cache", usuarios_en_cache.estadisticas)
+        instrumentacion.registrar_fuente("cache_fragmentos", cache_fragmentos.estadisticas)
+        instrumentacion.registrar_fuente("catalogo", catalogo.estadisticas)
+
+    opciones = {clave: valor for clave, valor in app.config["SQLALCHEMY_ENGINE_OPTIONS"].items()
+                if clave != "connect_args"}
+    app.logger.info("Perfil de configuracion: %s (debug=%s, base de datos %s, opciones del motor: %s)",
+                    app.config.get("PERFIL"), app.debug,
+                    make_url(app.config["SQLALCHEMY_DATABASE_URI"]).drivername, opciones)
     return app
@@ -0,0 +1,251 @@
+"""
+API JSON versionada (/api/v1) para el cliente movil y los paneles de terceros.
+
+Las rutas de lotes reciben los ids separados por comas (?ids=1,2,3, como mucho API_MAXIMO_IDS)
+y los resuelven de una vez, en lugar de una peticion por jugador:
+
+    GET /api/v1/jugadores?ids=...                       jugadores (catalogo en memoria)
+    GET /api/v1/cartas?ids=...                          cartas, con el nombre de su jugador
+    GET /api/v1/clasificaciones?ids=...&limite=10       primeros puestos de varias ligas, actuales
+        [&jornada=AAAA-MM-DD]                           o de una jornada pasada (ver historial_puntuaciones)
+    GET /api/v1/usuarios/<id>/ligas/<id>/cartas         pagina (por cursor) y resumen de una coleccion
+
+En todas, ?campos=a,b,... devuelve solo esos campos (ademas del id). Los jugadores y las cartas
+salen del catalogo (los que no esten en el, con un unico SELECT ... IN); las clasificaciones y
+las colecciones, de una consulta con IN o por cursor. Las respuestas llevan ETag: las de jugadores
+y cartas se calculan con la version "cartas", sin ejecutar la vista, y las demas a partir de los
+datos consultados. Se serializan con orjson si esta instalado (pip install orjson) y, si no, con json.
+"""
+import datetime
+import json
+from decimal import Decimal
+from flask import Blueprint, current_app, request
+from sqlalchemy import select, func
+from sqlalchemy.orm import aliased
+from werkzeug.exceptions import HTTPException, BadRequest, NotFound
+from . import db
+from .catalogo import catalogo
+from .coleccion import pagina_coleccion, resumen_coleccion, ORDENES as ORDENES_COLECCION
+from .historial_puntuaciones import ClasificacionEnJornada
+from .modelos import ClasificacionLiga, ClasificacionHistorica, Liga, Usuario
+from .replicas import solo_lectura
+from .cache_fragmentos import condicional, respuesta_condicional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Campos que se pueden pedir de cada recurso (el id siempre se devuelve)
+CAMPOS_JUGADOR = ("nombre", "nombre_equipo", "posicion", "altura", "fecha_nacimiento", "pais", "url_imagen")
+CAMPOS_CARTA = ("rareza", "puntuacion", "nombre", "nombre_equipo", "url_imagen")
+CAMPOS_CLASIFICACION = ("posicion", "email", "puntuacion")
+CAMPOS_COLECCION = ("numero_copias", "rareza", "puntuacion", "nombre", "nombre_equipo", "url_imagen")
+
+
+def _por_defecto(valor):
+    # Tipos que ni orjson ni json serializan por si solos
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if isinstance(valor, (datetime.date, datetime.datetime)):
+        return valor.isoformat()
+    raise TypeError(f"No se puede serializar a JSON un {type(valor).__name__}")
+
+
+def respuesta_json(datos, estado: int = 200):
+    if orjson is not None:
+        cuerpo = orjson.dumps(datos, default=_por_defecto)
+    else:
+        cuerpo = json.dumps(datos, default=_por_defecto, ensure_ascii=False, separators=(",", ":")).encode()
+    return current_app.response_class(cuerpo, status=estado, mimetype="application/json")
+
+
+@api.errorhandler(HTTPException)
+def error_api(error):
+    # Los errores de la API tambien son JSON
+    return respuesta_json({"error": error.description}, error.code)
+
+
+def _ids() -> list:
+    """
+    Ids del parametro "ids" (enteros separados por comas), sin repetir y en el orden en que vienen
+    """
+    try:
+        ids = list(dict.fromkeys(int(id_) for id_ in request.args.get("ids", "").split(",") if id_.strip()))
+    except ValueError:
+        raise BadRequest("'ids' tiene que ser una lista de enteros separados por comas")
+    if not ids:
+        raise BadRequest("Falta el parametro 'ids'")
+    maximo = current_app.config.get("API_MAXIMO_IDS", 100)
+    if len(ids) > maximo:
+        raise BadRequest(f"Como mucho se pueden pedir {maximo} ids a la vez")
+    return ids
+
+
+def _campos(validos: tuple) -> tuple:
+    """
+    Campos del parametro "campos" (por defecto, todos los validos)
+    """
+    pedidos = [campo.strip() for campo in request.args.get("campos", "").split(",") if campo.strip()]
+    desconocidos = [campo for campo in pedidos if campo not in validos]
+    if desconocidos:
+        raise BadRequest(f"Campos desconocidos: {', '.join(desconocidos)} (validos: {', '.join(validos)})")
+    return tuple(dict.fromkeys(pedidos)) or validos
+
+
+def _entero(parametro: str, por_defecto: int, maximo: int) -> int:
+    try:
+        valor = int(request.args.get(parametro, por_defecto))
+    except ValueError:
+        raise BadRequest(f"'{parametro}' tiene que ser un entero")
+    if not 1 <= valor <= maximo:
+        raise BadRequest(f"'{parametro}' tiene que estar entre 1 y {maximo}")
+    return valor
+
+
+def _lote(ids: list, encontrados: dict, a_diccionario) -> dict:
+    return {
+        "datos": [a_diccionario(encontrados[id_]) for id_ in ids if id_ in encontrados],
+        "no_encontrados": [id_ for id_ in ids if id_ not in encontrados],
+    }
+
+
+@api.route("/jugadores")
+@solo_lectura
+@condicional("cartas")
+def jugadores():
+    ids, campos = _ids(), _campos(CAMPOS_JUGADOR)
+    return respuesta_json(_lote(ids, catalogo.jugadores(ids), lambda jugador: {
+        "id_jugador": jugador.id_jugador, **{campo: getattr(jugador, campo) for campo in campos}
+    }))
+
+
+@api.route("/cartas")
+@solo_lectura
+@condicional("cartas")
+def cartas():
+    ids, campos = _ids(), _campos(CAMPOS_CARTA)
+
+    def a_diccionario(carta):
+        carta_dict = {"id_jugador": carta.id_jugador}
+        for campo in campos:
+            # nombre, nombre_equipo y url_imagen son del jugador de la carta
+            carta_dict[campo] = getattr(carta if campo in ("rareza", "puntuacion") else carta.jugador, campo)
+        return carta_dict
+
+    return respuesta_json(_lote(ids, catalogo.cartas(ids), a_diccionario))
+
+
+def _clasificaciones_actuales(ids_liga: list, limite: int) -> dict:
+    """
+    Primeros "limite" puestos (con los empatados) de la clasificacion materializada de cada liga,
+    en una consulta: id_liga -> {"participantes", "puestos": [(posicion, id_usuario, email, puntuacion)]}
+    """
+    clasificaciones = {}
+    filas = db.session.execute(
+        select(ClasificacionLiga.id_liga, Liga.num_participantes, ClasificacionLiga.posicion,
+               ClasificacionLiga.id_usuario, ClasificacionLiga.email, ClasificacionLiga.puntuacion)
+        .join(Liga, Liga.id == ClasificacionLiga.id_liga)
+        .where(ClasificacionLiga.id_liga.in_(ids_liga), ClasificacionLiga.posicion <= limite)
+        .order_by(ClasificacionLiga.id_liga, ClasificacionLiga.posicion, ClasificacionLiga.id_usuario)
+    )
+    for id_liga, participantes, posicion, id_usuario, email, puntuacion in filas:
+        clasificacion = clasificaciones.setdefault(id_liga, {"jornada": None, "participantes": participantes,
+                                                             "puestos": []})
+        clasificacion["puestos"].append((posicion, id_usuario, email, puntuacion))
+    return clasificaciones
+
+
+def _clasificaciones_en(ids_liga: list, jornada: str, limite: int, con_email: bool) -> dict:
+    """
+    Como _clasificaciones_actuales, con la ultima foto de cada liga hasta la jornada (una consulta,
+    y otra para los emails si se piden)
+    """
+    anterior = aliased(ClasificacionHistorica)
+    ultima = (
+        select(func.max(anterior.jornada))
+        .where(anterior.id_liga == ClasificacionHistorica.id_liga, anterior.jornada <= jornada)
+        .scalar_subquery()
+    )
+    fotos = db.session.execute(
+        select(ClasificacionHistorica.id_liga, ClasificacionHistorica.jornada, ClasificacionHistorica.participantes,
+               ClasificacionHistorica.datos)
+        .where(ClasificacionHistorica.id_liga.in_(ids_liga), ClasificacionHistorica.jornada == ultima)
+    ).all()
+
+    clasificaciones = {}
+    for id_liga, jornada_foto, participantes, datos in fotos:
+        foto = ClasificacionEnJornada(id_liga, jornada_foto, participantes, datos)
+        clasificaciones[id_liga] = {"jornada": jornada_foto, "participantes": len(foto),
+                                    "puestos": foto.primeros(limite)}
+
+    emails = {}
+    if con_email:
+        ids_usuario = {id_usuario for c in clasificaciones.values() for _, id_usuario, _ in c["puestos"]}
+        if ids_usuario:
+            emails = dict(db.session.execute(
+                select(Usuario.id, Usuario.email).where(Usuario.id.in_(ids_usuario))
+            ).all())
+    for clasificacion in clasificaciones.values():
+        clasificacion["puestos"] = [(posicion, id_usuario, emails.get(id_usuario), round(puntuacion, 2))
+                                    for posicion, id_usuario, puntuacion in clasificacion["puestos"]]
+    return clasificaciones
+
+
+@api.route("/clasificaciones")
+@solo_lectura
+def clasificaciones():
+    ids, campos = _ids(), _campos(CAMPOS_CLASIFICACION)
+    limite = _entero("limite", 10, current_app.config.get("API_MAXIMO_PUESTOS", 100))
+    jornada = request.args.get("jornada")
+    if jornada is not None:
+        try:
+            jornada = datetime.date.fromisoformat(jornada).isoformat()
+        except ValueError:
+            raise BadRequest("'jornada' tiene que ser una fecha AAAA-MM-DD")
+        encontradas = _clasificaciones_en(ids, jornada, limite, "email" in campos)
+    else:
+        encontradas = _clasificaciones_actuales(ids, limite)
+
+    respuesta = {"datos": [], "no_encontrados": [id_liga for id_liga in ids if id_liga not in encontradas]}
+    for id_liga in ids:
+        if id_liga not in encontradas:
+            continue
+        clasificacion = encontradas[id_liga]
+        respuesta["datos"].append({
+            "id_liga": id_liga,
+            "jornada": clasificacion["jornada"],
+            "participantes": clasificacion["participantes"],
+            "clasificacion": [
+                {"id_usuario": id_usuario,
+                 **{campo: valor for campo, valor in zip(CAMPOS_CLASIFICACION, (posicion, email, puntuacion))
+                    if campo in campos}}
+                for posicion, id_usuario, email, puntuacion in clasificacion["puestos"]
+            ],
+        })
+
+    # La clasificacion cambia con cada recomputo: la ETag sale de los propios datos consultados
+    return respuesta_condicional(respuesta, lambda: respuesta_json(respuesta))
+
+
+@api.route("/usuarios/<int:id_usuario>/ligas/<int:id_liga>/cartas")
+@solo_lectura
+def coleccion(id_usuario: int, id_liga: int):
+    campos = _campos(CAMPOS_COLECCION)
+    orden = request.args.get("orden", "rareza")
+    if orden not in ORDENES_COLECCION:
+        raise BadRequest(f"'orden' tiene que ser uno de: {', '.join(ORDENES_COLECCION)}")
+    por_pagina = _entero("por_pagina", 20, current_app.config.get("API_MAXIMO_IDS", 100))
+
+    resumen = resumen_coleccion(id_usuario, id_liga)
+    if resumen is None:
+        raise NotFound("No existe el usuario o la liga")
+    pagina = pagina_coleccion(id_usuario, id_liga, orden, despues=request.args.get("despues"),
+                              antes=request.args.get("antes"), por_pagina=por_pagina)
+    filas = [{"id_jugador": fila.id_jugador, **{campo: getattr(fila, campo) for campo in campos}}
+             for fila in pagina]
+
+    respuesta = {"resumen": resumen, "datos": filas, "siguiente": pagina.siguiente, "anterior": pagina.anterior}
+    return respuesta_condicional(respuesta, lambda: respuesta_json(respuesta))
@@ -0,0 +1,104 @@
+"""
+Busqueda y filtrado de la lista de jugadores.
+
+Se puede buscar por nombre (subcadena, sin distinguir mayusculas), filtrar por equipo, posicion y
+pais, y ordenar por nombre, por puntuacion de la carta o por rareza. Cada orden tiene su indice
+(ver app/modelos.py) y la lista se pagina por cursor, asi que ninguna pagina necesita OFFSET ni COUNT.
+"""
+import threading
+import time
+from decimal import Decimal
+from typing import Optional
+from sqlalchemy import select, event
+from . import db
+from .modelos import Jugador, Carta, rango_rareza
+from .paginacion import PaginaKeyset, paginar_keyset, decodificar_cursor
+
+# Segundos que se reutilizan las opciones de los filtros (equipos, posiciones y paises)
+TTL_OPCIONES = 300
+
+# Orden -> (columnas de ordenacion (columna, descendente), valores de la fila, tipos del cursor)
+ORDENES = {
+    "nombre": (
+        [(Jugador.nombre, False), (Jugador.id_jugador, False)],
+        lambda fila: (fila.Jugador.nombre, fila.Jugador.id_jugador),
+        (str, int),
+    ),
+    "puntuacion": (
+        [(Carta.puntuacion, True), (Carta.id_jugador, True)],
+        lambda fila: (fila.puntuacion, fila.Jugador.id_jugador),
+        (Decimal, int),
+    ),
+    "rareza": (
+        [(rango_rareza, True), (Carta.puntuacion, True), (Carta.id_jugador, True)],
+        lambda fila: (fila.rango, fila.puntuacion, fila.Jugador.id_jugador),
+        (int, Decimal, int),
+    ),
+}
+
+_lock = threading.Lock()
+_opciones = {"instante": None, "valores": None}
+
+
+def _escapar_like(texto: str) -> str:
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def buscar_jugadores(q: str = None, equipo: str = None, posicion: str = None, pais: str = None,
+                     orden: str = "nombre", despues: Optional[str] = None, antes: Optional[str] = None,
+                     por_pagina: int = 20) -> PaginaKeyset:
+    """
+    Pagina de filas (Jugador, puntuacion, rareza, rango) con los jugadores que cumplen los filtros
+    """
+    columnas, valores_fila, tipos = ORDENES.get(orden, ORDENES["nombre"])
+    # Ordenando por nombre tambien se listan los jugadores que aun no tienen carta
+    consulta = select(Jugador, Carta.puntuacion, Carta.rareza, rango_rareza.label("rango")).join(
+        Carta, Carta.id_jugador == Jugador.id_jugador, isouter=orden not in ("puntuacion", "rareza")
+    )
+
+    if q:
+        consulta = consulta.where(Jugador.nombre.ilike(f"%{_escapar_like(q)}%", escape="\\"))
+    if equipo:
+        consulta = consulta.where(Jugador.nombre_equipo == equipo)
+    if posicion:
+        consulta = consulta.where(Jugador.posicion == posicion)
+    if pais:
+        consulta = consulta.where(Jugador.pais == pais)
+
+    return paginar_keyset(
+        consulta,
+        columnas,
+        valores_fila,
+        decodificar_cursor(despues, *tipos),
+        decodificar_cursor(antes, *tipos),
+        por_pagina
+    )
+
+
+def opciones_filtros() -> dict:
+    """
+    Valores distintos de equipo, posicion y pais para los desplegables del formulario de busqueda.
+    Cambian muy poco, asi que se guardan en memoria TTL_OPCIONES segundos (o hasta que se modifica
+    un jugador a traves del ORM en este proceso).
+    """
+    with _lock:
+        if _opciones["instante"] is None or time.monotonic() - _opciones["instante"] > TTL_OPCIONES:
+            _opciones["valores"] = {
+                campo: db.session.scalars(
+                    select(columna).where(columna.is_not(None)).distinct().order_by(columna)
+                ).all()
+                for campo, columna in [("equipo", Jugador.nombre_equipo), ("posicion", Jugador.posicion),
+                                       ("pais", Jugador.pais)]
+            }
+            _opciones["instante"] = time.monotonic()
+        return _opciones["valores"]
+
+
+# Un jugador nuevo o modificado puede traer un equipo, una posicion o un pais que aun no estaba en
+# las opciones: sin invalidarlas, el formulario lo rechazaria hasta que caducaran
+@event.listens_for(Jugador, "after_insert")
+@event.listens_for(Jugador, "after_update")
+@event.listens_for(Jugador, "after_delete")
+def _invalidar_opciones(mapper, connection, objeto):
+    # Sin _lock: el evento puede saltar en el autoflush de la consulta de opciones_filtros
+    _opciones["instante"] = None
@@ -0,0 +1,315 @@
+"""
+Cache de fragmentos HTML y respuestas condicionales de las paginas publicas.
+
+Los datos de la lista de jugadores y del perfil de un jugador solo cambian al ingestar partidos o
+al puntuar las cartas, asi que los trozos caros de esas paginas (consultas y render de las macros)
+se guardan ya renderizados. La clave de cada fragmento lleva la version de los datos de los que
+depende (sus etiquetas, ver app/versiones.py), de modo que al incrementarse una version los
+fragmentos antiguos dejan de usarse sin tener que avisar a cada proceso. Las versiones se
+comprueban como mucho una vez cada CACHE_VERSIONES_TTL segundos.
+
+Almacenes (CACHE_FRAGMENTOS):
+    * "lru": en la memoria de cada proceso, con un maximo de CACHE_FRAGMENTOS_MAXIMO_BYTES. Cuando
+      un proceso ve que una version ha cambiado purga los fragmentos de esa etiqueta.
+    * "redis": compartido entre procesos, en CACHE_REDIS_URL (Redis o cualquier servidor
+      compatible; el tamaño lo limita su maxmemory con una politica LRU). Necesita el paquete redis.
+      admin_script purga las etiquetas al ingestar o puntuar.
+    * "ninguna": sin cache de fragmentos.
+
+Ademas, condicional() y respuesta_condicional() añaden ETag y Last-Modified a las respuestas y
+contestan 304 si el navegador ya tiene la pagina, sin ejecutar la vista cuando la ETag se puede
+calcular solo con las versiones de los datos.
+"""
+import datetime
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Iterable, Optional, Tuple
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from markupsafe import Markup
+from .versiones import versiones_actuales
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class CacheLRU:
+    """
+    Fragmentos en memoria, con un maximo de bytes y expulsion del menos usado recientemente
+    """
+
+    def __init__(self, maximo_bytes: int):
+        self._lock = threading.Lock()
+        self._fragmentos = OrderedDict()    # clave -> (valor, etiquetas, bytes)
+        self._maximo_bytes = maximo_bytes
+        self.bytes = 0
+        self.expulsados = 0
+
+    def obtener(self, clave: str) -> Optional[str]:
+        with self._lock:
+            entrada = self._fragmentos.get(clave)
+            if entrada is None:
+                return None
+            self._fragmentos.move_to_end(clave)
+            return entrada[0]
+
+    def guardar(self, clave: str, valor: str, etiquetas: Iterable[str]) -> None:
+        tamaño = sys.getsizeof(valor)
+        if tamaño > self._maximo_bytes:
+            return
+        with self._lock:
+            anterior = self._fragmentos.pop(clave, None)
+            if anterior is not None:
+                self.bytes -= anterior[2]
+            self._fragmentos[clave] = (valor, frozenset(etiquetas), tamaño)
+            self.bytes += tamaño
+            while self.bytes > self._maximo_bytes:
+                _, (_, _, tamaño_expulsado) = self._fragmentos.popitem(last=False)
+                self.bytes -= tamaño_expulsado
+                self.expulsados += 1
+
+    def purgar(self, *etiquetas: str) -> None:
+        etiquetas = set(etiquetas)
+        with self._lock:
+            for clave in [clave for clave, (_, suyas, _) in self._fragmentos.items() if suyas & etiquetas]:
+                self.bytes -= self._fragmentos.pop(clave)[2]
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._fragmentos.clear()
+            self.bytes = 0
+
+    def estadisticas(self) -> dict:
+        return {"fragmentos": len(self._fragmentos), "bytes": self.bytes, "expulsados": self.expulsados}
+
+
+class CacheRedis:
+    """
+    Fragmentos en un servidor Redis. Cada etiqueta es un conjunto con las claves de sus fragmentos.
+    Si el servidor no responde, se trabaja como si no hubiera cache.
+    """
+    PREFIJO = "nba:fragmento:"
+
+    def __init__(self, url: str, caducidad: int):
+        if redis is None:
+            raise RuntimeError("CACHE_FRAGMENTOS = 'redis' necesita el paquete redis (pip install redis)")
+        self._cliente = redis.Redis.from_url(url)
+        self._caducidad = caducidad
+
+    def _etiqueta(self, etiqueta: str) -> str:
+        return f"{self.PREFIJO}etiqueta:{etiqueta}"
+
+    def obtener(self, clave: str) -> Optional[str]:
+        try:
+            valor = self._cliente.get(self.PREFIJO + clave)
+        except redis.RedisError as e:
+            current_app.logger.warning("Cache de fragmentos no disponible: %s", e)
+            return None
+        return valor.decode("utf-8") if valor is not None else None
+
+    def guardar(self, clave: str, valor: str, etiquetas: Iterable[str]) -> None:
+        try:
+            tuberia = self._cliente.pipeline()
+            tuberia.set(self.PREFIJO + clave, valor.encode("utf-8"), ex=self._caducidad)
+            for etiqueta in etiquetas:
+                tuberia.sadd(self._etiqueta(etiqueta), self.PREFIJO + clave)
+            tuberia.execute()
+        except redis.RedisError as e:
+            current_app.logger.warning("Cache de fragmentos no disponible: %s", e)
+
+    def purgar(self, *etiquetas: str) -> None:
+        try:
+            for etiqueta in etiquetas:
+                claves = self._cliente.smembers(self._etiqueta(etiqueta))
+                self._cliente.delete(self._etiqueta(etiqueta), *claves)
+        except redis.RedisError as e:
+            current_app.logger.warning("Cache de fragmentos no disponible, no se ha purgado %s: %s",
+                                       ", ".join(etiquetas), e)
+
+    def limpiar(self) -> None:
+        try:
+            for clave in self._cliente.scan_iter(self.PREFIJO + "*"):
+                self._cliente.delete(clave)
+        except redis.RedisError as e:
+            current_app.logger.warning("Cache de fragmentos no disponible, no se ha limpiado: %s", e)
+
+    def estadisticas(self) -> dict:
+        return {}
+
+
+class SinCache:
+    """
+    Almacen que no guarda nada (CACHE_FRAGMENTOS = "ninguna")
+    """
+
+    def obtener(self, clave: str) -> Optional[str]:
+        return None
+
+    def guardar(self, clave: str, valor: str, etiquetas: Iterable[str]) -> None:
+        pass
+
+    def purgar(self, *etiquetas: str) -> None:
+        pass
+
+    def limpiar(self) -> None:
+        pass
+
+    def estadisticas(self) -> dict:
+        return {}
+
+
+class CacheFragmentos:
+    """
+    Fragmentos renderizados por version de los datos, con el almacen elegido en CACHE_FRAGMENTOS
+    (creado la primera vez que se usa)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._almacen = None
+        self._versiones = {}        # etiqueta -> (version, actualizada_en, comprobada_en)
+
+        self.aciertos = 0
+        self.fallos = 0
+        self.no_modificadas = 0
+
+    @property
+    def almacen(self):
+        with self._lock:
+            if self._almacen is None:
+                tipo = current_app.config.get("CACHE_FRAGMENTOS", "lru")
+                if tipo == "lru":
+                    self._almacen = CacheLRU(current_app.config.get("CACHE_FRAGMENTOS_MAXIMO_BYTES", 32 * 1024 * 1024))
+                elif tipo == "redis":
+                    self._almacen = CacheRedis(current_app.config["CACHE_REDIS_URL"],
+                                               current_app.config.get("CACHE_FRAGMENTOS_CADUCIDAD", 3600))
+                elif tipo == "ninguna":
+                    self._almacen = SinCache()
+                else:
+                    raise ValueError(f"Almacen de fragmentos desconocido: {tipo} (validos: lru, redis, ninguna)")
+            return self._almacen
+
+    def versiones(self, etiquetas: Iterable[str]) -> Tuple[tuple, Optional[datetime.datetime]]:
+        """
+        Version de cada etiqueta y fecha de la ultima modificacion de cualquiera de ellas
+        """
+        etiquetas = tuple(etiquetas)
+        ahora = time.monotonic()
+        ttl = current_app.config.get("CACHE_VERSIONES_TTL", 5)
+        caducadas = [e for e in etiquetas if e not in self._versiones or ahora - self._versiones[e][2] >= ttl]
+        if caducadas:
+            leidas = versiones_actuales(*caducadas)
+            for etiqueta in caducadas:
+                version, actualizada_en = leidas.get(etiqueta, (0, None))
+                anterior = self._versiones.get(etiqueta)
+                if anterior is not None and anterior[0] != version:
+                    # Los fragmentos de la version anterior ya no se van a pedir: liberamos su sitio
+                    self.almacen.purgar(etiqueta)
+                self._versiones[etiqueta] = (version, actualizada_en, ahora)
+
+        fechas = [self._versiones[e][1] for e in etiquetas if self._versiones[e][1] is not None]
+        return tuple(self._versiones[e][0] for e in etiquetas), max(fechas, default=None)
+
+    def fragmento(self, nombre: str, etiquetas: Iterable[str], partes: tuple, generar: Callable[[], str]) -> Markup:
+        """
+        Devuelve el fragmento "nombre" para los parametros "partes" (filtros, pagina...), generandolo
+        con "generar" si no esta en la cache para las versiones actuales de "etiquetas"
+        """
+        etiquetas = tuple(etiquetas)
+        versiones, _ = self.versiones(etiquetas)
+        clave = f"{nombre}:{_resumen((current_app.config.get('CACHE_SEMILLA', ''), versiones, partes))}"
+        valor = self.almacen.obtener(clave)
+        if valor is not None:
+            self.aciertos += 1
+            return Markup(valor)
+        self.fallos += 1
+        valor = str(generar())
+        self.almacen.guardar(clave, valor, etiquetas)
+        return Markup(valor)
+
+    def purgar(self, *etiquetas: str) -> None:
+        """
+        Borra los fragmentos de esas etiquetas. Con el almacen "lru" solo afecta a este proceso:
+        el resto los descarta al ver la nueva version
+        """
+        self.almacen.purgar(*etiquetas)
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._versiones.clear()
+        self.almacen.limpiar()
+
+    def estadisticas(self) -> dict:
+        return {
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "respuestas_304": self.no_modificadas,
+            "versiones": {etiqueta: version for etiqueta, (version, _, _) in self._versiones.items()},
+            **(self._almacen.estadisticas() if self._almacen is not None else {}),
+        }
+
+
+cache_fragmentos = CacheFragmentos()
+
+
+def _resumen(partes) -> str:
+    return hashlib.sha1(repr(partes).encode("utf-8")).hexdigest()
+
+
+def respuesta_condicional(partes: tuple, generar: Callable, ultima_modificacion: datetime.datetime = None):
+    """
+    Respuesta de "generar" con una ETag calculada a partir de "partes" (mas la URL y el usuario
+    conectado, que cambian la barra de navegacion) y Last-Modified. Si el navegador ya tiene esa
+    version de la pagina, se contesta 304 sin llamar a "generar".
+    """
+    # Con mensajes flash pendientes la pagina es distinta de la que se cacheo: no hay 304 ni ETag
+    if session.get("_flashes"):
+        return make_response(generar())
+
+    etag = _resumen((current_app.config.get("CACHE_SEMILLA", ""), request.full_path,
+                     current_user.get_id(), partes))
+    if ultima_modificacion is not None:
+        # Las fechas de la base de datos son locales y en HTTP van en UTC y sin microsegundos
+        ultima_modificacion = ultima_modificacion.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+    if request.if_none_match:
+        no_modificada = request.if_none_match.contains_weak(etag)
+    else:
+        no_modificada = (ultima_modificacion is not None and request.if_modified_since is not None
+                         and ultima_modificacion <= request.if_modified_since)
+
+    if no_modificada:
+        cache_fragmentos.no_modificadas += 1
+        respuesta = make_response("", 304)
+    else:
+        respuesta = make_response(generar())
+        if respuesta.status_code != 200:
+            return respuesta
+    respuesta.set_etag(etag, weak=True)
+    if ultima_modificacion is not None:
+        respuesta.last_modified = ultima_modificacion
+    # Que el navegador la guarde, pero que pregunte siempre si sigue valiendo (depende de la sesion)
+    respuesta.cache_control.private = True
+    respuesta.cache_control.no_cache = True
+    respuesta.vary.add("Cookie")
+    return respuesta
+
+
+def condicional(*etiquetas: str):
+    """
+    Decorador para las vistas cuya pagina solo depende de la URL, del usuario conectado y de los
+    datos de "etiquetas": la ETag sale de las versiones, sin ejecutar la vista
+    """
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            versiones, ultima_modificacion = cache_fragmentos.versiones(etiquetas)
+            return respuesta_condicional(versiones, lambda: vista(*args, **kwargs), ultima_modificacion)
+        return envoltura
+    return decorador
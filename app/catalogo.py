@@ -0,0 +1,223 @@
+"""
+Catalogo de jugadores y cartas en memoria.
+
+Las paginas que muestran cartas (tirada diaria, cartas de un usuario en una liga, perfil de un
+jugador) solo necesitan unos pocos campos del jugador (nombre, equipo, imagen...) y de su carta
+(rareza y puntuacion), y esos datos cambian como mucho una vez al dia. En lugar de cargar objetos
+Jugador y Carta del ORM en cada peticion, cada proceso guarda una copia de solo lectura de todos
+los jugadores, con registros compactos (__slots__, textos repetidos compartidos con sys.intern)
+indexados por id_jugador. Los templates los usan igual que los objetos del ORM.
+
+Como el pool de cartas, el catalogo se recarga entero cuando:
+    * Se modifica un Jugador o una Carta desde este mismo proceso (eventos del ORM).
+    * La version "cartas" de la base de datos cambia (la incrementa admin_script al puntuar las
+      cartas). Esta version se comprueba como mucho una vez cada CATALOGO_TTL segundos.
+"""
+import sys
+import threading
+import time
+from typing import Iterable, Optional
+from flask import current_app
+from sqlalchemy import select, event
+from sqlalchemy.orm import selectinload
+from . import db
+from .modelos import Jugador, Carta
+from .versiones import version_actual
+
+CLAVE_VERSION = "cartas"
+
+
+class _FichaSoloLectura:
+    """
+    Registro compacto y de solo lectura del catalogo
+    """
+    __slots__ = ()
+
+    def __init__(self, *valores):
+        for campo, valor in zip(self.__slots__, valores):
+            object.__setattr__(self, campo, valor)
+
+    def __setattr__(self, campo, valor):
+        raise AttributeError("El catalogo es de solo lectura: usa los modelos del ORM para modificar datos")
+
+
+class FichaJugador(_FichaSoloLectura):
+    """
+    Campos de Jugador que muestran los templates, y su carta (o None)
+    """
+    __slots__ = ("id_jugador", "nombre", "nombre_equipo", "posicion", "altura", "fecha_nacimiento", "pais",
+                 "url_imagen", "carta")
+
+
+class FichaCarta(_FichaSoloLectura):
+    """
+    Rareza y puntuacion de la carta de un jugador, con su ficha de jugador
+    """
+    __slots__ = ("id_jugador", "rareza", "puntuacion", "jugador")
+
+
+def _compartido(texto: Optional[str]) -> Optional[str]:
+    # Equipos, posiciones, paises y rarezas se repiten en miles de jugadores: una sola copia de cada uno
+    return sys.intern(texto) if texto is not None else None
+
+
+class Catalogo:
+    """
+    Fichas de los jugadores y de las cartas por id_jugador, con contadores de aciertos y recargas
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jugadores = {}
+        self._cartas = {}
+        self._version = None
+        self._comprobado_en = 0.0
+        self._invalidado = True
+
+        self.aciertos = 0
+        self.recargas = 0
+        self.bytes = 0
+        self.segundos_recarga = 0.0
+
+    def invalidar(self) -> None:
+        """
+        Marca el catalogo para que se recargue en la siguiente consulta
+        """
+        self._invalidado = True
+
+    def jugador(self, id_jugador: int):
+        """
+        Ficha del jugador, o None si no existe. Si aun no esta en el catalogo de este proceso
+        (p. ej. recien creado), se lee el Jugador de la base de datos.
+        """
+        jugador = self._vigentes()[0].get(id_jugador)
+        return jugador if jugador is not None else db.session.get(Jugador, id_jugador)
+
+    def jugadores(self, ids_jugador: Iterable[int]) -> dict:
+        """
+        Diccionario id_jugador -> ficha de los jugadores indicados. Los que aun no estan en el
+        catalogo se leen de la base de datos (objetos Jugador); los que no existen no aparecen.
+        """
+        ids_jugador = set(ids_jugador)
+        jugadores = self._vigentes()[0]
+        encontrados = {id_jugador: jugadores[id_jugador] for id_jugador in ids_jugador if id_jugador in jugadores}
+        faltan = ids_jugador - encontrados.keys()
+        if faltan:
+            encontrados.update((j.id_jugador, j) for j in db.session.scalars(
+                select(Jugador).where(Jugador.id_jugador.in_(faltan))
+            ))
+        return encontrados
+
+    def cartas(self, ids_jugador: Iterable[int]) -> dict:
+        """
+        Diccionario id_jugador -> ficha de las cartas indicadas (con carta.jugador). Las que aun
+        no estan en el catalogo se leen de la base de datos (objetos Carta); las que no existen
+        no aparecen.
+        """
+        ids_jugador = set(ids_jugador)
+        cartas = self._vigentes()[1]
+        encontradas = {id_jugador: cartas[id_jugador] for id_jugador in ids_jugador if id_jugador in cartas}
+        faltan = ids_jugador - encontradas.keys()
+        if faltan:
+            encontradas.update((c.id_jugador, c) for c in db.session.scalars(
+                select(Carta).where(Carta.id_jugador.in_(faltan)).options(selectinload(Carta.jugador))
+            ))
+        return encontradas
+
+    def estadisticas(self) -> dict:
+        return {
+            "aciertos": self.aciertos,
+            "recargas": self.recargas,
+            "version": self._version,
+            "jugadores": len(self._jugadores),
+            "cartas": len(self._cartas),
+            "bytes": self.bytes,
+            "segundos_recarga": round(self.segundos_recarga, 3),
+        }
+
+    def _vigentes(self):
+        with self._lock:
+            if not self._vigente():
+                self._recargar()
+            else:
+                self.aciertos += 1
+            # Se devuelven los diccionarios de esta carga: una recarga posterior los sustituye, no los modifica
+            return self._jugadores, self._cartas
+
+    def _vigente(self) -> bool:
+        if self._invalidado:
+            return False
+        ahora = time.monotonic()
+        if ahora - self._comprobado_en < current_app.config.get("CATALOGO_TTL", 30):
+            return True
+        self._comprobado_en = ahora
+        return version_actual(CLAVE_VERSION) == self._version
+
+    def _recargar(self) -> None:
+        inicio = time.perf_counter()
+        # Si se invalida mientras se carga, el flag vuelve a quedar activo y se recarga otra vez
+        self._invalidado = False
+        try:
+            jugadores, cartas, version = self._cargar()
+        except Exception:
+            self._invalidado = True
+            raise
+
+        self._jugadores, self._cartas = jugadores, cartas
+        self._version = version
+        self._comprobado_en = time.monotonic()
+        self.recargas += 1
+        self.bytes = _memoria(jugadores, cartas)
+        self.segundos_recarga = time.perf_counter() - inicio
+
+    def _cargar(self):
+        # Version antes que los datos: si cambian entre medias, la siguiente comprobacion recarga otra vez
+        version = version_actual(CLAVE_VERSION)
+        jugadores, cartas = {}, {}
+        filas = db.session.execute(
+            select(Jugador.id_jugador, Jugador.nombre, Jugador.nombre_equipo, Jugador.posicion, Jugador.altura,
+                   Jugador.fecha_nacimiento, Jugador.pais, Jugador.url_imagen, Carta.rareza, Carta.puntuacion)
+            .outerjoin(Carta, Carta.id_jugador == Jugador.id_jugador)
+        )
+        for (id_jugador, nombre, equipo, posicion, altura, nacimiento, pais, imagen, rareza, puntuacion) in filas:
+            carta = None
+            if rareza is not None:
+                carta = FichaCarta(id_jugador, _compartido(rareza), float(puntuacion), None)
+                cartas[id_jugador] = carta
+            jugador = FichaJugador(id_jugador, nombre, _compartido(equipo), _compartido(posicion),
+                                   float(altura), nacimiento, _compartido(pais), imagen, carta)
+            if carta is not None:
+                object.__setattr__(carta, "jugador", jugador)
+            jugadores[id_jugador] = jugador
+        return jugadores, cartas, version
+
+
+def _memoria(jugadores: dict, cartas: dict) -> int:
+    """
+    Bytes que ocupan los diccionarios, las fichas y sus valores (cada objeto compartido se cuenta una vez)
+    """
+    vistos = set()
+    total = sys.getsizeof(jugadores) + sys.getsizeof(cartas)
+    for ficha in (*jugadores.values(), *cartas.values()):
+        total += sys.getsizeof(ficha)
+        for campo in ficha.__slots__:
+            valor = getattr(ficha, campo)
+            if isinstance(valor, _FichaSoloLectura) or id(valor) in vistos:
+                continue
+            vistos.add(id(valor))
+            total += sys.getsizeof(valor)
+    return total
+
+
+catalogo = Catalogo()
+
+
+# Cualquier cambio de jugadores o cartas hecho a traves del ORM en este proceso invalida el catalogo
+@event.listens_for(Jugador, "after_insert")
+@event.listens_for(Jugador, "after_update")
+@event.listens_for(Jugador, "after_delete")
+@event.listens_for(Carta, "after_insert")
+@event.listens_for(Carta, "after_update")
+@event.listens_for(Carta, "after_delete")
+def _invalidar_catalogo(mapper, connection, objeto):
+    catalogo.invalidar()
@@ -0,0 +1,95 @@
+"""
+Clasificacion de las ligas.
+
+La tabla clasificacion_liga guarda la posicion, puntuacion y email de cada participante y se
+reconstruye (por bloques de ligas) cada vez que se recomputan las puntuaciones. La posicion de
+un usuario se consulta por clave primaria; los que se han unido despues del ultimo recomputo
+aun no estan en la tabla, y su posicion se calcula contando quien tiene mas puntos.
+"""
+from decimal import Decimal
+from typing import Optional
+from sqlalchemy import select, delete, func
+from . import db
+from .modelos import ClasificacionLiga, ParticipaLiga, Usuario
+from .paginacion import paginar_keyset, decodificar_cursor, PaginaKeyset
+
+
+def actualizar_clasificacion(desde_liga: Optional[int] = None, hasta_liga: Optional[int] = None) -> None:
+    """
+    Reconstruye la clasificacion de las ligas con id en [desde_liga, hasta_liga), o de todas.
+    No hace commit.
+    """
+    borrar = delete(ClasificacionLiga)
+    participaciones = (
+        select(
+            ParticipaLiga.id_liga,
+            ParticipaLiga.id_usuario,
+            func.rank().over(
+                partition_by=ParticipaLiga.id_liga,
+                order_by=ParticipaLiga.puntuacion_acumulada.desc()
+            ),
+            ParticipaLiga.puntuacion_acumulada,
+            Usuario.email
+        )
+        .join(Usuario, Usuario.id == ParticipaLiga.id_usuario)
+    )
+    if desde_liga is not None:
+        borrar = borrar.where(ClasificacionLiga.id_liga >= desde_liga, ClasificacionLiga.id_liga < hasta_liga)
+        participaciones = participaciones.where(ParticipaLiga.id_liga >= desde_liga,
+                                                ParticipaLiga.id_liga < hasta_liga)
+
+    db.session.execute(borrar)
+    db.session.execute(
+        ClasificacionLiga.__table__.insert().from_select(
+            ["id_liga", "id_usuario", "posicion", "puntuacion", "email"], participaciones
+        )
+    )
+
+
+def posicion_en_liga(id_liga: int, id_usuario: int) -> Optional[int]:
+    """
+    Posicion del usuario en la liga, o None si no participa en ella
+    """
+    posicion = db.session.scalar(
+        select(ClasificacionLiga.posicion)
+        .where(ClasificacionLiga.id_liga == id_liga, ClasificacionLiga.id_usuario == id_usuario)
+    )
+    if posicion is not None:
+        return posicion
+
+    # Se ha unido despues del ultimo recomputo
+    puntuacion = db.session.scalar(
+        select(ParticipaLiga.puntuacion_acumulada)
+        .where(ParticipaLiga.id_liga == id_liga, ParticipaLiga.id_usuario == id_usuario)
+    )
+    if puntuacion is None:
+        return None
+    return 1 + db.session.scalar(
+        select(func.count())
+        .select_from(ParticipaLiga)
+        .where(ParticipaLiga.id_liga == id_liga, ParticipaLiga.puntuacion_acumulada > puntuacion)
+    )
+
+
+def pagina_clasificacion(id_liga: int, despues: Optional[str], antes: Optional[str],
+                         por_pagina: int) -> PaginaKeyset:
+    """
+    Pagina de participantes de la liga ordenada por (puntuacion_acumulada DESC, id_usuario),
+    con el email del usuario y su posicion en la clasificacion materializada (None si aun no tiene)
+    """
+    consulta = (
+        select(ParticipaLiga.id_liga, ParticipaLiga.id_usuario, ParticipaLiga.puntuacion_acumulada,
+               Usuario.email, ClasificacionLiga.posicion)
+        .join(Usuario, Usuario.id == ParticipaLiga.id_usuario)
+        .outerjoin(ClasificacionLiga, (ClasificacionLiga.id_liga == ParticipaLiga.id_liga) &
+                   (ClasificacionLiga.id_usuario == ParticipaLiga.id_usuario))
+        .where(ParticipaLiga.id_liga == id_liga)
+    )
+    return paginar_keyset(
+        consulta,
+        [(ParticipaLiga.puntuacion_acumulada, True), (ParticipaLiga.id_usuario, False)],
+        lambda fila: (fila.puntuacion_acumulada, fila.id_usuario),
+        decodificar_cursor(despues, Decimal, int),
+        decodificar_cursor(antes, Decimal, int),
+        por_pagina
+    )
@@ -0,0 +1,89 @@
+"""
+Coleccion de cartas de un usuario en una liga.
+
+La pagina de cartas se saca con una sola consulta (CartaLiga + Carta + Jugador) paginada por
+cursor, ordenando por rareza, por puntuacion o por numero de copias. El resumen de la coleccion
+(cartas distintas, copias y puntuacion por rareza) sale de una unica consulta agregada, que ademas
+sirve para comprobar que el usuario y la liga existen.
+"""
+from decimal import Decimal
+from typing import Optional
+from sqlalchemy import select, func, and_
+from . import db
+from .modelos import Usuario, Liga, Jugador, Carta, CartaLiga, rango_rareza
+from .paginacion import PaginaKeyset, paginar_keyset, decodificar_cursor
+from .tirada import RAREZAS
+
+# Orden -> (columnas de ordenacion (columna, descendente), valores de la fila, tipos del cursor)
+ORDENES = {
+    "rareza": (
+        [(rango_rareza, True), (Carta.puntuacion, True), (CartaLiga.id_jugador, True)],
+        lambda fila: (fila.rango, fila.puntuacion, fila.id_jugador),
+        (int, Decimal, int),
+    ),
+    "puntuacion": (
+        [(Carta.puntuacion, True), (CartaLiga.id_jugador, True)],
+        lambda fila: (fila.puntuacion, fila.id_jugador),
+        (Decimal, int),
+    ),
+    "copias": (
+        [(CartaLiga.numero_copias, True), (CartaLiga.id_jugador, True)],
+        lambda fila: (fila.numero_copias, fila.id_jugador),
+        (int, int),
+    ),
+}
+
+
+def pagina_coleccion(id_usuario: int, id_liga: int, orden: str = "rareza", despues: Optional[str] = None,
+                     antes: Optional[str] = None, por_pagina: int = 8) -> PaginaKeyset:
+    """
+    Pagina de cartas del usuario en la liga. Cada fila tiene los campos de la carta (rareza,
+    puntuacion), del jugador (id_jugador, nombre, nombre_equipo, url_imagen) y numero_copias,
+    asi que se puede pasar a la macro mostrar_carta como jugador y como carta a la vez.
+    """
+    columnas, valores_fila, tipos = ORDENES.get(orden, ORDENES["rareza"])
+    consulta = (
+        select(CartaLiga.id_jugador, CartaLiga.numero_copias, Carta.rareza, Carta.puntuacion,
+               rango_rareza.label("rango"), Jugador.nombre, Jugador.nombre_equipo, Jugador.url_imagen)
+        .join(Carta, Carta.id_jugador == CartaLiga.id_jugador)
+        .join(Jugador, Jugador.id_jugador == CartaLiga.id_jugador)
+        .where(CartaLiga.id_usuario == id_usuario, CartaLiga.id_liga == id_liga)
+    )
+    return paginar_keyset(
+        consulta,
+        columnas,
+        valores_fila,
+        decodificar_cursor(despues, *tipos),
+        decodificar_cursor(antes, *tipos),
+        por_pagina
+    )
+
+
+def resumen_coleccion(id_usuario: int, id_liga: int) -> Optional[dict]:
+    """
+    Cartas distintas, copias y puntuacion (suma de las cartas distintas) de la coleccion, en total
+    y por rareza. Devuelve None si el usuario o la liga no existen.
+    """
+    # Usuario x liga (una fila si existen los dos) con sus cartas agrupadas por rareza; sin cartas
+    # queda una unica fila con rareza NULL y contadores a 0
+    filas = db.session.execute(
+        select(Carta.rareza, func.count(CartaLiga.id_jugador), func.coalesce(func.sum(CartaLiga.numero_copias), 0),
+               func.coalesce(func.sum(Carta.puntuacion), 0))
+        .select_from(Usuario)
+        .join(Liga, Liga.id == id_liga)
+        .outerjoin(CartaLiga, and_(CartaLiga.id_usuario == Usuario.id, CartaLiga.id_liga == Liga.id))
+        .outerjoin(Carta, Carta.id_jugador == CartaLiga.id_jugador)
+        .where(Usuario.id == id_usuario)
+        .group_by(Carta.rareza)
+    ).all()
+    if not filas:
+        return None
+
+    por_rareza = {rareza: {"cartas": cartas, "copias": copias, "puntuacion": puntuacion}
+                  for rareza, cartas, copias, puntuacion in filas if rareza is not None}
+    return {
+        "cartas": sum(r["cartas"] for r in por_rareza.values()),
+        "copias": sum(r["copias"] for r in por_rareza.values()),
+        "puntuacion": sum((r["puntuacion"] for r in por_rareza.values()), Decimal(0)),
+        "por_rareza": [(rareza, por_rareza[rareza]) for rareza in RAREZAS if rareza in por_rareza],
+    }
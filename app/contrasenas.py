@@ -0,0 +1,90 @@
+"""
+Hash de contraseñas (usuarios y ligas privadas) fuera del hilo de la peticion.
+
+generate_password_hash y check_password_hash son lentos a proposito. Con HASH_PROCESOS > 0 se
+ejecutan en un pool de procesos de ese tamaño, para que una avalancha de logins no deje sin CPU
+al resto de vistas; como mucho hay HASH_MAXIMO_PENDIENTES hashes en cola, y si el pool esta
+saturado se lanza HashSaturado en lugar de encolar sin limite. Con HASH_PROCESOS = 0 se calculan
+en el propio hilo. Los procesos se arrancan con "spawn", asi que los scripts que creen la app
+tienen que proteger su codigo con if __name__ == "__main__".
+
+El algoritmo y su coste se configuran por perfil con HASH_METODO (p. ej. "scrypt:32768:8:1" o
+"pbkdf2:sha256:600000"). Los hashes hechos con otros parametros siguen siendo validos, y
+necesita_rehash() indica cuando conviene recalcularlos (al hacer login, que es cuando tenemos
+la contraseña en claro).
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashSaturado(RuntimeError):
+    """
+    Hay demasiados hashes de contraseña pendientes
+    """
+
+
+class PoolHash:
+    """
+    Pool de procesos para los hashes, creado la primera vez que se usa (despues del fork de los workers)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ejecutor = None
+        self._pendientes = None
+        self._prefijos = {}
+
+    def _iniciar(self) -> None:
+        procesos = current_app.config.get("HASH_PROCESOS", 0)
+        # spawn: los procesos hijos no heredan los hilos ni las conexiones del worker
+        self._ejecutor = ProcessPoolExecutor(max_workers=procesos,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        self._pendientes = threading.BoundedSemaphore(
+            current_app.config.get("HASH_MAXIMO_PENDIENTES", procesos * 4)
+        )
+
+    def ejecutar(self, funcion, *args):
+        if not current_app.config.get("HASH_PROCESOS", 0):
+            return funcion(*args)
+        with self._lock:
+            if self._ejecutor is None:
+                self._iniciar()
+        if not self._pendientes.acquire(timeout=current_app.config.get("HASH_ESPERA_MAXIMA", 5)):
+            raise HashSaturado("Hay demasiados hashes de contraseña pendientes")
+        try:
+            return self._ejecutor.submit(funcion, *args).result()
+        finally:
+            self._pendientes.release()
+
+    def prefijo(self, metodo: str) -> str:
+        # Parametros tal y como quedan escritos en el hash ("scrypt" -> "scrypt:32768:8:1")
+        if metodo not in self._prefijos:
+            self._prefijos[metodo] = generate_password_hash("", method=metodo, salt_length=1).split("$", 1)[0]
+        return self._prefijos[metodo]
+
+    def cerrar(self) -> None:
+        with self._lock:
+            if self._ejecutor is not None:
+                self._ejecutor.shutdown()
+                self._ejecutor = None
+
+
+pool_hash = PoolHash()
+
+
+def generar_hash(password: str) -> str:
+    return pool_hash.ejecutar(generate_password_hash, password, current_app.config.get("HASH_METODO", "scrypt"))
+
+
+def comprobar_hash(password_hash: str, password: str) -> bool:
+    return pool_hash.ejecutar(check_password_hash, password_hash, password)
+
+
+def necesita_rehash(password_hash: str) -> bool:
+    """
+    Si el hash se hizo con un algoritmo o coste distintos de HASH_METODO
+    """
+    return password_hash.split("$", 1)[0] != pool_hash.prefijo(current_app.config.get("HASH_METODO", "scrypt"))
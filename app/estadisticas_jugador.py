@@ -0,0 +1,170 @@
+"""
+Estadisticas agregadas de los jugadores (tabla estadisticas_jugador).
+
+Se recalculan solo para los jugadores afectados cada vez que se ingestan partidos o historicos:
+los totales y victorias con una consulta agregada, y la mediana y la forma (media de los
+ultimos partidos) con NumPy sobre las puntuaciones ordenadas por fecha, como en el calculo de
+la puntuacion de las cartas.
+
+El historico de partidos del perfil se pagina por cursor, para que la pagina cueste lo mismo
+tenga el jugador las temporadas que tenga.
+"""
+import datetime
+from typing import Iterable, Optional
+import numpy as np
+from flask import current_app
+from sqlalchemy import select, func, case, and_, or_, not_
+from . import db
+from .modelos import Jugador, Partido, Historico, EstadisticasJugador
+from .paginacion import PaginaKeyset, paginar_keyset, decodificar_cursor
+from .puntuacion_cartas import calcular_puntuaciones
+from .utilidades_bd import insert_con_conflicto
+from .versiones import incrementar_version
+
+# Clave de la version de los historicos y estadisticas (ver app/versiones.py)
+CLAVE_VERSION = "historico"
+
+# Jugadores por consulta (limita el tamaño de los IN)
+TAM_BLOQUE = 1000
+
+
+def _victoria():
+    """
+    Expresion SQL equivalente a la de macro_mostrar_historico.html: gana si su equipo es el local y
+    gana el local, o si es el visitante y gana el visitante
+    """
+    return or_(
+        and_(Jugador.nombre_equipo == Partido.equipo_local, Partido.gana_local),
+        and_(Jugador.nombre_equipo == Partido.equipo_visitante, not_(Partido.gana_local))
+    )
+
+
+def _actualizar_bloque(ids_jugador: list, partidos_forma: int) -> int:
+    totales = db.session.execute(
+        select(
+            Historico.id_jugador,
+            func.count(),
+            func.sum(Historico.tiempo_jugador),
+            func.sum(func.coalesce(Historico.puntos_marcados, 0)),
+            func.avg(Historico.puntuacion),
+            func.sum(case((_victoria(), 1), else_=0)),
+        )
+        .join(Partido, Partido.id_partido == Historico.id_partido)
+        .join(Jugador, Jugador.id_jugador == Historico.id_jugador)
+        .where(Historico.id_jugador.in_(ids_jugador))
+        .group_by(Historico.id_jugador)
+    ).all()
+
+    filas = db.session.execute(
+        select(Historico.id_jugador, Historico.puntuacion)
+        .join(Partido, Partido.id_partido == Historico.id_partido)
+        .where(Historico.id_jugador.in_(ids_jugador))
+        .order_by(Historico.id_jugador, Partido.fecha.desc(), Partido.id_partido.desc())
+    ).all()
+    ids = np.fromiter((f[0] for f in filas), dtype=np.int64, count=len(filas))
+    puntuaciones = np.fromiter((f[1] for f in filas), dtype=np.float64, count=len(filas))
+    max_partidos = max((t[1] for t in totales), default=1)
+    _, medianas = calcular_puntuaciones(ids, puntuaciones, max_partidos, "mediana")
+    ids_unicos, formas = calcular_puntuaciones(ids, puntuaciones, partidos_forma, "media")
+    mediana = dict(zip(ids_unicos.tolist(), medianas.tolist()))
+    forma = dict(zip(ids_unicos.tolist(), formas.tolist()))
+
+    ahora = datetime.datetime.now()
+    estadisticas = [
+        {
+            "id_jugador": id_jugador,
+            "partidos": partidos,
+            "minutos": minutos or 0,
+            "puntos": puntos or 0,
+            "puntuacion_media": round(float(media), 2),
+            "puntuacion_mediana": round(mediana[id_jugador], 2),
+            "victorias": victorias or 0,
+            "derrotas": partidos - (victorias or 0),
+            "forma": round(forma[id_jugador], 2),
+            "actualizada_en": ahora,
+        }
+        for id_jugador, partidos, minutos, puntos, media, victorias in totales
+    ]
+    if estadisticas:
+        stmt = insert_con_conflicto(EstadisticasJugador)
+        db.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[EstadisticasJugador.id_jugador],
+                set_={c: stmt.excluded[c] for c in estadisticas[0] if c != "id_jugador"}
+            ),
+            estadisticas
+        )
+    return len(estadisticas)
+
+
+def actualizar_rango(desde_jugador: int, hasta_jugador: int, ids_jugador: Iterable[int] = None) -> int:
+    """
+    Recalcula las estadisticas de los jugadores con historico e id en [desde_jugador, hasta_jugador)
+    (solo los de "ids_jugador", si se indica). No hace commit ni incrementa la version. Devuelve el
+    numero de jugadores actualizados.
+    """
+    if ids_jugador is None:
+        ids_jugador = db.session.scalars(
+            select(Historico.id_jugador)
+            .where(Historico.id_jugador >= desde_jugador, Historico.id_jugador < hasta_jugador)
+            .distinct()
+        ).all()
+    ids_jugador = sorted(i for i in set(ids_jugador) if desde_jugador <= i < hasta_jugador)
+    partidos_forma = current_app.config.get("ESTADISTICAS_PARTIDOS_FORMA", 5)
+    return sum(_actualizar_bloque(ids_jugador[i:i + TAM_BLOQUE], partidos_forma)
+               for i in range(0, len(ids_jugador), TAM_BLOQUE))
+
+
+def actualizar_estadisticas(ids_jugador: Iterable[int] = None) -> int:
+    """
+    Recalcula las estadisticas de los jugadores indicados (o de todos los que tienen historico).
+    Devuelve el numero de jugadores actualizados. Para repartir los jugadores entre varios
+    procesos, ver el trabajo "estadisticas-jugadores" de app/trabajos.py.
+    """
+    if ids_jugador is None:
+        ids_jugador = db.session.scalars(select(Historico.id_jugador).distinct()).all()
+    ids_jugador = sorted(set(ids_jugador))
+    partidos_forma = current_app.config.get("ESTADISTICAS_PARTIDOS_FORMA", 5)
+
+    actualizados = 0
+    for i in range(0, len(ids_jugador), TAM_BLOQUE):
+        actualizados += _actualizar_bloque(ids_jugador[i:i + TAM_BLOQUE], partidos_forma)
+        db.session.commit()
+    if ids_jugador:
+        # Despues de confirmar los datos: quien lea la nueva version ya ve los historicos nuevos
+        incrementar_version(CLAVE_VERSION)
+        db.session.commit()
+    return actualizados
+
+
+def jugadores_de_partidos(ids_partido: Iterable[int]) -> set:
+    """
+    Jugadores con historico en alguno de los partidos indicados
+    """
+    ids_partido = list(ids_partido)
+    jugadores = set()
+    for i in range(0, len(ids_partido), TAM_BLOQUE):
+        jugadores.update(db.session.scalars(
+            select(Historico.id_jugador).where(Historico.id_partido.in_(ids_partido[i:i + TAM_BLOQUE])).distinct()
+        ))
+    return jugadores
+
+
+def pagina_historico(id_jugador: int, despues: Optional[str], antes: Optional[str],
+                     por_pagina: int) -> PaginaKeyset:
+    """
+    Pagina de tuplas (Historico, Partido) del jugador, del partido mas reciente al mas antiguo
+    """
+    consulta = (
+        select(Historico, Partido)  # macro_mostrar_historico espera una tupla
+        .join(Partido, Historico.id_partido == Partido.id_partido)
+        .where(Historico.id_jugador == id_jugador)
+    )
+    return paginar_keyset(
+        consulta,
+        [(Partido.fecha, True), (Partido.id_partido, True)],
+        lambda fila: (fila[1].fecha, fila[1].id_partido),
+        decodificar_cursor(despues, datetime.date.fromisoformat, int),
+        decodificar_cursor(antes, datetime.date.fromisoformat, int),
+        por_pagina
+    )
@@ -1,11 +1,9 @@
 """
 Modulo en el que definimos los formularios de nuestra aplicacion
 """
-from typing import List
 import datetime
-from dateutil import relativedelta
-from wtforms import StringField, PasswordField, SelectField, DateField, SubmitField, BooleanField, IntegerField
-from wtforms.validators import DataRequired, Length, Email, EqualTo, URL, ValidationError, NumberRange, Optional
+from wtforms import StringField, PasswordField, SelectField, DateField, SubmitField, IntegerField
+from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Optional
 from flask_wtf import FlaskForm
 
 
@@ -77,4 +75,27 @@ class CrearLigaForm(FlaskForm):
     )
     password = PasswordField('Contraseña (opcional)', validators=[Optional()])
 
-    submit = SubmitField('Crear')
\ No newline at end of file
+    submit = SubmitField('Crear')
+
+class BuscarJugadoresForm(FlaskForm):
+    """Formulario (GET) de busqueda y filtrado de la lista de jugadores"""
+    class Meta:
+        # Es un formulario de consulta: no modifica nada y sus parametros van en la URL
+        csrf = False
+
+    q = StringField('Nombre', validators=[Optional(), Length(max=100)])
+    equipo = SelectField('Equipo', default="", validators=[Optional()])
+    posicion = SelectField('Posición', default="", validators=[Optional()])
+    pais = SelectField('País', default="", validators=[Optional()])
+    orden = SelectField(
+        'Ordenar por',
+        choices=[("nombre", "Nombre"), ("puntuacion", "Puntuación de la carta"), ("rareza", "Rareza")],
+        default="nombre"
+    )
+
+    submit = SubmitField('Buscar')
+
+    def cargar_opciones(self, opciones: dict) -> None:
+        # Las opciones de los desplegables salen de la base de datos (app/busqueda_jugadores.py)
+        for campo in ("equipo", "posicion", "pais"):
+            getattr(self, campo).choices = [("", "Todos")] + [(valor, valor) for valor in opciones[campo]]
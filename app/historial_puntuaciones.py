@@ -0,0 +1,227 @@
+"""
+Historial de las puntuaciones de las ligas.
+
+participa_liga solo guarda la puntuacion acumulada actual, que cada recomputo sobrescribe. Para
+poder consultar el pasado se guardan, al aplicar cada jornada (ver app/puntuaciones.py):
+
+    * movimiento_puntuacion: libro de solo insercion con una fila por cada participacion cuya
+      puntuacion cambia (jornada, diferencia y puntuacion resultante). La evolucion de un usuario
+      en una liga es un recorrido del indice (id_usuario, id_liga, id).
+    * clasificacion_historica: una foto compacta de la clasificacion de cada liga por jornada, con
+      los ids de los usuarios, sus posiciones y sus puntuaciones empaquetados en un unico campo
+      binario (12 bytes por participante). La clasificacion de una liga en una fecha es una
+      busqueda por clave primaria.
+
+Las puntuaciones de las fotos se guardan en float32: bastan para mostrar, y los valores exactos
+estan en el libro de movimientos. Las posiciones se copian de clasificacion_liga y no se deducen
+de esas puntuaciones redondeadas, que podrian empatar a participantes que no estaban empatados.
+Las fotos guardadas antes de incluir las posiciones (8 bytes por participante) se siguen leyendo,
+con las posiciones calculadas a partir de las puntuaciones en float32 (aproximadas).
+"""
+import datetime
+from typing import Optional, List
+import numpy as np
+from sqlalchemy import select, func
+from . import db
+from .modelos import MovimientoPuntuacion, ClasificacionHistorica, ClasificacionLiga, Usuario
+from .utilidades_bd import insert_con_conflicto
+from .paginacion import decodificar_cursor, PaginaKeyset
+
+# Ligas cuyas clasificaciones se leen y se guardan de una vez al hacer las fotos
+LIGAS_POR_LOTE = 500
+
+_TIPO_IDS = np.dtype("<i4")
+_TIPO_POSICIONES = np.dtype("<i4")
+_TIPO_PUNTUACIONES = np.dtype("<f4")
+
+
+def codificar_clasificacion(ids_usuario, posiciones, puntuaciones) -> bytes:
+    """
+    Empaqueta una clasificacion (ya ordenada por posicion) en el formato de ClasificacionHistorica.datos
+    """
+    return (np.asarray(ids_usuario, dtype=_TIPO_IDS).tobytes() +
+            np.asarray(posiciones, dtype=_TIPO_POSICIONES).tobytes() +
+            np.asarray(puntuaciones, dtype=_TIPO_PUNTUACIONES).tobytes())
+
+
+def _posiciones_aproximadas(puntuaciones: np.ndarray) -> np.ndarray:
+    # Mismas posiciones que RANK() sobre las puntuaciones en float32: los empatados comparten
+    # posicion y la siguiente se salta
+    indices = np.arange(1, puntuaciones.size + 1)
+    cambia = np.r_[True, puntuaciones[1:] != puntuaciones[:-1]]
+    return np.maximum.accumulate(np.where(cambia, indices, 0))
+
+
+def decodificar_clasificacion(datos: bytes, participantes: int):
+    """
+    Devuelve los arrays (ids_usuario, posiciones, puntuaciones) de una clasificacion empaquetada
+    """
+    ids_usuario = np.frombuffer(datos, dtype=_TIPO_IDS, count=participantes)
+    if len(datos) == participantes * (_TIPO_IDS.itemsize + _TIPO_PUNTUACIONES.itemsize):
+        # Foto anterior a guardar las posiciones
+        puntuaciones = np.frombuffer(datos, dtype=_TIPO_PUNTUACIONES, count=participantes,
+                                     offset=participantes * _TIPO_IDS.itemsize)
+        return ids_usuario, _posiciones_aproximadas(puntuaciones), puntuaciones
+    posiciones = np.frombuffer(datos, dtype=_TIPO_POSICIONES, count=participantes,
+                               offset=participantes * _TIPO_IDS.itemsize)
+    puntuaciones = np.frombuffer(datos, dtype=_TIPO_PUNTUACIONES, count=participantes,
+                                 offset=participantes * (_TIPO_IDS.itemsize + _TIPO_POSICIONES.itemsize))
+    return ids_usuario, posiciones, puntuaciones
+
+
+class ClasificacionEnJornada:
+    """
+    Clasificacion de una liga tal y como quedo al aplicar una jornada
+    """
+
+    def __init__(self, id_liga: int, jornada: str, participantes: int, datos: bytes):
+        self.id_liga = id_liga
+        self.jornada = jornada
+        self.ids_usuario, self.posiciones, self.puntuaciones = decodificar_clasificacion(datos, participantes)
+
+    def __len__(self):
+        return int(self.ids_usuario.size)
+
+    def pagina(self, inicio: int, cantidad: int) -> List[tuple]:
+        """
+        Participantes [inicio, inicio + cantidad) como tuplas (posicion, id_usuario, puntuacion)
+        """
+        fin = inicio + cantidad
+        return list(zip(self.posiciones[inicio:fin].tolist(), self.ids_usuario[inicio:fin].tolist(),
+                        self.puntuaciones[inicio:fin].tolist()))
+
+    def primeros(self, posicion: int) -> List[tuple]:
+        """
+        Participantes hasta la posicion indicada (con los empatados en ella), como en pagina()
+        """
+        return self.pagina(0, int(np.searchsorted(self.posiciones, posicion, side="right")))
+
+    def posicion_de(self, id_usuario: int) -> Optional[int]:
+        encontrados = np.flatnonzero(self.ids_usuario == id_usuario)
+        return int(self.posiciones[encontrados[0]]) if encontrados.size else None
+
+
+def guardar_clasificaciones(jornada: str, desde_liga: Optional[int] = None,
+                            hasta_liga: Optional[int] = None) -> int:
+    """
+    Guarda la foto de la clasificacion materializada (ver app/clasificacion.py) de las ligas con
+    id en [desde_liga, hasta_liga), o de todas, como la de la jornada. Si la jornada ya tenia foto
+    (p. ej. al recomputarla) se sustituye. Devuelve el numero de fotos guardadas. No hace commit.
+    """
+    rango = select(func.min(ClasificacionLiga.id_liga), func.max(ClasificacionLiga.id_liga))
+    if desde_liga is not None:
+        rango = rango.where(ClasificacionLiga.id_liga >= desde_liga, ClasificacionLiga.id_liga < hasta_liga)
+    minimo, maximo = db.session.execute(rango).one()
+    if minimo is None:
+        return 0
+
+    ahora = datetime.datetime.now()
+    stmt = insert_con_conflicto(ClasificacionHistorica)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ClasificacionHistorica.id_liga, ClasificacionHistorica.jornada],
+        set_={"participantes": stmt.excluded.participantes, "datos": stmt.excluded.datos,
+              "registrada_en": stmt.excluded.registrada_en}
+    )
+    guardadas = 0
+    for desde in range(minimo, maximo + 1, LIGAS_POR_LOTE):
+        # Sin pasarse de maximo: las ligas siguientes pueden ser de otro bloque (o de otro proceso)
+        hasta = min(desde + LIGAS_POR_LOTE, maximo + 1)
+        filas = db.session.execute(
+            select(ClasificacionLiga.id_liga, ClasificacionLiga.id_usuario, ClasificacionLiga.posicion,
+                   ClasificacionLiga.puntuacion)
+            .where(ClasificacionLiga.id_liga >= desde, ClasificacionLiga.id_liga < hasta)
+            .order_by(ClasificacionLiga.id_liga, ClasificacionLiga.posicion, ClasificacionLiga.id_usuario)
+        ).all()
+        if not filas:
+            continue
+        ligas = np.fromiter((fila[0] for fila in filas), dtype=np.int64, count=len(filas))
+        usuarios = np.fromiter((fila[1] for fila in filas), dtype=_TIPO_IDS, count=len(filas))
+        posiciones = np.fromiter((fila[2] for fila in filas), dtype=_TIPO_POSICIONES, count=len(filas))
+        puntuaciones = np.fromiter((fila[3] for fila in filas), dtype=_TIPO_PUNTUACIONES, count=len(filas))
+        inicios = np.flatnonzero(np.r_[True, ligas[1:] != ligas[:-1]])
+        fines = np.r_[inicios[1:], ligas.size]
+        db.session.execute(stmt, [
+            {"id_liga": int(ligas[inicio]), "jornada": jornada, "participantes": int(fin - inicio),
+             "datos": codificar_clasificacion(usuarios[inicio:fin], posiciones[inicio:fin],
+                                              puntuaciones[inicio:fin]),
+             "registrada_en": ahora}
+            for inicio, fin in zip(inicios, fines)
+        ])
+        guardadas += inicios.size
+    return guardadas
+
+
+def clasificacion_en(id_liga: int, jornada: Optional[str] = None) -> Optional[ClasificacionEnJornada]:
+    """
+    Clasificacion de la liga en la jornada indicada: la de la ultima foto hasta esa jornada
+    (por defecto, la ultima que haya). None si la liga no tiene ninguna foto hasta entonces.
+    """
+    consulta = (
+        select(ClasificacionHistorica.jornada, ClasificacionHistorica.participantes, ClasificacionHistorica.datos)
+        .where(ClasificacionHistorica.id_liga == id_liga)
+        .order_by(ClasificacionHistorica.jornada.desc())
+        .limit(1)
+    )
+    if jornada is not None:
+        consulta = consulta.where(ClasificacionHistorica.jornada <= jornada)
+    foto = db.session.execute(consulta).first()
+    if foto is None:
+        return None
+    return ClasificacionEnJornada(id_liga, foto.jornada, foto.participantes, foto.datos)
+
+
+def pagina_clasificacion_en(clasificacion: ClasificacionEnJornada, despues: Optional[str],
+                            antes: Optional[str], por_pagina: int) -> PaginaKeyset:
+    """
+    Pagina de una clasificacion historica, con el email de cada usuario. Como la foto entera ya
+    esta en memoria, los cursores son el indice del primer participante de la pagina siguiente
+    (despues) o del primero de la pagina actual (antes).
+    """
+    despues = decodificar_cursor(despues, int)
+    antes = decodificar_cursor(antes, int)
+    if despues is not None:
+        inicio = despues[0]
+    elif antes is not None:
+        inicio = antes[0] - por_pagina
+    else:
+        inicio = 0
+    inicio = min(max(inicio, 0), max(len(clasificacion) - 1, 0))
+    filas = clasificacion.pagina(inicio, por_pagina)
+
+    emails = dict(db.session.execute(
+        select(Usuario.id, Usuario.email).where(Usuario.id.in_([id_usuario for _, id_usuario, _ in filas]))
+    ).all()) if filas else {}
+    items = [
+        {"posicion": posicion, "id_usuario": id_usuario, "id_liga": clasificacion.id_liga,
+         "email": emails.get(id_usuario), "puntuacion": round(puntuacion, 2)}
+        for posicion, id_usuario, puntuacion in filas
+    ]
+    fin = inicio + len(filas)
+    return PaginaKeyset(items,
+                        str(fin) if fin < len(clasificacion) else None,
+                        str(inicio) if inicio > 0 else None)
+
+
+def jornadas_con_clasificacion(id_liga: int, limite: int = 30) -> List[str]:
+    """
+    Ultimas jornadas de las que hay foto de la clasificacion de la liga, de la mas reciente a la mas antigua
+    """
+    return list(db.session.scalars(
+        select(ClasificacionHistorica.jornada)
+        .where(ClasificacionHistorica.id_liga == id_liga)
+        .order_by(ClasificacionHistorica.jornada.desc())
+        .limit(limite)
+    ))
+
+
+def evolucion_puntuacion(id_usuario: int, id_liga: int) -> list:
+    """
+    Movimientos de la puntuacion del usuario en la liga, del mas antiguo al mas reciente, como
+    filas (jornada, diferencia, puntuacion, registrado_en)
+    """
+    return db.session.execute(
+        select(MovimientoPuntuacion.jornada, MovimientoPuntuacion.diferencia,
+               MovimientoPuntuacion.puntuacion, MovimientoPuntuacion.registrado_en)
+        .where(MovimientoPuntuacion.id_usuario == id_usuario, MovimientoPuntuacion.id_liga == id_liga)
+        .order_by(MovimientoPuntuacion.id)
+    ).all()
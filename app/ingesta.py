@@ -0,0 +1,243 @@
+"""
+Ingesta masiva de partidos y estadisticas de jugadores (historico) desde ficheros.
+
+Los ficheros pueden ser CSV (con cabecera) o JSON lines (un objeto por linea, extension .jsonl/.json).
+Se leen en streaming y se procesan por bloques: cada bloque se valida (tipos, claves ajenas contra
+los ids de Jugador y Partido precargados) y se escribe con un unico upsert, de modo que volver a
+ingestar un fichero corregido sobreescribe las filas en lugar de fallar.
+
+Columnas de partidos:   id_partido, fecha (YYYY-MM-DD), equipo_local, equipo_visitante, gana_local, url
+Columnas de historicos: id_partido, id_jugador, tiempo_jugador, puntos_marcados, puntuacion
+"""
+import csv
+import datetime
+import json
+import math
+import time
+from itertools import islice
+from typing import Iterator, Optional, Tuple
+from sqlalchemy import select
+from . import db
+from .modelos import Jugador, Partido, Historico
+from .utilidades_bd import insert_con_conflicto
+from .estadisticas_jugador import actualizar_estadisticas, jugadores_de_partidos
+
+TAM_BLOQUE = 1000
+
+
+class FilaInvalida(ValueError):
+    """
+    Una fila del fichero que no se puede ingestar
+    """
+
+
+def leer_filas(ruta: str) -> Iterator[Tuple[int, object]]:
+    """
+    Recorre un fichero CSV o JSON lines devolviendo tuplas (numero_linea, fila). Si una linea
+    JSON esta mal formada o no es un objeto, se devuelve la excepcion en lugar de la fila.
+    """
+    with open(ruta, encoding="utf-8", newline="") as fichero:
+        if ruta.endswith((".jsonl", ".json")):
+            for num_linea, linea in enumerate(fichero, start=1):
+                if not linea.strip():
+                    continue
+                try:
+                    fila = json.loads(linea)
+                except json.JSONDecodeError as e:
+                    yield num_linea, FilaInvalida(f"JSON mal formado: {e.msg}")
+                    continue
+                if not isinstance(fila, dict):
+                    yield num_linea, FilaInvalida("la linea no es un objeto JSON")
+                    continue
+                yield num_linea, fila
+        else:
+            # La linea 1 es la cabecera
+            for num_linea, fila in enumerate(csv.DictReader(fichero), start=2):
+                yield num_linea, fila
+
+
+def _entero(fila: dict, campo: str, opcional: bool = False):
+    valor = fila.get(campo)
+    if valor is None or valor == "":
+        if opcional:
+            return None
+        raise FilaInvalida(f"falta el campo '{campo}'")
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise FilaInvalida(f"'{campo}' no es un entero: {valor!r}")
+
+
+def _texto(fila: dict, campo: str, longitud: int = None) -> str:
+    valor = fila.get(campo)
+    if valor is None or str(valor).strip() == "":
+        raise FilaInvalida(f"falta el campo '{campo}'")
+    valor = str(valor).strip()
+    if longitud is not None and len(valor) > longitud:
+        raise FilaInvalida(f"'{campo}' tiene mas de {longitud} caracteres")
+    return valor
+
+
+def _validar_partido(fila: dict) -> dict:
+    try:
+        fecha = datetime.date.fromisoformat(_texto(fila, "fecha"))
+    except ValueError:
+        raise FilaInvalida(f"'fecha' no tiene el formato YYYY-MM-DD: {fila.get('fecha')!r}")
+    gana_local = fila.get("gana_local")
+    if isinstance(gana_local, str):
+        gana_local = gana_local.strip().lower()
+        if gana_local not in ("s", "n", "true", "false", "1", "0"):
+            raise FilaInvalida(f"'gana_local' no es un booleano: {fila.get('gana_local')!r}")
+        gana_local = gana_local in ("s", "true", "1")
+    elif not isinstance(gana_local, bool):
+        raise FilaInvalida("falta el campo 'gana_local'")
+    return {
+        "id_partido": _entero(fila, "id_partido"),
+        "fecha": fecha,
+        "equipo_local": _texto(fila, "equipo_local", 30),
+        "equipo_visitante": _texto(fila, "equipo_visitante", 30),
+        "gana_local": gana_local,
+        "url": _texto(fila, "url"),
+    }
+
+
+def _validar_historico(fila: dict, ids_jugador: set, ids_partido: set) -> dict:
+    id_jugador = _entero(fila, "id_jugador")
+    id_partido = _entero(fila, "id_partido")
+    if id_jugador not in ids_jugador:
+        raise FilaInvalida(f"no existe el jugador {id_jugador}")
+    if id_partido not in ids_partido:
+        raise FilaInvalida(f"no existe el partido {id_partido}")
+    try:
+        puntuacion = float(fila.get("puntuacion"))
+    except (TypeError, ValueError):
+        raise FilaInvalida(f"'puntuacion' no es un numero: {fila.get('puntuacion')!r}")
+    # La columna es Numeric(4, 2). NaN e infinito pasarian la comparacion y estropearian las medias
+    if not math.isfinite(puntuacion) or abs(puntuacion) >= 100:
+        raise FilaInvalida(f"'puntuacion' fuera de rango: {puntuacion}")
+    return {
+        "id_jugador": id_jugador,
+        "id_partido": id_partido,
+        "tiempo_jugador": _entero(fila, "tiempo_jugador"),
+        "puntos_marcados": _entero(fila, "puntos_marcados", opcional=True),
+        "puntuacion": puntuacion,
+        # Se marca tambien al corregir una fila, para que se vuelva a puntuar
+        "registrado_en": datetime.datetime.now(),
+    }
+
+
+def _upsert(modelo, claves: list, filas: list) -> None:
+    """
+    Inserta las filas en bloque; si ya existian (misma clave primaria) se actualizan
+    """
+    if not filas:
+        return
+    stmt = insert_con_conflicto(modelo)
+    columnas = [c for c in filas[0] if c not in claves]
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=claves,
+            set_={c: stmt.excluded[c] for c in columnas}
+        ),
+        filas
+    )
+
+
+def _ingestar(ruta: str, validar, modelo, claves: list, tam_bloque: int, resumen: dict,
+              aceptar=None, confirmar: bool = True) -> set:
+    """
+    Ingesta el fichero por bloques (solo las lineas para las que aceptar(fila) es cierto, si se
+    indica; con "confirmar", haciendo commit de cada bloque) y devuelve las claves de las filas escritas
+    """
+    escritas = set()
+    filas = leer_filas(ruta)
+    if aceptar is not None:
+        filas = ((num_linea, fila) for num_linea, fila in filas if aceptar(fila))
+    while True:
+        bloque = list(islice(filas, tam_bloque))
+        if not bloque:
+            break
+        validas = {}
+        for num_linea, fila in bloque:
+            try:
+                if isinstance(fila, FilaInvalida):
+                    raise fila
+                valida = validar(fila)
+            except FilaInvalida as e:
+                resumen["rechazadas"].append((ruta, num_linea, str(e)))
+                continue
+            # Si la misma clave se repite en el fichero, gana la ultima linea
+            validas[tuple(valida[c] for c in claves)] = valida
+        _upsert(modelo, claves, list(validas.values()))
+        if confirmar:
+            db.session.commit()
+        resumen["filas"] += len(validas)
+        escritas.update(validas)
+    return escritas
+
+
+def ingestar_ficheros(ruta_partidos: str = None, ruta_historicos: str = None,
+                      tam_bloque: int = TAM_BLOQUE, estadisticas: bool = True) -> dict:
+    """
+    Ingesta un fichero de partidos y/o uno de historicos (primero los partidos, para que los
+    historicos puedan referenciarlos), y actualiza las estadisticas de los jugadores afectados.
+    Devuelve un resumen con las filas escritas, las lineas rechazadas (fichero, linea, motivo), los
+    jugadores con estadisticas actualizadas, los segundos empleados y las filas por segundo.
+    Sin "estadisticas", no se actualizan y el resumen trae los "jugadores_afectados" (p. ej. para
+    repartirlos entre varios procesos con el trabajo "estadisticas-jugadores" de app/trabajos.py).
+    """
+    inicio = time.perf_counter()
+    resumen = {"filas": 0, "rechazadas": []}
+    jugadores_afectados = set()
+
+    if ruta_partidos:
+        partidos = _ingestar(ruta_partidos, _validar_partido, Partido, ["id_partido"], tam_bloque, resumen)
+        # Un partido corregido (p. ej. el ganador) cambia las estadisticas de quienes lo jugaron
+        jugadores_afectados.update(jugadores_de_partidos(id_partido for id_partido, in partidos))
+
+    if ruta_historicos:
+        # Precargamos los ids validos para comprobar las claves ajenas sin consultar fila a fila
+        ids_jugador = set(db.session.scalars(select(Jugador.id_jugador)))
+        ids_partido = set(db.session.scalars(select(Partido.id_partido)))
+        historicos = _ingestar(ruta_historicos, lambda fila: _validar_historico(fila, ids_jugador, ids_partido),
+                               Historico, ["id_jugador", "id_partido"], tam_bloque, resumen)
+        jugadores_afectados.update(id_jugador for id_jugador, _ in historicos)
+
+    if estadisticas:
+        resumen["jugadores_actualizados"] = actualizar_estadisticas(jugadores_afectados)
+    else:
+        resumen["jugadores_afectados"] = jugadores_afectados
+
+    resumen["segundos"] = time.perf_counter() - inicio
+    resumen["filas_por_segundo"] = resumen["filas"] / resumen["segundos"] if resumen["segundos"] else 0.0
+    return resumen
+
+
+def ingestar_historicos_rango(ruta: str, desde_jugador: int, hasta_jugador: int, tam_bloque: int = TAM_BLOQUE,
+                              limites: Optional[Tuple[int, int]] = None) -> dict:
+    """
+    Ingesta las lineas del fichero de historicos cuyo id_jugador esta en [desde_jugador, hasta_jugador)
+    y, si se indican los "limites" [minimo, maximo] de los ids de todos los fragmentos, tambien las
+    que quedan fuera de ellos o no tienen un id_jugador entero (que se rechazan). Es el fragmento del
+    trabajo "ingestar" de app/trabajos.py: no hace commit ni actualiza las estadisticas. Devuelve un
+    resumen con las filas escritas, las lineas rechazadas y los jugadores afectados.
+    """
+    resumen = {"filas": 0, "rechazadas": []}
+
+    def aceptar(fila) -> bool:
+        try:
+            id_jugador = int(fila.get("id_jugador"))
+        except (AttributeError, TypeError, ValueError):
+            return limites is not None
+        if desde_jugador <= id_jugador < hasta_jugador:
+            return True
+        return limites is not None and not limites[0] <= id_jugador <= limites[1]
+
+    ids_jugador = set(db.session.scalars(
+        select(Jugador.id_jugador).where(Jugador.id_jugador >= desde_jugador, Jugador.id_jugador < hasta_jugador)
+    ))
+    ids_partido = set(db.session.scalars(select(Partido.id_partido)))
+    historicos = _ingestar(ruta, lambda fila: _validar_historico(fila, ids_jugador, ids_partido),
+                           Historico, ["id_jugador", "id_partido"], tam_bloque, resumen, aceptar, confirmar=False)
+    resumen["jugadores_afectados"] = {id_jugador for id_jugador, _ in historicos}
+    return resumen
@@ -0,0 +1,178 @@
+"""
+Instrumentacion de las peticiones: numero de consultas, tiempo en base de datos, tiempo de
+renderizado de templates y tiempo total de cada vista.
+
+    * Con DEBUG activado, cada respuesta lleva estas medidas en las cabeceras X-Consultas,
+      X-Tiempo-BD-ms, X-Tiempo-Render-ms y X-Tiempo-Total-ms.
+    * Las medidas se acumulan por endpoint en histogramas, que se sirven en formato texto
+      (compatible con Prometheus) en /metrics.
+    * Si una peticion hace mas consultas que PRESUPUESTO_CONSULTAS, se escribe un aviso en el log
+      (y la cabecera X-Presupuesto-Excedido en DEBUG), para detectar problemas N+1 en cuanto aparecen.
+"""
+import threading
+import time
+from bisect import bisect_left
+from flask import Flask, Response, current_app, g, request, has_request_context
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+# Limites superiores (en segundos) de los cubos de los histogramas de tiempo
+CUBOS_TIEMPO = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+# Limites superiores de los cubos del histograma de consultas por peticion
+CUBOS_CONSULTAS = [1, 2, 3, 5, 8, 13, 21, 34, 55]
+
+
+class Histograma:
+    """
+    Histograma acumulado de observaciones con cubos fijos
+    """
+
+    def __init__(self, cubos):
+        self.cubos = cubos
+        self.cuentas = [0] * (len(cubos) + 1)   # El ultimo cubo es +Inf
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor) -> None:
+        self.cuentas[bisect_left(self.cubos, valor)] += 1
+        self.suma += valor
+        self.total += 1
+
+    def lineas(self, nombre: str, etiquetas: str):
+        acumulado = 0
+        for limite, cuenta in zip(self.cubos + ["+Inf"], self.cuentas):
+            acumulado += cuenta
+            yield f'{nombre}_bucket{{{etiquetas},le="{limite}"}} {acumulado}'
+        yield f"{nombre}_sum{{{etiquetas}}} {self.suma}"
+        yield f"{nombre}_count{{{etiquetas}}} {self.total}"
+
+
+class MetricasEndpoint:
+    def __init__(self):
+        self.tiempo_total = Histograma(CUBOS_TIEMPO)
+        self.tiempo_bd = Histograma(CUBOS_TIEMPO)
+        self.tiempo_render = Histograma(CUBOS_TIEMPO)
+        self.consultas = Histograma(CUBOS_CONSULTAS)
+        self.presupuesto_excedido = 0
+
+
+class Instrumentacion:
+    """
+    Extension de Flask que mide cada peticion. Se registra en create_app con init_app(app).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        # Otras fuentes de metricas (nombre -> funcion que devuelve un diccionario de contadores)
+        self.fuentes = {}
+
+    def init_app(self, app: Flask) -> None:
+        # Se miden las consultas de todos los motores (la primaria y las replicas)
+        with app.app_context():
+            engines = app.extensions["sqlalchemy"].engines.values()
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", _antes_consulta)
+            event.listen(engine, "after_cursor_execute", _despues_consulta)
+        before_render_template.connect(_antes_render, app)
+        template_rendered.connect(_despues_render, app)
+        app.before_request(_inicio_peticion)
+        app.after_request(self._fin_peticion)
+        app.add_url_rule("/metrics", "metricas", self.vista_metricas)
+
+    def registrar_fuente(self, nombre: str, funcion) -> None:
+        """
+        Añade a /metrics los contadores que devuelva "funcion" (p. ej. los del pool de cartas)
+        """
+        self.fuentes[nombre] = funcion
+
+    def _fin_peticion(self, respuesta):
+        if "instr_inicio" not in g or request.endpoint in (None, "static", "metricas"):
+            return respuesta
+        total = time.perf_counter() - g.instr_inicio
+        presupuesto = current_app.config.get("PRESUPUESTO_CONSULTAS")
+        excedido = presupuesto is not None and g.instr_consultas > presupuesto
+
+        with self._lock:
+            metricas = self.endpoints.setdefault(request.endpoint, MetricasEndpoint())
+            metricas.tiempo_total.observar(total)
+            metricas.tiempo_bd.observar(g.instr_tiempo_bd)
+            metricas.tiempo_render.observar(g.instr_tiempo_render)
+            metricas.consultas.observar(g.instr_consultas)
+            if excedido:
+                metricas.presupuesto_excedido += 1
+
+        if excedido:
+            current_app.logger.warning(
+                "La vista %s ha hecho %d consultas (presupuesto: %d)",
+                request.endpoint, g.instr_consultas, presupuesto
+            )
+        if current_app.debug:
+            respuesta.headers["X-Consultas"] = str(g.instr_consultas)
+            respuesta.headers["X-Tiempo-BD-ms"] = f"{g.instr_tiempo_bd * 1000:.2f}"
+            respuesta.headers["X-Tiempo-Render-ms"] = f"{g.instr_tiempo_render * 1000:.2f}"
+            respuesta.headers["X-Tiempo-Total-ms"] = f"{total * 1000:.2f}"
+            if excedido:
+                respuesta.headers["X-Presupuesto-Excedido"] = "1"
+        return respuesta
+
+    def texto_metricas(self) -> str:
+        lineas = []
+        with self._lock:
+            histogramas = [
+                ("nba_peticion_segundos", "Tiempo total de la peticion", lambda m: m.tiempo_total),
+                ("nba_bd_segundos", "Tiempo en base de datos por peticion", lambda m: m.tiempo_bd),
+                ("nba_render_segundos", "Tiempo de renderizado de templates por peticion", lambda m: m.tiempo_render),
+                ("nba_consultas_por_peticion", "Consultas SQL por peticion", lambda m: m.consultas),
+            ]
+            for nombre, ayuda, histograma in histogramas:
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} histogram")
+                for endpoint, metricas in sorted(self.endpoints.items()):
+                    lineas.extend(histograma(metricas).lineas(nombre, f'endpoint="{endpoint}"'))
+
+            lineas.append("# HELP nba_presupuesto_excedido_total Peticiones que superan PRESUPUESTO_CONSULTAS")
+            lineas.append("# TYPE nba_presupuesto_excedido_total counter")
+            for endpoint, metricas in sorted(self.endpoints.items()):
+                lineas.append(f'nba_presupuesto_excedido_total{{endpoint="{endpoint}"}} {metricas.presupuesto_excedido}')
+
+        for fuente, funcion in sorted(self.fuentes.items()):
+            for contador, valor in funcion().items():
+                if isinstance(valor, (int, float)):
+                    lineas.append(f"nba_{fuente}_{contador} {valor}")
+        return "\n".join(lineas) + "\n"
+
+    def vista_metricas(self):
+        return Response(self.texto_metricas(), mimetype="text/plain; version=0.0.4")
+
+
+def _inicio_peticion():
+    g.instr_inicio = time.perf_counter()
+    g.instr_consultas = 0
+    g.instr_tiempo_bd = 0.0
+    g.instr_tiempo_render = 0.0
+
+
+def _antes_consulta(conn, cursor, sentencia, parametros, contexto, executemany):
+    # El inicio va en el contexto de la ejecucion, que se descarta tambien si la consulta falla
+    # (en conn.info se quedaria para siempre en la conexion del pool)
+    if contexto is not None:
+        contexto._instr_inicio = time.perf_counter()
+
+
+def _despues_consulta(conn, cursor, sentencia, parametros, contexto, executemany):
+    inicio = getattr(contexto, "_instr_inicio", None)
+    # Las consultas fuera de una peticion (scripts, arranque) no se miden
+    if inicio is not None and has_request_context() and "instr_inicio" in g:
+        g.instr_consultas += 1
+        g.instr_tiempo_bd += time.perf_counter() - inicio
+
+
+def _antes_render(sender, template, context, **extra):
+    if has_request_context():
+        g.instr_inicio_render = time.perf_counter()
+
+
+def _despues_render(sender, template, context, **extra):
+    if has_request_context() and "instr_inicio_render" in g:
+        g.instr_tiempo_render += time.perf_counter() - g.pop("instr_inicio_render")
@@ -0,0 +1,94 @@
+"""
+Operaciones sobre las ligas y sus participantes
+"""
+from enum import Enum
+from typing import Optional
+from sqlalchemy import select, update, func
+from . import db
+from .modelos import Liga, ParticipaLiga
+from .pool_cartas import pool_cartas
+from .tirada import elegir_rareza, sumar_copias
+from .utilidades_bd import insert_con_conflicto
+
+
+class ResultadoUnion(Enum):
+    """
+    Resultado de intentar unirse a una liga
+    """
+    UNIDO = "unido"
+    LLENA = "llena"
+    YA_PARTICIPA = "ya_participa"
+    PASSWORD_INCORRECTA = "password_incorrecta"
+
+
+def unirse_a_liga(id_usuario: int, liga: Liga, password: str = None) -> ResultadoUnion:
+    """
+    Une al usuario a la liga y le da la carta de bienvenida, todo en una transaccion:
+
+        1. INSERT en participa_liga ON CONFLICT DO NOTHING: si no inserta, ya participaba.
+        2. UPDATE liga SET num_participantes = num_participantes + 1 WHERE num_participantes < maximo:
+           si no actualiza, la liga esta llena. El UPDATE bloquea la fila de la liga hasta el commit,
+           asi que las uniones simultaneas a la misma liga no pueden pasarse del maximo.
+        3. Upsert de la carta de bienvenida.
+
+    Si algun paso falla se deshace la transaccion entera.
+    """
+    if not liga.check_password(password):
+        return ResultadoUnion.PASSWORD_INCORRECTA
+
+    insertada = db.session.scalar(
+        insert_con_conflicto(ParticipaLiga)
+        .values(id_usuario=id_usuario, id_liga=liga.id, puntuacion_acumulada=0)
+        .on_conflict_do_nothing()
+        .returning(ParticipaLiga.id_usuario)
+    )
+    if insertada is None:
+        db.session.rollback()
+        return ResultadoUnion.YA_PARTICIPA
+
+    hay_hueco = db.session.scalar(
+        update(Liga)
+        .where(Liga.id == liga.id, Liga.num_participantes < Liga.numero_participantes_maximo)
+        .values(num_participantes=Liga.num_participantes + 1)
+        .returning(Liga.id)
+        .execution_options(synchronize_session=False)
+    )
+    if hay_hueco is None:
+        db.session.rollback()
+        return ResultadoUnion.LLENA
+
+    # Es la carta de bienvenida
+    sumar_copias(id_usuario, {(liga.id, pool_cartas.elegir(elegir_rareza())): 1})
+    db.session.commit()
+    return ResultadoUnion.UNIDO
+
+
+def corregir_contadores(desde_liga: Optional[int] = None, hasta_liga: Optional[int] = None) -> int:
+    """
+    Corrige en una unica sentencia el contador de participantes de las ligas con id en
+    [desde_liga, hasta_liga) (o de todas) que no coincide con ParticipaLiga. Devuelve el numero
+    de ligas corregidas. No hace commit.
+    """
+    reales = (
+        select(func.count())
+        .select_from(ParticipaLiga)
+        .where(ParticipaLiga.id_liga == Liga.id)
+        .scalar_subquery()
+    )
+    consulta = update(Liga).where(Liga.num_participantes != reales)
+    if desde_liga is not None:
+        consulta = consulta.where(Liga.id >= desde_liga, Liga.id < hasta_liga)
+    resultado = db.session.execute(
+        consulta.values(num_participantes=reales).execution_options(synchronize_session=False)
+    )
+    return resultado.rowcount
+
+
+def reconstruir_contadores() -> int:
+    """
+    Comprueba el contador de participantes de todas las ligas contra ParticipaLiga y corrige
+    los que no coinciden, en una unica sentencia. Devuelve el numero de ligas corregidas.
+    """
+    corregidas = corregir_contadores()
+    db.session.commit()
+    return corregidas
@@ -0,0 +1,345 @@
+"""
+Migraciones versionadas del esquema de la base de datos.
+
+Cada migracion tiene un numero de version, una descripcion y una funcion que la aplica. La tabla
+version_esquema guarda las que ya se han aplicado, y migrar() aplica en orden las pendientes,
+cada una en su propia transaccion. Para cambiar el esquema se añade una migracion al final de
+MIGRACIONES; nunca se modifica una que ya este publicada.
+
+Cada migracion crea solo las tablas, columnas e indices que introduce, definidos aqui (y no sacados
+de los modelos ni de otros modulos) para que no cambie cuando cambien los modelos. La version 1 es
+el esquema inicial de la aplicacion.
+
+Todas las migraciones son idempotentes (IF NOT EXISTS, o comprobando el catalogo), de modo que una
+base de datos creada antes de existir esta tabla se puede migrar desde la version 1.
+"""
+import datetime
+from sqlalchemy import (inspect, select, func, text, case, MetaData, Table, Column, ForeignKey, Index, Integer,
+                        String, Numeric, Date, DateTime, Boolean, Float, LargeBinary)
+from sqlalchemy.schema import CreateIndex, CreateTable
+from . import db
+from .modelos import VersionEsquema
+
+# Cada migracion define en su propio MetaData las tablas e indices que crea, tal y como eran al
+# publicarla. Las tablas anteriores a las que hace referencia (claves ajenas, indices) se declaran
+# solo con las columnas que necesita y no se crean.
+
+# Version 1: las tablas tal y como eran antes de existir las migraciones
+_version_1 = MetaData()
+Table("jugador", _version_1,
+      Column("id_jugador", Integer, primary_key=True, autoincrement=True),
+      Column("nombre", String, nullable=False),
+      Column("nombre_equipo", String, nullable=True),
+      Column("posicion", String(20), nullable=False),
+      Column("altura", Numeric(4, 1), nullable=False),
+      Column("peso", Numeric(4, 1), nullable=True),
+      Column("fecha_nacimiento", Date, nullable=False),
+      Column("pais", String(30), nullable=False),
+      Column("url_imagen", String, nullable=False))
+Table("partido", _version_1,
+      Column("id_partido", Integer, primary_key=True),
+      Column("fecha", Date, nullable=False),
+      Column("equipo_local", String(30), nullable=False),
+      Column("equipo_visitante", String(30), nullable=False),
+      Column("gana_local", Boolean, nullable=False),
+      Column("url", String, nullable=False))
+Table("historico", _version_1,
+      Column("id_jugador", Integer, ForeignKey("jugador.id_jugador"), primary_key=True),
+      Column("id_partido", Integer, ForeignKey("partido.id_partido"), primary_key=True),
+      Column("tiempo_jugador", Integer, nullable=False),
+      Column("puntos_marcados", Integer, nullable=True),
+      Column("puntuacion", Numeric(4, 2), nullable=False))
+Table("usuario", _version_1,
+      Column("id", Integer, primary_key=True, autoincrement=True),
+      Column("email", String(30), nullable=False, unique=True),
+      Column("cumple", Date, nullable=False),
+      Column("password_hash", String(256), nullable=False),
+      Column("ultima_tirada", Date, nullable=True))
+Table("carta", _version_1,
+      Column("id_jugador", Integer, ForeignKey("jugador.id_jugador"), primary_key=True),
+      Column("puntuacion", Numeric(4, 1), nullable=False),
+      Column("rareza", String(15), nullable=False))
+Table("liga", _version_1,
+      Column("id", Integer, primary_key=True, autoincrement=True),
+      Column("nombre", String(30), nullable=False),
+      Column("numero_participantes_maximo", Integer, nullable=False),
+      Column("password_hash", String, nullable=True))
+Table("participa_liga", _version_1,
+      Column("id_usuario", Integer, ForeignKey("usuario.id"), primary_key=True),
+      Column("id_liga", Integer, ForeignKey("liga.id"), primary_key=True),
+      Column("puntuacion_acumulada", Numeric, nullable=False))
+Table("carta_liga", _version_1,
+      Column("id_liga", Integer, ForeignKey("liga.id"), primary_key=True),
+      Column("id_usuario", Integer, ForeignKey("usuario.id"), primary_key=True),
+      Column("id_jugador", Integer, ForeignKey("jugador.id_jugador"), primary_key=True),
+      Column("numero_copias", Integer, nullable=False))
+
+
+def _referencias(metadata: MetaData, *tablas: str) -> None:
+    # Tablas ya existentes a las que apuntan las claves ajenas de una migracion (solo su clave primaria)
+    claves = {"jugador": "id_jugador", "partido": "id_partido", "usuario": "id", "liga": "id"}
+    for tabla in tablas:
+        Table(tabla, metadata, Column(claves[tabla], Integer, primary_key=True))
+
+
+# Version 2: tablas que se añadieron antes de existir las migraciones (sus indices van en la version 4)
+_version_2 = MetaData()
+_referencias(_version_2, "jugador", "usuario", "liga")
+Table("version_datos", _version_2,
+      Column("clave", String(30), primary_key=True),
+      Column("version", Integer, nullable=False),
+      Column("actualizada_en", DateTime, nullable=False))
+Table("marca_proceso", _version_2,
+      Column("clave", String(30), primary_key=True),
+      Column("marca", DateTime, nullable=True))
+Table("puntos_jornada", _version_2,
+      Column("id_usuario", Integer, ForeignKey("usuario.id"), primary_key=True),
+      Column("id_liga", Integer, ForeignKey("liga.id"), primary_key=True),
+      Column("jornada", String(20), primary_key=True),
+      Column("puntos", Numeric, nullable=False))
+Table("jornada_aplicada", _version_2,
+      Column("jornada", String(20), primary_key=True),
+      Column("aplicada_en", DateTime, nullable=False),
+      Column("marca_cartas", DateTime, nullable=True))
+Table("clasificacion_liga", _version_2,
+      Column("id_liga", Integer, ForeignKey("liga.id"), primary_key=True),
+      Column("id_usuario", Integer, ForeignKey("usuario.id"), primary_key=True),
+      Column("posicion", Integer, nullable=False),
+      Column("puntuacion", Numeric, nullable=False),
+      Column("email", String(30), nullable=False))
+Table("estadisticas_jugador", _version_2,
+      Column("id_jugador", Integer, ForeignKey("jugador.id_jugador"), primary_key=True),
+      Column("partidos", Integer, nullable=False),
+      Column("minutos", Integer, nullable=False),
+      Column("puntos", Integer, nullable=False),
+      Column("puntuacion_media", Numeric(4, 2), nullable=True),
+      Column("puntuacion_mediana", Numeric(4, 2), nullable=True),
+      Column("victorias", Integer, nullable=False),
+      Column("derrotas", Integer, nullable=False),
+      Column("forma", Numeric(4, 2), nullable=True),
+      Column("actualizada_en", DateTime, nullable=False))
+
+# Version 3: indices de la busqueda de jugadores
+_version_3 = MetaData()
+_jugador_3 = Table("jugador", _version_3,
+                   Column("id_jugador", Integer, primary_key=True),
+                   Column("nombre", String),
+                   Column("nombre_equipo", String),
+                   Column("posicion", String(20)),
+                   Column("pais", String(30)))
+_carta_3 = Table("carta", _version_3,
+                 Column("id_jugador", Integer, primary_key=True),
+                 Column("puntuacion", Numeric(4, 1)),
+                 Column("rareza", String(15)))
+Index("ix_jugador_nombre_trgm", _jugador_3.c.nombre, postgresql_using="gin",
+      postgresql_ops={"nombre": "gin_trgm_ops"})
+Index("ix_jugador_nombre_id", _jugador_3.c.nombre, _jugador_3.c.id_jugador)
+Index("ix_jugador_nombre_equipo", _jugador_3.c.nombre_equipo)
+Index("ix_jugador_posicion", _jugador_3.c.posicion)
+Index("ix_jugador_pais", _jugador_3.c.pais)
+Index("ix_carta_puntuacion", _carta_3.c.puntuacion, _carta_3.c.id_jugador)
+Index("ix_carta_rango_rareza",
+      case({"comun": 0, "infrecuente": 1, "rara": 2, "mitica": 3}, value=_carta_3.c.rareza, else_=0),
+      _carta_3.c.puntuacion, _carta_3.c.id_jugador)
+
+# Version 4: indices de las consultas principales
+_version_4 = MetaData()
+_carta_4 = Table("carta", _version_4,
+                 Column("id_jugador", Integer, primary_key=True),
+                 Column("rareza", String(15)),
+                 Column("actualizada_en", DateTime))
+_partido_4 = Table("partido", _version_4,
+                   Column("id_partido", Integer, primary_key=True),
+                   Column("fecha", Date))
+_historico_4 = Table("historico", _version_4,
+                     Column("id_jugador", Integer, primary_key=True),
+                     Column("id_partido", Integer, primary_key=True),
+                     Column("registrado_en", DateTime))
+_participa_liga_4 = Table("participa_liga", _version_4,
+                          Column("id_usuario", Integer, primary_key=True),
+                          Column("id_liga", Integer, primary_key=True),
+                          Column("puntuacion_acumulada", Numeric))
+_carta_liga_4 = Table("carta_liga", _version_4,
+                      Column("id_liga", Integer, primary_key=True),
+                      Column("id_usuario", Integer, primary_key=True),
+                      Column("id_jugador", Integer, primary_key=True))
+_clasificacion_liga_4 = Table("clasificacion_liga", _version_4,
+                              Column("id_liga", Integer, primary_key=True),
+                              Column("id_usuario", Integer, primary_key=True),
+                              Column("posicion", Integer))
+_puntos_jornada_4 = Table("puntos_jornada", _version_4,
+                          Column("id_usuario", Integer, primary_key=True),
+                          Column("id_liga", Integer, primary_key=True),
+                          Column("jornada", String(20), primary_key=True))
+Index("ix_carta_rareza", _carta_4.c.rareza, _carta_4.c.id_jugador)
+Index("ix_carta_actualizada_en", _carta_4.c.actualizada_en)
+Index("ix_partido_fecha", _partido_4.c.fecha, _partido_4.c.id_partido)
+Index("ix_historico_partido", _historico_4.c.id_partido, _historico_4.c.id_jugador)
+Index("ix_historico_registrado_en", _historico_4.c.registrado_en)
+Index("ix_participa_liga_clasificacion", _participa_liga_4.c.id_liga, _participa_liga_4.c.puntuacion_acumulada,
+      _participa_liga_4.c.id_usuario)
+Index("ix_carta_liga_usuario", _carta_liga_4.c.id_usuario, _carta_liga_4.c.id_liga, _carta_liga_4.c.id_jugador)
+Index("ix_clasificacion_liga_posicion", _clasificacion_liga_4.c.id_liga, _clasificacion_liga_4.c.posicion)
+Index("ix_puntos_jornada_jornada_liga", _puntos_jornada_4.c.jornada, _puntos_jornada_4.c.id_liga)
+
+# Version 5: tiradas preparadas
+_version_5 = MetaData()
+_referencias(_version_5, "jugador", "usuario", "liga")
+Table("tirada_preparada", _version_5,
+      Column("fecha", Date, primary_key=True),
+      Column("id_usuario", Integer, ForeignKey("usuario.id"), primary_key=True),
+      Column("id_liga", Integer, ForeignKey("liga.id"), primary_key=True),
+      Column("posicion", Integer, primary_key=True, autoincrement=False),
+      Column("id_jugador", Integer, ForeignKey("jugador.id_jugador"), nullable=False))
+
+# Version 6: tiradas obtenidas
+_version_6 = MetaData()
+_referencias(_version_6, "jugador", "usuario", "liga")
+Table("tirada_obtenida", _version_6,
+      Column("fecha", Date, primary_key=True),
+      Column("id_usuario", Integer, ForeignKey("usuario.id"), primary_key=True),
+      Column("id_liga", Integer, ForeignKey("liga.id"), primary_key=True),
+      Column("posicion", Integer, primary_key=True, autoincrement=False),
+      Column("id_jugador", Integer, ForeignKey("jugador.id_jugador"), nullable=False))
+
+# Version 7: puntos de control de los trabajos
+_version_7 = MetaData()
+Table("fragmento_trabajo", _version_7,
+      Column("trabajo", String(100), primary_key=True),
+      Column("desde", Integer, primary_key=True, autoincrement=False),
+      Column("hasta", Integer, nullable=False),
+      Column("estado", String(10), nullable=False),
+      Column("filas", Integer, nullable=True),
+      Column("segundos", Float, nullable=True),
+      Column("error", String, nullable=True),
+      Column("terminado_en", DateTime, nullable=True))
+
+# Version 8: libro de movimientos de puntuacion y clasificaciones historicas
+_version_8 = MetaData()
+_referencias(_version_8, "usuario", "liga")
+_movimiento_puntuacion_8 = Table("movimiento_puntuacion", _version_8,
+                                 Column("id", Integer, primary_key=True),
+                                 Column("id_usuario", Integer, ForeignKey("usuario.id"), nullable=False),
+                                 Column("id_liga", Integer, ForeignKey("liga.id"), nullable=False),
+                                 Column("jornada", String(20), nullable=False),
+                                 Column("diferencia", Numeric, nullable=False),
+                                 Column("puntuacion", Numeric, nullable=False),
+                                 Column("registrado_en", DateTime, nullable=False))
+Table("clasificacion_historica", _version_8,
+      Column("id_liga", Integer, ForeignKey("liga.id"), primary_key=True),
+      Column("jornada", String(20), primary_key=True),
+      Column("participantes", Integer, nullable=False),
+      Column("datos", LargeBinary, nullable=False),
+      Column("registrada_en", DateTime, nullable=False))
+Index("ix_movimiento_puntuacion_serie", _movimiento_puntuacion_8.c.id_usuario, _movimiento_puntuacion_8.c.id_liga,
+      _movimiento_puntuacion_8.c.id)
+
+
+def _crear_tablas(metadata: MetaData, *nombres: str) -> None:
+    # Solo las tablas: sus indices se crean, por su nombre, con _crear_indices
+    for nombre in nombres:
+        db.session.execute(CreateTable(metadata.tables[nombre], if_not_exists=True))
+
+
+def _crear_indices(metadata: MetaData, *nombres: str) -> None:
+    indices = {indice.name: indice for tabla in metadata.tables.values() for indice in tabla.indexes}
+    for nombre in nombres:
+        db.session.execute(CreateIndex(indices[nombre], if_not_exists=True))
+
+
+def _añadir_columna(tabla: str, columna: str, definicion: str) -> None:
+    columnas = {c["name"] for c in inspect(db.session.connection()).get_columns(tabla)}
+    if columna not in columnas:
+        db.session.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}"))
+
+
+def _esquema_inicial() -> None:
+    _crear_tablas(_version_1, *(tabla.name for tabla in _version_1.sorted_tables))
+
+
+def _columnas_recomputo() -> None:
+    _crear_tablas(_version_2, "version_datos", "marca_proceso", "puntos_jornada", "jornada_aplicada",
+                  "clasificacion_liga", "estadisticas_jugador")
+    _añadir_columna("carta", "actualizada_en", "TIMESTAMP")
+    _añadir_columna("historico", "registrado_en", "TIMESTAMP")
+    _añadir_columna("liga", "num_participantes", "INTEGER NOT NULL DEFAULT 0")
+    # Rellenamos los contadores de participantes de las ligas que ya existian (sin commit: la
+    # transaccion es de migrar())
+    db.session.execute(text(
+        "UPDATE liga SET num_participantes = "
+        "(SELECT COUNT(*) FROM participa_liga WHERE participa_liga.id_liga = liga.id)"
+    ))
+
+
+def _indices_busqueda_jugadores() -> None:
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    _crear_indices(_version_3, "ix_jugador_nombre_trgm", "ix_jugador_nombre_id", "ix_jugador_nombre_equipo",
+                   "ix_jugador_posicion", "ix_jugador_pais", "ix_carta_puntuacion", "ix_carta_rango_rareza")
+
+
+def _indices_consultas_principales() -> None:
+    _crear_indices(_version_4, "ix_carta_rareza", "ix_carta_actualizada_en", "ix_partido_fecha",
+                   "ix_historico_partido", "ix_historico_registrado_en", "ix_participa_liga_clasificacion",
+                   "ix_carta_liga_usuario", "ix_clasificacion_liga_posicion", "ix_puntos_jornada_jornada_liga")
+
+
+def _tiradas_preparadas() -> None:
+    _crear_tablas(_version_5, "tirada_preparada")
+
+
+def _tiradas_obtenidas() -> None:
+    _crear_tablas(_version_6, "tirada_obtenida")
+
+
+def _fragmentos_trabajos() -> None:
+    _crear_tablas(_version_7, "fragmento_trabajo")
+
+
+def _historial_puntuaciones() -> None:
+    _crear_tablas(_version_8, "movimiento_puntuacion", "clasificacion_historica")
+    _crear_indices(_version_8, "ix_movimiento_puntuacion_serie")
+
+
+# (version, descripcion, funcion)
+MIGRACIONES = [
+    (1, "Esquema inicial", _esquema_inicial),
+    (2, "Tablas del recomputo y la clasificacion, columnas del recomputo incremental y contador de participantes",
+     _columnas_recomputo),
+    (3, "Indices de la busqueda de jugadores", _indices_busqueda_jugadores),
+    (4, "Indices de las consultas principales", _indices_consultas_principales),
+    (5, "Tabla de tiradas preparadas", _tiradas_preparadas),
+    (6, "Tabla de tiradas obtenidas", _tiradas_obtenidas),
+    (7, "Tabla de puntos de control de los trabajos", _fragmentos_trabajos),
+    (8, "Libro de movimientos de puntuacion y clasificaciones historicas", _historial_puntuaciones),
+]
+
+
+def version_esquema() -> int:
+    """
+    Ultima migracion aplicada (0 si no se ha aplicado ninguna)
+    """
+    VersionEsquema.__table__.create(db.engine, checkfirst=True)
+    return db.session.scalar(select(func.coalesce(func.max(VersionEsquema.version), 0)))
+
+
+def migrar(hasta: int = None) -> list:
+    """
+    Aplica las migraciones pendientes (hasta la version "hasta", si se indica) y devuelve
+    la lista de (version, descripcion) aplicadas
+    """
+    actual = version_esquema()
+    aplicadas = []
+    for version, descripcion, funcion in MIGRACIONES:
+        if version <= actual or (hasta is not None and version > hasta):
+            continue
+        try:
+            funcion()
+            db.session.add(VersionEsquema(version=version, descripcion=descripcion,
+                                          aplicada_en=datetime.datetime.now()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        aplicadas.append((version, descripcion))
+    return aplicadas
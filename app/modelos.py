@@ -1,12 +1,13 @@
 from typing import List
 import datetime
 from . import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from .contrasenas import generar_hash, comprobar_hash
 from sqlalchemy import String, Integer, Boolean, ForeignKey
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from flask_login import UserMixin
 
-from sqlalchemy import Numeric, Date
+from sqlalchemy import Numeric, Date, DateTime, Float, LargeBinary
+from sqlalchemy import DDL, Index, case, event
 
 
 class Jugador(db.Model):
@@ -25,6 +26,17 @@ class Jugador(db.Model):
     pais: Mapped[str] = mapped_column(String(30), nullable=False)
     url_imagen: Mapped[str] = mapped_column(String, nullable=False)
 
+    # Busqueda y filtros de la lista de jugadores (ver app/busqueda_jugadores.py). El indice de
+    # trigramas permite buscar por subcadena del nombre con ILIKE sin recorrer toda la tabla.
+    __table_args__ = (
+        Index("ix_jugador_nombre_trgm", "nombre", postgresql_using="gin",
+              postgresql_ops={"nombre": "gin_trgm_ops"}),
+        Index("ix_jugador_nombre_id", "nombre", "id_jugador"),
+        Index("ix_jugador_nombre_equipo", "nombre_equipo"),
+        Index("ix_jugador_posicion", "posicion"),
+        Index("ix_jugador_pais", "pais"),
+    )
+
     historicos: Mapped[List["Historico"]] = relationship(back_populates="jugador")
     cartas: Mapped[List["Carta"]] = relationship(back_populates="jugador")
     cartas_liga: Mapped[List["CartaLiga"]] = relationship(back_populates="jugador")
@@ -40,6 +52,11 @@ class Partido(db.Model):
     gana_local: Mapped[bool] = mapped_column(Boolean, nullable=False)
     url: Mapped[str] = mapped_column(String, nullable=False)
 
+    # Historico de un jugador y puntuacion de las cartas ordenan los partidos por fecha
+    __table_args__ = (
+        Index("ix_partido_fecha", "fecha", "id_partido"),
+    )
+
     historicos: Mapped[List["Historico"]] = relationship(back_populates="partido")
 
 
@@ -54,11 +71,41 @@ class Historico(db.Model):
     tiempo_jugador: Mapped[int] = mapped_column(Integer, nullable=False)
     puntos_marcados: Mapped[int] = mapped_column(Integer, nullable=True)
     puntuacion: Mapped[float] = mapped_column(Numeric(4, 2), nullable=False)
+    # Momento en el que se inserto o corrigio la fila (para puntuar solo lo nuevo)
+    registrado_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True,
+                                                             default=datetime.datetime.now,
+                                                             onupdate=datetime.datetime.now)
+
+    # La clave primaria empieza por id_jugador; estos cubren las busquedas por partido (ingesta)
+    # y por marca de agua (puntuacion de las cartas)
+    __table_args__ = (
+        Index("ix_historico_partido", "id_partido", "id_jugador"),
+        Index("ix_historico_registrado_en", "registrado_en"),
+    )
 
     jugador: Mapped["Jugador"] = relationship(back_populates="historicos")
     partido: Mapped["Partido"] = relationship(back_populates="historicos")
 
 
+class EstadisticasJugador(db.Model):
+    """
+    Estadisticas agregadas de todo el historico de un jugador. Se actualizan al ingestar
+    partidos (ver app/estadisticas_jugador.py), para no recorrer el historico en cada visita al perfil.
+    """
+    id_jugador: Mapped[int] = mapped_column(Integer, ForeignKey(Jugador.id_jugador), primary_key=True)
+
+    partidos: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    minutos: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    puntos: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    puntuacion_media: Mapped[float] = mapped_column(Numeric(4, 2), nullable=True)
+    puntuacion_mediana: Mapped[float] = mapped_column(Numeric(4, 2), nullable=True)
+    victorias: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    derrotas: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Puntuacion media de los ultimos ESTADISTICAS_PARTIDOS_FORMA partidos
+    forma: Mapped[float] = mapped_column(Numeric(4, 2), nullable=True)
+    actualizada_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False)
+
+
 class Usuario(db.Model, UserMixin):
     """
     Usuarios de la aplicacion
@@ -84,10 +131,10 @@ class Usuario(db.Model, UserMixin):
     # se invoca siempre que asignemos al atributo un nuevo valor. En este caso, cuando hagamos usuario.password
     @password.setter
     def password(self, password: str) -> None:
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generar_hash(password)
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        return comprobar_hash(self.password_hash, password)
 
 
 class Carta(db.Model):
@@ -95,10 +142,30 @@ class Carta(db.Model):
 
     puntuacion: Mapped[float] = mapped_column(Numeric(4, 1), nullable=False, default=0)
     rareza: Mapped[str] = mapped_column(String(15), nullable=False)
+    # Momento en el que se modifico la carta por ultima vez (para el recomputo incremental)
+    actualizada_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True,
+                                                              onupdate=datetime.datetime.now)
+
+    # El pool de cartas carga (rareza, id_jugador) solo desde el indice; el recomputo incremental
+    # busca las cartas modificadas desde la ultima jornada
+    __table_args__ = (
+        Index("ix_carta_rareza", "rareza", "id_jugador"),
+        Index("ix_carta_actualizada_en", "actualizada_en"),
+    )
 
     jugador: Mapped["Jugador"] = relationship(back_populates="cartas")
 
 
+# Rareza como numero (comun=0 ... mitica=3), para poder ordenar las cartas por rareza con un indice
+rango_rareza = case({"comun": 0, "infrecuente": 1, "rara": 2, "mitica": 3}, value=Carta.rareza, else_=0)
+Index("ix_carta_rango_rareza", rango_rareza, Carta.puntuacion, Carta.id_jugador)
+Index("ix_carta_puntuacion", Carta.puntuacion, Carta.id_jugador)
+
+# El indice de trigramas necesita la extension pg_trgm
+event.listen(db.metadata, "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
+
 
 class Liga(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -106,6 +173,8 @@ class Liga(db.Model):
     nombre: Mapped[str] = mapped_column(String(30), nullable=False)
     numero_participantes_maximo: Mapped[int] = mapped_column(Integer, nullable=False)
     password_hash: Mapped[str] = mapped_column(String, nullable=True)
+    # Numero de participantes actuales, mantenido al unirse/crear la liga para no contarlos en cada vista
+    num_participantes: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
 
     participa_ligas: Mapped[List["ParticipaLiga"]] = relationship(back_populates="liga")
     cartas_liga: Mapped[List["CartaLiga"]] = relationship(back_populates="liga")
@@ -117,14 +186,14 @@ class Liga(db.Model):
     @password.setter
     def password(self, password: str) -> None:
         if password:
-            self.password_hash = generate_password_hash(password)
+            self.password_hash = generar_hash(password)
         else:
             self.password_hash = None
 
     def check_password(self, password: str) -> bool:
         if self.password_hash is None:
             return True
-        return check_password_hash(self.password_hash, password)
+        return comprobar_hash(self.password_hash, password)
 
 
 class ParticipaLiga(db.Model):
@@ -133,6 +202,12 @@ class ParticipaLiga(db.Model):
 
     puntuacion_acumulada: Mapped[float] = mapped_column(Numeric, nullable=False, default=0)
 
+    # La clave primaria (id_usuario, id_liga) ya sirve para las ligas de un usuario. La clasificacion
+    # de una liga se pagina por (puntuacion_acumulada DESC, id_usuario) dentro de la liga
+    __table_args__ = (
+        Index("ix_participa_liga_clasificacion", "id_liga", "puntuacion_acumulada", "id_usuario"),
+    )
+
     usuario: Mapped["Usuario"] = relationship(back_populates="participa_ligas")
     liga: Mapped["Liga"] = relationship(back_populates="participa_ligas")
 
@@ -144,6 +219,170 @@ class CartaLiga(db.Model):
 
     numero_copias: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
+    # Cartas de un usuario (en todas sus ligas o en una), sin pasar por la clave (id_liga, ...)
+    __table_args__ = (
+        Index("ix_carta_liga_usuario", "id_usuario", "id_liga", "id_jugador"),
+    )
+
     usuario: Mapped["Usuario"] = relationship(back_populates="cartas_liga")
     liga: Mapped["Liga"] = relationship(back_populates="cartas_liga")
-    jugador: Mapped["Jugador"] = relationship(back_populates="cartas_liga")
\ No newline at end of file
+    jugador: Mapped["Jugador"] = relationship(back_populates="cartas_liga")
+
+
+class ClasificacionLiga(db.Model):
+    """
+    Clasificacion de cada liga, materializada cada vez que se recomputan las puntuaciones.
+    Permite consultar la posicion de un usuario en una liga por clave primaria.
+    """
+    id_liga: Mapped[int] = mapped_column(Integer, ForeignKey(Liga.id), primary_key=True)
+    id_usuario: Mapped[int] = mapped_column(Integer, ForeignKey(Usuario.id), primary_key=True)
+
+    posicion: Mapped[int] = mapped_column(Integer, nullable=False)
+    puntuacion: Mapped[float] = mapped_column(Numeric, nullable=False)
+    email: Mapped[str] = mapped_column(String(30), nullable=False)
+
+    __table_args__ = (
+        Index("ix_clasificacion_liga_posicion", "id_liga", "posicion"),
+    )
+
+
+class PuntosJornada(db.Model):
+    """
+    Puntos que ha sumado cada participacion en una jornada. Guardarlos permite volver a
+    recomputar una jornada sin sumar dos veces sus puntos.
+    """
+    id_usuario: Mapped[int] = mapped_column(Integer, ForeignKey(Usuario.id), primary_key=True)
+    id_liga: Mapped[int] = mapped_column(Integer, ForeignKey(Liga.id), primary_key=True)
+    jornada: Mapped[str] = mapped_column(String(20), primary_key=True)
+
+    puntos: Mapped[float] = mapped_column(Numeric, nullable=False, default=0)
+
+    # El recomputo de una jornada recorre sus puntos por bloques de ligas
+    __table_args__ = (
+        Index("ix_puntos_jornada_jornada_liga", "jornada", "id_liga"),
+    )
+
+
+class MovimientoPuntuacion(db.Model):
+    """
+    Libro de movimientos de las puntuaciones: cada vez que un recomputo cambia la puntuacion
+    acumulada de una participacion se añade una fila con la diferencia y la puntuacion resultante.
+    Solo se insertan filas, nunca se modifican ni se borran (ver app/historial_puntuaciones.py).
+    """
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    id_usuario: Mapped[int] = mapped_column(Integer, ForeignKey(Usuario.id), nullable=False)
+    id_liga: Mapped[int] = mapped_column(Integer, ForeignKey(Liga.id), nullable=False)
+    jornada: Mapped[str] = mapped_column(String(20), nullable=False)
+    diferencia: Mapped[float] = mapped_column(Numeric, nullable=False)
+    puntuacion: Mapped[float] = mapped_column(Numeric, nullable=False)
+    registrado_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False)
+
+    # La evolucion de un usuario en una liga es un unico recorrido de este indice, en el orden
+    # en el que se registraron los movimientos
+    __table_args__ = (
+        Index("ix_movimiento_puntuacion_serie", "id_usuario", "id_liga", "id"),
+    )
+
+
+class ClasificacionHistorica(db.Model):
+    """
+    Foto de la clasificacion de una liga al aplicar una jornada. "datos" guarda los participantes
+    ordenados por posicion: "participantes" ids de usuario (int32) seguidos de otras tantas
+    posiciones (int32) y puntuaciones (float32), en little endian (ver app/historial_puntuaciones.py).
+    """
+    id_liga: Mapped[int] = mapped_column(Integer, ForeignKey(Liga.id), primary_key=True)
+    jornada: Mapped[str] = mapped_column(String(20), primary_key=True)
+
+    participantes: Mapped[int] = mapped_column(Integer, nullable=False)
+    datos: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    registrada_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False)
+
+
+class JornadaAplicada(db.Model):
+    """
+    Jornadas cuyos puntos ya se han sumado a las participaciones
+    """
+    jornada: Mapped[str] = mapped_column(String(20), primary_key=True)
+
+    aplicada_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False)
+    # Marca de agua: Carta.actualizada_en mas reciente que se tuvo en cuenta al aplicarla
+    marca_cartas: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+
+
+class VersionDatos(db.Model):
+    """
+    Version de los datos de una tabla "de catalogo" (cartas, jugadores...). Cada vez que
+    se modifican esos datos se incrementa, para que las caches de cada proceso sepan
+    que tienen que recargarse
+    """
+    clave: Mapped[str] = mapped_column(String(30), primary_key=True)
+
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    actualizada_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False,
+                                                              default=datetime.datetime.now)
+
+
+class MarcaProceso(db.Model):
+    """
+    Marca de agua de un proceso periodico: hasta donde proceso los datos la ultima vez
+    """
+    clave: Mapped[str] = mapped_column(String(30), primary_key=True)
+
+    marca: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+
+
+class VersionEsquema(db.Model):
+    """
+    Migraciones del esquema ya aplicadas en esta base de datos (ver app/migraciones.py)
+    """
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+
+    descripcion: Mapped[str] = mapped_column(String, nullable=False)
+    aplicada_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False,
+                                                           default=datetime.datetime.now)
+
+
+class TiradaPreparada(db.Model):
+    """
+    Cartas de la tirada diaria precalculadas para un usuario y un dia (ver app/tiradas_preparadas.py).
+    Una fila por carta: una por liga, o una por rareza en cada liga si es el cumpleaños del usuario.
+    Al reclamar la tirada se borran sus filas.
+    """
+    fecha: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    id_usuario: Mapped[int] = mapped_column(Integer, ForeignKey(Usuario.id), primary_key=True)
+    id_liga: Mapped[int] = mapped_column(Integer, ForeignKey(Liga.id), primary_key=True)
+    posicion: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+
+    id_jugador: Mapped[int] = mapped_column(Integer, ForeignKey(Jugador.id_jugador), nullable=False)
+
+
+class TiradaObtenida(db.Model):
+    """
+    Cartas que obtuvo un usuario en la tirada de un dia, con la misma forma que TiradaPreparada.
+    (fecha, id_usuario) es la clave de idempotencia de la tirada: si se repite la peticion, se
+    devuelven estas cartas en lugar de volver a tirar.
+    """
+    fecha: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    id_usuario: Mapped[int] = mapped_column(Integer, ForeignKey(Usuario.id), primary_key=True)
+    id_liga: Mapped[int] = mapped_column(Integer, ForeignKey(Liga.id), primary_key=True)
+    posicion: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+
+    id_jugador: Mapped[int] = mapped_column(Integer, ForeignKey(Jugador.id_jugador), nullable=False)
+
+
+class FragmentoTrabajo(db.Model):
+    """
+    Punto de control de un fragmento (rango de ids [desde, hasta)) de un trabajo en segundo plano
+    (ver app/trabajos.py). "trabajo" identifica la ejecucion (nombre y parametros): al relanzarla
+    solo se procesan los fragmentos que no estan "hecho".
+    """
+    trabajo: Mapped[str] = mapped_column(String(100), primary_key=True)
+    desde: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+
+    hasta: Mapped[int] = mapped_column(Integer, nullable=False)
+    estado: Mapped[str] = mapped_column(String(10), nullable=False, default="pendiente")
+    filas: Mapped[int] = mapped_column(Integer, nullable=True)
+    segundos: Mapped[float] = mapped_column(Float, nullable=True)
+    error: Mapped[str] = mapped_column(String, nullable=True)
+    terminado_en: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
@@ -0,0 +1,96 @@
+"""
+Paginacion por cursor (keyset).
+
+En lugar de OFFSET (que recorre todas las filas anteriores y necesita un COUNT aparte), cada
+pagina se pide a partir de los valores de ordenacion de la ultima fila de la pagina anterior.
+El coste de cualquier pagina es el mismo, sea la primera o la ultima.
+"""
+from decimal import Decimal
+from typing import List, Optional
+from sqlalchemy import and_, or_
+from . import db
+
+
+class PaginaKeyset:
+    """
+    Pagina de resultados con los cursores a la pagina siguiente y a la anterior (None si no hay)
+    """
+
+    def __init__(self, items: List, siguiente: Optional[str], anterior: Optional[str]):
+        self.items = items
+        self.siguiente = siguiente
+        self.anterior = anterior
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def codificar_cursor(*valores) -> str:
+    # Los Decimal se escriben sin notacion cientifica (0E-10) para que la URL quede limpia
+    return "_".join(format(valor, "f") if isinstance(valor, Decimal) else str(valor) for valor in valores)
+
+
+def decodificar_cursor(cursor: Optional[str], *tipos) -> Optional[tuple]:
+    """
+    Convierte el cursor de la URL en una tupla con los tipos indicados. Si el cursor no es valido
+    se devuelve None (es decir, se empieza por la primera pagina).
+    """
+    if not cursor:
+        return None
+    # Se separa por la derecha: solo el primer valor (p. ej. un nombre) puede contener "_"
+    partes = cursor.rsplit("_", len(tipos) - 1)
+    if len(partes) != len(tipos):
+        return None
+    try:
+        return tuple(tipo(parte) for tipo, parte in zip(tipos, partes))
+    except (ValueError, ArithmeticError):
+        return None
+
+
+def _posteriores(columnas, cursor: tuple, hacia_atras: bool):
+    """
+    Condicion "fila posterior al cursor" con direcciones mezcladas:
+    (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+    """
+    condiciones = []
+    for i, (columna, descendente) in enumerate(columnas):
+        avanza = (columna < cursor[i]) if descendente != hacia_atras else (columna > cursor[i])
+        iguales = [anterior == cursor[j] for j, (anterior, _) in enumerate(columnas[:i])]
+        condiciones.append(and_(*iguales, avanza))
+    return or_(*condiciones)
+
+
+def paginar_keyset(consulta, columnas, valores_fila, despues: Optional[tuple], antes: Optional[tuple],
+                   por_pagina: int) -> PaginaKeyset:
+    """
+    Pagina "consulta" ordenando por "columnas", una lista de tuplas (columna, descendente) cuya
+    ultima columna debe ser unica. "valores_fila" devuelve los valores de esas columnas en una fila.
+    Se pide la pagina posterior al cursor "despues", o la anterior al cursor "antes".
+    """
+    hacia_atras = despues is None and antes is not None
+    cursor = antes if hacia_atras else despues
+    if cursor is not None:
+        consulta = consulta.where(_posteriores(columnas, cursor, hacia_atras))
+
+    # Hacia atras se recorre en orden inverso y despues se le da la vuelta a la pagina
+    orden = [columna.desc() if descendente != hacia_atras else columna.asc() for columna, descendente in columnas]
+    filas = db.session.execute(consulta.order_by(*orden).limit(por_pagina + 1)).all()
+
+    hay_mas = len(filas) > por_pagina
+    filas = filas[:por_pagina]
+    if hacia_atras:
+        filas.reverse()
+
+    if not filas:
+        return PaginaKeyset(filas, None, None)
+    # Hacia atras siempre hay pagina siguiente (de la que venimos); hacia delante, anterior si habia cursor
+    hay_siguiente = True if hacia_atras else hay_mas
+    hay_anterior = hay_mas if hacia_atras else cursor is not None
+    return PaginaKeyset(
+        filas,
+        codificar_cursor(*valores_fila(filas[-1])) if hay_siguiente else None,
+        codificar_cursor(*valores_fila(filas[0])) if hay_anterior else None
+    )
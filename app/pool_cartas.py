@@ -0,0 +1,100 @@
+"""
+Pool de cartas en memoria, agrupadas por rareza.
+
+Para las tiradas solo necesitamos elegir un id_jugador al azar dentro de una rareza, asi que
+en lugar de cargar todos los objetos Carta de esa rareza en cada tirada, guardamos por proceso
+un array compacto de ids por rareza y elegimos con random.choice (O(1)).
+
+El pool se reconstruye cuando:
+    * Se modifica una Carta desde este mismo proceso (eventos del ORM).
+    * La version "cartas" de la base de datos cambia (la incrementa admin_script). Esta
+      version se comprueba como mucho una vez cada POOL_CARTAS_TTL segundos.
+"""
+import random
+import threading
+import time
+from array import array
+from flask import current_app
+from sqlalchemy import select, event
+from . import db
+from .modelos import Carta
+from .versiones import version_actual
+
+CLAVE_VERSION = "cartas"
+
+
+class PoolCartas:
+    """
+    Ids de las cartas por rareza, con contadores de aciertos y reconstrucciones
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids_por_rareza = {}
+        self._version = None
+        self._comprobado_en = 0.0
+        self._invalidado = True
+
+        # Contadores para comprobar que el pool esta sirviendo las tiradas
+        self.aciertos = 0
+        self.reconstrucciones = 0
+
+    def invalidar(self) -> None:
+        """
+        Marca el pool para que se reconstruya en la siguiente tirada
+        """
+        self._invalidado = True
+
+    def elegir(self, rareza: str) -> int:
+        """
+        Devuelve el id_jugador de una carta aleatoria de la rareza indicada
+        """
+        with self._lock:
+            if not self._vigente():
+                self._reconstruir()
+            else:
+                self.aciertos += 1
+            ids = self._ids_por_rareza.get(rareza, ())
+        return random.choice(ids)
+
+    def estadisticas(self) -> dict:
+        return {
+            "aciertos": self.aciertos,
+            "reconstrucciones": self.reconstrucciones,
+            "version": self._version,
+            "cartas_por_rareza": {rareza: len(ids) for rareza, ids in self._ids_por_rareza.items()},
+        }
+
+    def _vigente(self) -> bool:
+        if self._invalidado:
+            return False
+        ahora = time.monotonic()
+        if ahora - self._comprobado_en < current_app.config.get("POOL_CARTAS_TTL", 30):
+            return True
+        self._comprobado_en = ahora
+        return version_actual(CLAVE_VERSION) == self._version
+
+    def _reconstruir(self) -> None:
+        # Leemos la version antes que las cartas: si cambian entre medias, en la siguiente
+        # comprobacion la version no coincidira y se volvera a reconstruir
+        version = version_actual(CLAVE_VERSION)
+        ids_por_rareza = {}
+        for rareza, id_jugador in db.session.execute(select(Carta.rareza, Carta.id_jugador)):
+            ids_por_rareza.setdefault(rareza, array("i")).append(id_jugador)
+
+        self._ids_por_rareza = ids_por_rareza
+        self._version = version
+        self._comprobado_en = time.monotonic()
+        self._invalidado = False
+        self.reconstrucciones += 1
+
+
+pool_cartas = PoolCartas()
+
+
+# Cualquier cambio de cartas hecho a traves del ORM en este proceso invalida el pool
+@event.listens_for(Carta, "after_insert")
+@event.listens_for(Carta, "after_update")
+@event.listens_for(Carta, "after_delete")
+def _invalidar_pool(mapper, connection, carta):
+    pool_cartas.invalidar()
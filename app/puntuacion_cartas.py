@@ -0,0 +1,159 @@
+"""
+Calculo de la puntuacion de las cartas (Carta.puntuacion) a partir del historico de los jugadores.
+
+Cada ejecucion:
+    1. Busca los jugadores con filas de Historico nuevas o corregidas desde la ultima ejecucion
+       (marca de agua "puntuacion_cartas").
+    2. Carga con una sola consulta las puntuaciones de esos jugadores, ordenadas por fecha.
+    3. Calcula con NumPy la puntuacion de cada carta sobre sus ultimos PUNTUACION_CARTAS_VENTANA
+       partidos, segun PUNTUACION_CARTAS_FORMULA ("media", "mediana" o "suma").
+    4. Escribe de golpe las cartas cuya puntuacion ha cambiado, e incrementa la version de las cartas.
+
+Devuelve los id_jugador de las cartas modificadas, para que los totales de las ligas puedan
+recomputarse de forma incremental (ver app/puntuaciones.py).
+
+Historico.registrado_en se pone al validar cada fila, no al hacer commit, asi que una ingesta lenta
+puede confirmar filas mas antiguas que el historico ya puntuado. Por eso la marca de agua nunca
+pasa de hace PUNTUACION_CARTAS_MARGEN segundos: el historico de ese margen se vuelve a revisar en
+la siguiente ejecucion (solo se escriben las cartas que cambian), y solo se pierde el de una
+ingesta que tarde mas que el margen en hacer commit (puntuar_cartas(completo=True) lo recupera).
+"""
+import datetime
+from typing import Optional
+import numpy as np
+from flask import current_app
+from sqlalchemy import select, update, func
+from . import db
+from .modelos import Carta, Historico, Partido, MarcaProceso
+from .utilidades_bd import insert_con_conflicto
+from .versiones import incrementar_version
+
+CLAVE_MARCA = "puntuacion_cartas"
+
+# Carta.puntuacion es Numeric(4, 1)
+PUNTUACION_MAXIMA = 999.9
+
+FORMULAS = {
+    "media": np.nanmean,
+    "mediana": np.nanmedian,
+    "suma": np.nansum,
+}
+
+
+def calcular_puntuaciones(ids: np.ndarray, puntuaciones: np.ndarray, ventana: int, formula: str):
+    """
+    Dados los arrays "ids" y "puntuaciones", ordenados por id_jugador y por fecha descendente,
+    devuelve (ids_unicos, puntuacion_carta) usando los "ventana" partidos mas recientes de cada jugador.
+    """
+    if ventana < 1:
+        raise ValueError(f"La ventana de partidos tiene que ser al menos 1: {ventana}")
+    if ids.size == 0:
+        return ids, puntuaciones
+    # Inicio de cada grupo de filas del mismo jugador y posicion de cada fila dentro de su grupo
+    inicios = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    tamaños = np.diff(np.r_[inicios, ids.size])
+    grupo = np.repeat(np.arange(inicios.size), tamaños)
+    posicion = np.arange(ids.size) - np.repeat(inicios, tamaños)
+
+    # Matriz jugadores x ventana con los ultimos partidos de cada uno (NaN si ha jugado menos)
+    en_ventana = posicion < ventana
+    matriz = np.full((inicios.size, ventana), np.nan)
+    matriz[grupo[en_ventana], posicion[en_ventana]] = puntuaciones[en_ventana]
+
+    resultado = np.round(FORMULAS[formula](matriz, axis=1), 1)
+    return ids[inicios], np.clip(resultado, -PUNTUACION_MAXIMA, PUNTUACION_MAXIMA)
+
+
+def marca_puntuacion() -> Optional[datetime.datetime]:
+    """
+    Marca de agua de la ultima puntuacion: solo hay que revisar el historico registrado despues
+    """
+    return db.session.scalar(select(MarcaProceso.marca).where(MarcaProceso.clave == CLAVE_MARCA))
+
+
+def nueva_marca_puntuacion() -> Optional[datetime.datetime]:
+    """
+    Marca de agua que se registra al puntuar: el historico mas reciente, pero no posterior a hace
+    PUNTUACION_CARTAS_MARGEN segundos
+    """
+    ultima = db.session.scalar(select(func.max(Historico.registrado_en)))
+    if ultima is None:
+        return None
+    margen = datetime.timedelta(seconds=current_app.config.get("PUNTUACION_CARTAS_MARGEN", 900))
+    return min(ultima, datetime.datetime.now() - margen)
+
+
+def puntuar_rango(marca: Optional[datetime.datetime], desde_jugador: Optional[int] = None,
+                  hasta_jugador: Optional[int] = None) -> dict:
+    """
+    Recalcula la puntuacion de las cartas de los jugadores con id en [desde_jugador, hasta_jugador)
+    (o de todos) con historico posterior a "marca" (o con cualquier historico, si no hay marca).
+    No hace commit ni incrementa la version de las cartas. Devuelve un resumen con la lista
+    "modificados" de id_jugador actualizados.
+    """
+    formula = current_app.config.get("PUNTUACION_CARTAS_FORMULA", "media")
+    ventana = current_app.config.get("PUNTUACION_CARTAS_VENTANA", 10)
+    if formula not in FORMULAS:
+        raise ValueError(f"Formula de puntuacion desconocida: {formula}")
+
+    consulta = (
+        select(Historico.id_jugador, Historico.puntuacion)
+        .join(Partido, Partido.id_partido == Historico.id_partido)
+        .order_by(Historico.id_jugador, Partido.fecha.desc(), Partido.id_partido.desc())
+    )
+    if desde_jugador is not None:
+        consulta = consulta.where(Historico.id_jugador >= desde_jugador, Historico.id_jugador < hasta_jugador)
+    if marca is not None:
+        afectados = select(Historico.id_jugador).where(Historico.registrado_en > marca).distinct()
+        consulta = consulta.where(Historico.id_jugador.in_(afectados))
+
+    filas = db.session.execute(consulta).all()
+    ids = np.fromiter((f[0] for f in filas), dtype=np.int64, count=len(filas))
+    puntuaciones = np.fromiter((f[1] for f in filas), dtype=np.float64, count=len(filas))
+    ids_jugador, nuevas = calcular_puntuaciones(ids, puntuaciones, ventana, formula)
+
+    # Comparamos con la puntuacion actual para escribir solo las cartas que cambian
+    actuales = dict(db.session.execute(
+        select(Carta.id_jugador, Carta.puntuacion).where(Carta.id_jugador.in_(ids_jugador.tolist()))
+    ).all()) if ids_jugador.size else {}
+    ahora = datetime.datetime.now()
+    cambios = [
+        {"id_jugador": id_jugador, "puntuacion": puntuacion, "actualizada_en": ahora}
+        for id_jugador, puntuacion in zip(ids_jugador.tolist(), nuevas.tolist())
+        if id_jugador in actuales and float(actuales[id_jugador]) != puntuacion
+    ]
+    if cambios:
+        db.session.execute(update(Carta), cambios)
+
+    return {
+        "jugadores_revisados": int(ids_jugador.size),
+        "filas_historico": len(filas),
+        "modificados": [cambio["id_jugador"] for cambio in cambios],
+    }
+
+
+def registrar_puntuacion(nueva_marca: Optional[datetime.datetime], hay_cambios: bool) -> None:
+    """
+    Guarda la marca de agua de la puntuacion y, si alguna carta ha cambiado, incrementa la version
+    de las cartas. Hace commit.
+    """
+    if hay_cambios:
+        incrementar_version("cartas")
+    stmt = insert_con_conflicto(MarcaProceso).values(clave=CLAVE_MARCA, marca=nueva_marca)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[MarcaProceso.clave], set_={"marca": stmt.excluded.marca}
+    ))
+    db.session.commit()
+
+
+def puntuar_cartas(completo: bool = False) -> dict:
+    """
+    Recalcula la puntuacion de las cartas de los jugadores con historico nuevo (o de todos, si
+    "completo"). Devuelve un resumen con la lista "modificados" de id_jugador actualizados. Para
+    repartir los jugadores entre varios procesos, ver el trabajo "puntuar-cartas" de app/trabajos.py.
+    """
+    marca = None if completo else marca_puntuacion()
+    nueva_marca = nueva_marca_puntuacion()
+    resumen = puntuar_rango(marca)
+    registrar_puntuacion(nueva_marca, bool(resumen["modificados"]))
+    return resumen
@@ -0,0 +1,202 @@
+"""
+Recomputo de las puntuaciones acumuladas de las ligas.
+
+En cada jornada, cada participacion suma la puntuacion de las cartas (unicas) que tiene en la liga.
+Todo el calculo se hace en la base de datos con unas pocas sentencias por bloque de ligas:
+
+    1. INSERT en el libro movimiento_puntuacion ... SELECT (puntos nuevos - puntos ya aplicados
+       en la jornada), solo de las participaciones cuya puntuacion cambia
+    2. UPDATE participa_liga ... FROM los movimientos que se acaban de insertar
+    3. Upsert de los puntos de la jornada en puntos_jornada
+    4. Reconstruccion de la clasificacion materializada de esas ligas (ver app/clasificacion.py)
+       y foto de la clasificacion de la jornada (ver app/historial_puntuaciones.py)
+    5. Registro de la jornada en jornada_aplicada, con la marca de agua de las cartas
+
+Como se suma la diferencia con lo que ya se aplico en esa jornada, volver a ejecutar una
+jornada no duplica puntos. El modo incremental solo recalcula las participaciones que tienen
+alguna carta modificada despues de la marca de agua de la jornada.
+"""
+import datetime
+from typing import Optional
+from sqlalchemy import select, update, func, and_, literal
+from . import db
+from .modelos import Carta, CartaLiga, Liga, ParticipaLiga, PuntosJornada, JornadaAplicada, MovimientoPuntuacion
+from .utilidades_bd import insert_con_conflicto
+from .clasificacion import actualizar_clasificacion
+from .historial_puntuaciones import guardar_clasificaciones
+
+
+def jornada_de_hoy() -> str:
+    return datetime.date.today().isoformat()
+
+
+def _puntos_nuevos(jornada: str, desde_liga: Optional[int], hasta_liga: Optional[int],
+                   marca: Optional[datetime.datetime]):
+    """
+    SELECT con los puntos de la jornada de cada participacion (id_usuario, id_liga, jornada, puntos)
+    """
+    consulta = (
+        select(CartaLiga.id_usuario, CartaLiga.id_liga,
+               literal(jornada, PuntosJornada.jornada.type).label("jornada"),
+               func.sum(Carta.puntuacion).label("puntos"))
+        .join(Carta, Carta.id_jugador == CartaLiga.id_jugador)
+        .group_by(CartaLiga.id_usuario, CartaLiga.id_liga)
+    )
+    if desde_liga is not None:
+        consulta = consulta.where(CartaLiga.id_liga >= desde_liga, CartaLiga.id_liga < hasta_liga)
+    if marca is not None:
+        # Solo las participaciones con alguna carta modificada despues de la marca de agua
+        consulta = consulta.having(func.max(Carta.actualizada_en) > marca)
+    return consulta
+
+
+def _aplicar_bloque(jornada: str, desde_liga: Optional[int], hasta_liga: Optional[int],
+                    marca: Optional[datetime.datetime]) -> int:
+    """
+    Aplica la jornada a un bloque de ligas [desde_liga, hasta_liga). Devuelve el numero de
+    participaciones cuya puntuacion ha cambiado.
+    """
+    nuevos = _puntos_nuevos(jornada, desde_liga, hasta_liga, marca).subquery()
+
+    diferencias = (
+        select(nuevos.c.id_usuario, nuevos.c.id_liga,
+               (nuevos.c.puntos - func.coalesce(PuntosJornada.puntos, 0)).label("diferencia"))
+        .outerjoin(PuntosJornada, and_(
+            PuntosJornada.id_usuario == nuevos.c.id_usuario,
+            PuntosJornada.id_liga == nuevos.c.id_liga,
+            PuntosJornada.jornada == jornada
+        ))
+        .subquery()
+    )
+    # Los movimientos se anotan en el libro y la puntuacion se actualiza a partir de ellos, asi las
+    # diferencias solo se calculan una vez. Los ids nuevos son mayores que el ultimo que hay ahora
+    ultimo = db.session.scalar(select(func.coalesce(func.max(MovimientoPuntuacion.id), 0)))
+    db.session.execute(
+        MovimientoPuntuacion.__table__.insert().from_select(
+            ["id_usuario", "id_liga", "jornada", "diferencia", "puntuacion", "registrado_en"],
+            select(diferencias.c.id_usuario, diferencias.c.id_liga,
+                   literal(jornada, MovimientoPuntuacion.jornada.type),
+                   diferencias.c.diferencia,
+                   ParticipaLiga.puntuacion_acumulada + diferencias.c.diferencia,
+                   literal(datetime.datetime.now(), MovimientoPuntuacion.registrado_en.type))
+            .join(ParticipaLiga, and_(ParticipaLiga.id_usuario == diferencias.c.id_usuario,
+                                      ParticipaLiga.id_liga == diferencias.c.id_liga))
+            .where(diferencias.c.diferencia != 0)
+        )
+    )
+    movimientos = select(MovimientoPuntuacion).where(
+        MovimientoPuntuacion.id > ultimo, MovimientoPuntuacion.jornada == jornada
+    )
+    if desde_liga is not None:
+        movimientos = movimientos.where(MovimientoPuntuacion.id_liga >= desde_liga,
+                                        MovimientoPuntuacion.id_liga < hasta_liga)
+    movimientos = movimientos.subquery()
+    resultado = db.session.execute(
+        update(ParticipaLiga)
+        .values(puntuacion_acumulada=ParticipaLiga.puntuacion_acumulada + movimientos.c.diferencia)
+        .where(ParticipaLiga.id_usuario == movimientos.c.id_usuario,
+               ParticipaLiga.id_liga == movimientos.c.id_liga)
+        .execution_options(synchronize_session=False)
+    )
+
+    stmt = insert_con_conflicto(PuntosJornada).from_select(
+        ["id_usuario", "id_liga", "jornada", "puntos"],
+        _puntos_nuevos(jornada, desde_liga, hasta_liga, marca)
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[PuntosJornada.id_usuario, PuntosJornada.id_liga, PuntosJornada.jornada],
+        set_={"puntos": stmt.excluded.puntos}
+    ))
+    return resultado.rowcount
+
+
+def _bloques_ligas(tam_bloque: Optional[int]):
+    """
+    Rangos [desde, hasta) de ids de liga de tamaño tam_bloque. Sin tamaño, un unico bloque con todas.
+    """
+    if not tam_bloque:
+        yield None, None
+        return
+    minimo, maximo = db.session.execute(select(func.min(Liga.id), func.max(Liga.id))).one()
+    if minimo is None:
+        return
+    for desde in range(minimo, maximo + 1, tam_bloque):
+        yield desde, desde + tam_bloque
+
+
+def preparar_jornada(jornada: str, incremental: bool = False, forzar: bool = False) -> Optional[dict]:
+    """
+    Marcas de agua con las que se aplica la jornada: {"marca": solo las cartas modificadas despues
+    (o None para recalcularla entera), "nueva_marca": la que se registra al terminar}. Devuelve None
+    si la jornada ya estaba aplicada y no se pide "incremental" ni "forzar".
+    """
+    aplicada = db.session.get(JornadaAplicada, jornada)
+    if aplicada is not None and not incremental and not forzar:
+        return None
+
+    marca = aplicada.marca_cartas if (aplicada is not None and incremental) else None
+    if incremental and aplicada is not None and marca is None:
+        # La jornada se aplico sin cartas modificadas aun: no hay nada posterior a la marca
+        marca = aplicada.aplicada_en
+    return {"marca": marca, "nueva_marca": db.session.scalar(select(func.max(Carta.actualizada_en)))}
+
+
+def aplicar_jornada(jornada: str, desde_liga: Optional[int], hasta_liga: Optional[int],
+                    marca: Optional[datetime.datetime]) -> int:
+    """
+    Aplica la jornada a las ligas [desde_liga, hasta_liga), reconstruye su clasificacion y guarda
+    la foto de la clasificacion de la jornada. Devuelve el numero de participaciones actualizadas.
+    No hace commit.
+    """
+    participaciones = _aplicar_bloque(jornada, desde_liga, hasta_liga, marca)
+    actualizar_clasificacion(desde_liga, hasta_liga)
+    guardar_clasificaciones(jornada, desde_liga, hasta_liga)
+    return participaciones
+
+
+def registrar_jornada(jornada: str, nueva_marca: Optional[datetime.datetime]) -> None:
+    """
+    Registra la jornada como aplicada, con la marca de agua de las cartas, y hace commit
+    """
+    stmt = insert_con_conflicto(JornadaAplicada).values(
+        jornada=jornada, aplicada_en=datetime.datetime.now(), marca_cartas=nueva_marca
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[JornadaAplicada.jornada],
+        set_={"aplicada_en": stmt.excluded.aplicada_en, "marca_cartas": stmt.excluded.marca_cartas}
+    ))
+    db.session.commit()
+
+
+def recomputar_jornada(jornada: str = None, incremental: bool = False, tam_bloque: int = None,
+                       forzar: bool = False) -> dict:
+    """
+    Suma a las participaciones los puntos de la jornada indicada (por defecto, la de hoy).
+
+    * Si la jornada ya estaba aplicada, no se hace nada salvo que se indique "incremental"
+      (recalcula solo las participaciones con cartas modificadas) o "forzar" (la recalcula entera).
+    * Con "tam_bloque", se procesa por bloques de ids de liga, con un commit por bloque.
+
+    Devuelve un diccionario con el resumen del recomputo. Para repartir los bloques entre varios
+    procesos, ver el trabajo "recomputar-jornada" de app/trabajos.py.
+    """
+    jornada = jornada or jornada_de_hoy()
+    marcas = preparar_jornada(jornada, incremental, forzar)
+    if marcas is None:
+        return {"jornada": jornada, "estado": "ya aplicada", "participaciones": 0}
+
+    participaciones = 0
+    bloques = 0
+    for desde_liga, hasta_liga in _bloques_ligas(tam_bloque):
+        participaciones += aplicar_jornada(jornada, desde_liga, hasta_liga, marcas["marca"])
+        bloques += 1
+        db.session.commit()
+
+    registrar_jornada(jornada, marcas["nueva_marca"])
+
+    return {
+        "jornada": jornada,
+        "estado": "incremental" if marcas["marca"] is not None else "completa",
+        "participaciones": participaciones,
+        "bloques": bloques,
+    }
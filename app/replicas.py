@@ -0,0 +1,96 @@
+"""
+Enrutado de las lecturas a replicas de la base de datos.
+
+Las vistas marcadas con @solo_lectura leen de una replica (SQLALCHEMY_REPLICAS en config.py; se
+elige una por peticion, por turnos). Todo lo demas va a la primaria:
+    * Las vistas sin @solo_lectura, los scripts y cualquier sentencia que escriba.
+    * Las sesiones con cambios pendientes (se hace flush contra la primaria).
+    * Lectura despues de escritura: cuando una peticion escribe en la primaria, las siguientes
+      peticiones del mismo navegador leen de la primaria durante REPLICA_LECTURA_PRIMARIA_SEGUNDOS,
+      para que el usuario vea sus propios cambios aunque la replica vaya con retraso.
+
+Sin replicas configuradas, @solo_lectura no cambia nada. Para probarlo en local basta con dos
+bases de datos PostgreSQL, o con dos ficheros SQLite (copiando el de la primaria).
+"""
+import functools
+import itertools
+import threading
+import time
+from flask import Flask, g, session, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+# Prefijo de los binds de Flask-SQLAlchemy que son replicas
+PREFIJO_REPLICA = "replica_"
+
+_turno = itertools.count()
+_lock = threading.Lock()
+
+
+def solo_lectura(vista):
+    """
+    Decorador de las vistas que solo leen: sus consultas pueden ir a una replica.
+    Se pone justo debajo de @app.route, para que la carga del usuario tambien vaya a la replica.
+    """
+    @functools.wraps(vista)
+    def envoltorio(*args, **kwargs):
+        g.solo_lectura = True
+        return vista(*args, **kwargs)
+    return envoltorio
+
+
+def configurar_replicas(app: Flask) -> None:
+    """
+    Añade las replicas de SQLALCHEMY_REPLICAS a SQLALCHEMY_BINDS. Se llama antes de db.init_app.
+    """
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    for i, uri in enumerate(app.config.get("SQLALCHEMY_REPLICAS") or []):
+        binds[f"{PREFIJO_REPLICA}{i}"] = uri
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+
+def registrar_escrituras(app: Flask, primaria) -> None:
+    """
+    Marca las peticiones que escriben en la primaria, para leer de ella durante un tiempo
+    """
+    def antes_consulta(conn, cursor, sentencia, parametros, contexto, executemany):
+        if has_request_context() and sentencia.lstrip()[:6].upper() not in ("SELECT", "PRAGMA"):
+            g.escritura_en_primaria = True
+
+    def fin_peticion(respuesta):
+        if g.get("escritura_en_primaria"):
+            session["leer_primaria_hasta"] = time.time() + app.config.get("REPLICA_LECTURA_PRIMARIA_SEGUNDOS", 5)
+        return respuesta
+
+    event.listen(primaria, "before_cursor_execute", antes_consulta)
+    app.after_request(fin_peticion)
+
+
+class SesionEnrutada(Session):
+    """
+    Sesion de Flask-SQLAlchemy que manda las lecturas de las vistas @solo_lectura a una replica
+    """
+
+    def _replica(self):
+        if not has_request_context() or not g.get("solo_lectura"):
+            return None
+        if self._flushing or self.new or self.dirty or self.deleted:
+            return None
+        if session.get("leer_primaria_hasta", 0) > time.time():
+            return None
+        if "replica" not in g:
+            replicas = sorted(clave for clave in self._db.engines
+                              if isinstance(clave, str) and clave.startswith(PREFIJO_REPLICA))
+            if replicas:
+                with _lock:
+                    g.replica = replicas[next(_turno) % len(replicas)]
+            else:
+                g.replica = None
+        return self._db.engines[g.replica] if g.replica else None
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not getattr(clause, "is_dml", False):
+            replica = self._replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
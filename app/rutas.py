@@ -1,16 +1,27 @@
 """
 Módulo de Python que contiene las rutas
 """
-import datetime
-import random
-from flask import current_app as app, render_template, redirect, url_for, flash, abort
+from flask import current_app as app, render_template, redirect, url_for, flash, abort, request
 from flask_login import login_user, logout_user, login_required, current_user
 from sqlalchemy import select, func, exists
-from sqlalchemy.orm import selectinload, load_only
+from sqlalchemy.orm import load_only
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime
-from .formularios import SignupForm, SignInForm, UnirseLigaForm, CrearLigaForm
-from .modelos import Usuario, Jugador, Liga, Historico, Partido, ParticipaLiga, Carta, CartaLiga
+from .formularios import SignupForm, SignInForm, UnirseLigaForm, CrearLigaForm, BuscarJugadoresForm
+from .modelos import Usuario, Liga, ParticipaLiga, EstadisticasJugador
+from .tirada import tirada_en_lote, reservar_tirada, tirada_obtenida
+from .ligas import unirse_a_liga, ResultadoUnion
+from .clasificacion import pagina_clasificacion, posicion_en_liga
+from .historial_puntuaciones import clasificacion_en, pagina_clasificacion_en, jornadas_con_clasificacion, \
+    evolucion_puntuacion
+from .estadisticas_jugador import pagina_historico
+from .busqueda_jugadores import buscar_jugadores, opciones_filtros
+from .replicas import solo_lectura
+from .sesion_usuario import usuarios_en_cache
+from .contrasenas import necesita_rehash, HashSaturado
+from .cache_fragmentos import cache_fragmentos, condicional, respuesta_condicional
+from .catalogo import catalogo
+from .coleccion import pagina_coleccion, resumen_coleccion, ORDENES as ORDENES_COLECCION
 from . import db, login_manager
 login_manager.login_view = 'sign_in'
 
@@ -18,7 +29,14 @@ login_manager.login_view = 'sign_in'
 
 @login_manager.user_loader
 def carga_usuario(id_usuario: str):
-    return db.session.get(Usuario, int(id_usuario))
+    # Foto de solo lectura del usuario, cacheada en memoria (ver app/sesion_usuario.py)
+    return usuarios_en_cache.obtener(int(id_usuario))
+
+
+@app.errorhandler(HashSaturado)
+def hash_saturado(error):
+    # Pool de hashes de contraseñas saturado fuera del login y el registro (p. ej. ligas privadas)
+    return "Hay demasiadas peticiones en este momento, inténtalo de nuevo en unos segundos.", 503
 
 
 @app.route('/registrarse', methods=['GET', 'POST'])
@@ -41,7 +59,11 @@ def sign_up():
         # directamente.
         usuario = Usuario(email=form.data["email"],
                           cumple=form.data["cumple"])
-        usuario.password = form.data["password"]
+        try:
+            usuario.password = form.data["password"]
+        except HashSaturado:
+            flash("Hay demasiados registros en este momento, inténtalo de nuevo en unos segundos.")
+            return render_template("sign_up.html", form=form)
 
         # Lo intento añadir a la sesión. Si el email ya existe,
         # se genera una excepción 'IntegrityError'. Otra opción sería haber hecho una consulta para
@@ -92,13 +114,20 @@ def sign_in():
         # mensaje personalizado
         usuario = db.session.scalar(select(Usuario).where(Usuario.email == email))
 
-        if usuario is None:
-            flash("El email introducido no tiene un usuario asociado.")
-        elif not usuario.check_password(password):
-            flash("Contraseña incorrecta.")
-        else:
-            login_user(usuario)
-            return redirect(url_for("tirada_diaria"))
+        try:
+            if usuario is None:
+                flash("El email introducido no tiene un usuario asociado.")
+            elif not usuario.check_password(password):
+                flash("Contraseña incorrecta.")
+            else:
+                # Si el hash se hizo con otro algoritmo o coste, lo rehacemos ahora que tenemos la contraseña
+                if necesita_rehash(usuario.password_hash):
+                    usuario.password = password
+                    db.session.commit()
+                login_user(usuario)
+                return redirect(url_for("tirada_diaria"))
+        except HashSaturado:
+            flash("Hay demasiados accesos en este momento, inténtalo de nuevo en unos segundos.")
 
     return render_template("sign_in.html", form=form)
 
@@ -126,14 +155,8 @@ def perfil_usuario(id_usuario: int):
         .where(ParticipaLiga.id_usuario == id_usuario)
     ).all()
 
-    num_usuarios = {}
-    for liga in ligas:
-        count = db.session.scalar(
-            select(func.count())
-            .select_from(ParticipaLiga)
-            .where(ParticipaLiga.id_liga == liga.id)
-        )
-        num_usuarios[liga.id] = count
+    # El numero de participantes ya viene en cada liga (Liga.num_participantes)
+    num_usuarios = {liga.id: liga.num_participantes for liga in ligas}
 
     return render_template(
         "perfil_usuario.html",
@@ -144,46 +167,79 @@ def perfil_usuario(id_usuario: int):
 
 
 @app.route('/jugadores')
+@solo_lectura
+@condicional("cartas")
 def listar_jugadores():
     # Muestra una página con la lista de jugadores.
     # Devuelve como respuesta el template "lista_jugadores.html"
     # que debéis implementar vosotros mismos, el cual debe recibir
     # como parámetro una página de jugadores.
-    page = db.paginate(select(Jugador))
-    # paginate por defecto son 20, si se quiere más-menos per_page=x
-    # page = db.paginate(select(Jugador), per_page=10)
-    return render_template("lista_jugadores.html", page=page)
+    # Se puede buscar por nombre, filtrar por equipo, posicion y pais y ordenar por nombre,
+    # puntuacion o rareza de la carta (formulario GET). La pagina se pide por cursor.
+    form = BuscarJugadoresForm(request.args)
+    form.cargar_opciones(opciones_filtros())
+    if not form.validate():
+        # Parametros invalidos (p. ej. un equipo que no existe): se muestran los errores en lugar de
+        # una lista sin filtrar que parezca el resultado de la busqueda. Con 400 no se guarda la ETag
+        return render_template("lista_jugadores.html", form=form, resultados=None), 400
+    filtros = {campo: getattr(form, campo).data for campo in ("q", "equipo", "posicion", "pais", "orden")}
+
+    despues, antes = request.args.get("despues"), request.args.get("antes")
+    por_pagina = app.config.get("JUGADORES_POR_PAGINA", 20)
+
+    def generar_resultados():
+        page = buscar_jugadores(**filtros, despues=despues, antes=antes, por_pagina=por_pagina)
+        # Parametros de la busqueda que tienen que mantener los enlaces de la paginacion
+        enlaces = {campo: valor for campo, valor in filtros.items() if valor}
+        return render_template("fragmento_lista_jugadores.html", page=page, filtros=enlaces)
+
+    # La busqueda y el render de los jugadores se cachean hasta que cambian las cartas (puntuacion y rareza)
+    resultados = cache_fragmentos.fragmento("lista_jugadores", ("cartas",),
+                                            (sorted(filtros.items()), despues, antes, por_pagina),
+                                            generar_resultados)
+    return render_template("lista_jugadores.html", form=form, resultados=resultados)
 
 
 @app.route('/perfil_jugador/<int:id_jugador>')
+@solo_lectura
+@condicional("historico")
 def perfil_jugador(id_jugador: int):
     # Muestra el perfil de un jugador de baloncesto.
     # Devuelve un error 404 si el id no está asociado a ningún jugador.
     # Como respuesta, renderiza el template "perfil_jugador.html".
-    jugador = db.first_or_404(
-        select(Jugador)
-        .where(Jugador.id_jugador == id_jugador)
-        .options(selectinload(Jugador.historicos).selectinload(Historico.partido))
-    )
-
-    lista_historico_partido = db.session.execute(
-        select(Historico, Partido)  # macro_mostrar_historico espera una tupla
-        .join(Partido, Historico.id_partido == Partido.id_partido)
-        # SQL: JOIN partido ON historico.id_partido = partido.id_partido; SELECT ... FROM ... JOIN
-        .where(Historico.id_jugador == id_jugador)
-        .order_by(Partido.fecha.desc())
-    ).all()
+    # Las estadisticas agregadas se precalculan al ingestar; el historico se pagina por cursor.
+    # El jugador sale del catalogo en memoria, y las estadisticas y el historico se cachean ya
+    # renderizados hasta la siguiente ingesta
+    jugador = catalogo.jugador(id_jugador)
+    if jugador is None:
+        abort(404)
+    despues, antes = request.args.get("despues"), request.args.get("antes")
+    por_pagina = app.config.get("HISTORICO_POR_PAGINA", 10)
+
+    def generar_detalle():
+        return render_template(
+            "fragmento_perfil_jugador.html",
+            jugador=jugador,
+            estadisticas=db.session.get(EstadisticasJugador, id_jugador),
+            pagina_historico_partido=pagina_historico(id_jugador, despues, antes, por_pagina=por_pagina)
+        )
 
-    return render_template("perfil_jugador.html", jugador=jugador, lista_historico_partido=lista_historico_partido)
+    detalle = cache_fragmentos.fragmento("perfil_jugador", ("historico",),
+                                         (id_jugador, jugador.nombre_equipo, despues, antes, por_pagina),
+                                         generar_detalle)
+    return render_template("perfil_jugador.html", jugador=jugador, detalle=detalle)
 
 
 @app.route('/ligas')
+@solo_lectura
 def mostrar_ligas():
     # Muestra la lista de ligas del sistema.
     # Como puede haber numerosas ligas, se utiliza la paginación de las mismas.
     # Devuelve como respuesta el template "mostrar_ligas.html".
     ligas = db.paginate(
-        select(Liga).options(load_only(Liga.id, Liga.nombre, Liga.numero_participantes_maximo)),
+        select(Liga).options(load_only(Liga.id, Liga.nombre, Liga.numero_participantes_maximo,
+                                       Liga.num_participantes, Liga.password_hash))
+        .order_by(Liga.id),
         per_page=8
     )
 
@@ -192,12 +248,8 @@ def mostrar_ligas():
     #  .session.scalars -> 1 fila, 1 columna: saca un escalar, no necesita .all()
     #  .session.scalars -> n filas, 1 columna: saca varios escalares, necesita .all()
     #  .session.execute -> n filas, n columnas: saca varios resultados (ej. tuplas), necesita .all()
-    # Crear lista tuplas para luego convertir en diccionario {clave:valor(int)}
-    num_per_id = db.session.execute(
-        select(ParticipaLiga.id_liga, func.count())
-        .group_by(ParticipaLiga.id_liga)
-    ).all()
-    num_usuarios = {id_liga: cont for id_liga, cont in num_per_id}    # Un diccionario "num_usuarios" que... (en el template)
+    # Un diccionario "num_usuarios" que... (en el template). Solo las ligas de la pagina, con el contador de la liga
+    num_usuarios = {liga.id: liga.num_participantes for liga in ligas.items}
 
     # Crear lista tuplas con valor vacio y se asigna en el for {clave:valor(bool)}
         # perteneceLiga: lista de todos los idLiga donde si está (boolean = TRUE)
@@ -217,16 +269,27 @@ def mostrar_ligas():
         else:
             participa_liga[liga.id] = False
 
-    # el html espera 3 argumentos
-    return render_template(
-        "mostrar_ligas.html",
-        ligas=ligas,
-        num_usuarios=num_usuarios,
-        participa_liga=participa_liga
+    # Las ligas cambian con cada union, asi que en lugar de una version usamos los propios datos
+    # de la pagina (ya consultados) como clave del fragmento y de la ETag
+    datos_pagina = (
+        ligas.page, ligas.pages, current_user.is_authenticated,
+        tuple((liga.id, liga.nombre, liga.numero_participantes_maximo, liga.num_participantes,
+               liga.password_hash is not None, participa_liga[liga.id]) for liga in ligas.items)
     )
 
+    def generar_pagina():
+        lista_ligas = cache_fragmentos.fragmento(
+            "lista_ligas", (), datos_pagina,
+            lambda: render_template("fragmento_lista_ligas.html", ligas=ligas, num_usuarios=num_usuarios,
+                                    participa_liga=participa_liga)
+        )
+        return render_template("mostrar_ligas.html", ligas=ligas, lista_ligas=lista_ligas)
+
+    return respuesta_condicional(datos_pagina, generar_pagina)
+
 
 @app.route('/liga/<int:id_liga>')
+@solo_lectura
 def mostrar_liga(id_liga: int):
     # Muestra la liga asociada al id "id_liga".
     # Devuelve un error 404 si la liga no existe.
@@ -240,29 +303,69 @@ def mostrar_liga(id_liga: int):
     #  selectinload(...) evita lazy loading, hace una consulta adicional para cargar todos los
     #  usuarios de golpe -> se llama: eager loadin
     #  Resumen: optimiza y evita problema de N+1. Ej. Usar si es equipo.jugador.id, no usar si es equipo.id
-    pagina_participaciones = db.paginate(
-        select(ParticipaLiga)
-        .where(ParticipaLiga.id_liga == id_liga)
-        .order_by(ParticipaLiga.puntuacion_acumulada.desc())
-        .options(selectinload(ParticipaLiga.usuario)),
-        per_page=5
+    # Ahora el email viene en la misma consulta (join) y la pagina se pide por cursor
+    # (puntuacion_acumulada, id_usuario) en lugar de OFFSET, asi todas las paginas cuestan lo mismo
+    pagina_participaciones = pagina_clasificacion(
+        id_liga,
+        despues=request.args.get("despues"),
+        antes=request.args.get("antes"),
+        por_pagina=5
     )
 
-    num_participantes = db.session.scalar(
-        select(func.count())
-        .select_from(ParticipaLiga)
-        .where(ParticipaLiga.id_liga == id_liga)
-    )
+    # "¿Dónde estoy?": posicion del usuario actual en la clasificacion
+    mi_posicion = None
+    if current_user.is_authenticated:
+        mi_posicion = posicion_en_liga(id_liga, current_user.id)
 
     return render_template(
         "mostrar_liga_participante.html",
         liga=liga,
         pagina_participaciones=pagina_participaciones,
-        num_participantes=num_participantes
+        num_participantes=liga.num_participantes,
+        mi_posicion=mi_posicion
+    )
+
+
+@app.route('/liga/<int:id_liga>/historial')
+@solo_lectura
+def historial_liga(id_liga: int):
+    # Clasificacion de la liga en una jornada pasada ("jornada" en la URL, por defecto la ultima
+    # aplicada) y evolucion de la puntuacion del usuario actual en la liga.
+    # La clasificacion sale de la foto guardada al aplicar la jornada y la evolucion del libro de
+    # movimientos (ver app/historial_puntuaciones.py): una consulta indexada cada una
+    liga = db.first_or_404(select(Liga).where(Liga.id == id_liga))
+    jornadas = jornadas_con_clasificacion(id_liga)
+
+    clasificacion = clasificacion_en(id_liga, request.args.get("jornada"))
+    pagina_participaciones = None
+    mi_posicion = None
+    if clasificacion is not None:
+        pagina_participaciones = pagina_clasificacion_en(
+            clasificacion,
+            despues=request.args.get("despues"),
+            antes=request.args.get("antes"),
+            por_pagina=10
+        )
+
+    evolucion = []
+    if current_user.is_authenticated:
+        evolucion = evolucion_puntuacion(current_user.id, id_liga)
+        if clasificacion is not None:
+            mi_posicion = clasificacion.posicion_de(current_user.id)
+
+    return render_template(
+        "clasificacion_historica.html",
+        liga=liga,
+        jornadas=jornadas,
+        clasificacion=clasificacion,
+        pagina_participaciones=pagina_participaciones,
+        mi_posicion=mi_posicion,
+        evolucion=evolucion
     )
 
 
 @app.route('/perfil/<int:id_usuario>/liga/<int:id_liga>/cartas')
+@solo_lectura
 def cartas_usuario_en_liga(id_usuario: int, id_liga: int):
     # Dado un usuario y una liga, se muestran las cartas de ese usuario
     # asociados a esa liga. Si no existe el id del usuario o el de la liga,
@@ -270,35 +373,29 @@ def cartas_usuario_en_liga(id_usuario: int, id_liga: int):
     # Para mostrar las cartas de un usuario en una liga, utilizaremos una
     # paginacion de las mismas. Esta funcion devuelve el template
     # "mostrar_cartas_liga_participante.html."
-    usuario = db.session.get(Usuario, id_usuario)
-    liga = db.session.get(Liga, id_liga)
-    if usuario is None or liga is None:
+    # El resumen de la coleccion sale de una consulta agregada que tambien comprueba que existen el
+    # usuario y la liga, y la pagina (cartas con su jugador) de otra, por cursor y sin COUNT
+    resumen = resumen_coleccion(id_usuario, id_liga)
+    if resumen is None:
         abort(404)
 
-    paginacion_carta_liga = db.paginate(
-        select(CartaLiga)
-        .where(CartaLiga.id_usuario == id_usuario, CartaLiga.id_liga == id_liga),
-        per_page=8
+    orden = request.args.get("orden")
+    if orden not in ORDENES_COLECCION:
+        orden = "rareza"
+    pagina_cartas = pagina_coleccion(
+        id_usuario, id_liga, orden,
+        despues=request.args.get("despues"),
+        antes=request.args.get("antes"),
+        por_pagina=8
     )
 
-    # Para hacer los diccionarios
-    id_cartas = [cl.id_jugador for cl in paginacion_carta_liga.items]
-    cartas = db.session.scalars(
-        select(Carta)
-        .where(Carta.id_jugador.in_(id_cartas))
-        .options(selectinload(Carta.jugador))
-    ).all()
-
-    id2carta = {carta.id_jugador: carta for carta in cartas}
-    id2jugador = {carta.id_jugador: carta.jugador for carta in cartas}
-
     return render_template(
         "mostrar_cartas_liga_participante.html",
         id_usuario=id_usuario,
         id_liga=id_liga,
-        paginacion_carta_liga=paginacion_carta_liga,
-        id2carta=id2carta,
-        id2jugador=id2jugador
+        pagina_cartas=pagina_cartas,
+        resumen=resumen,
+        orden=orden
     )
 
 
@@ -324,51 +421,42 @@ def unirse_liga(id_liga: int):
     #   que el caso anterior. También se le asigna una carta aleatoriamente.
     liga = db.first_or_404(select(Liga).where(Liga.id == id_liga))
 
-    ya_participa = db.session.scalar(
-        select(exists().where(
-            ParticipaLiga.id_usuario == current_user.id,
-            ParticipaLiga.id_liga == id_liga
-        ))
-    )
-    if ya_participa:
+    password = None
+    if liga.password_hash is not None:
+        form = UnirseLigaForm()
+        if not form.validate_on_submit():
+            # Antes de pedir la contraseña comprobamos si ya participa o si esta llena
+            ya_participa = db.session.scalar(
+                select(exists().where(
+                    ParticipaLiga.id_usuario == current_user.id,
+                    ParticipaLiga.id_liga == id_liga
+                ))
+            )
+            if ya_participa:
+                flash("Ya te has unido a esta liga.")
+                return redirect(url_for("mostrar_ligas"))
+            if liga.num_participantes >= liga.numero_participantes_maximo:
+                flash("¡La liga está al máximo!")
+                return redirect(url_for("mostrar_ligas"))
+            return render_template("unirse_liga.html", liga=liga, form=form)
+        password = form.password.data
+
+    # Las comprobaciones (ya participa, liga llena) y la union se hacen a la vez en la base de datos,
+    # para que dos usuarios que se unen a la vez no puedan pasarse del maximo de participantes
+    resultado = unirse_a_liga(current_user.id, liga, password)
+
+    if resultado == ResultadoUnion.PASSWORD_INCORRECTA:
+        flash("Contraseña incorrecta.")
+        return render_template("unirse_liga.html", liga=liga, form=form)
+    elif resultado == ResultadoUnion.YA_PARTICIPA:
         flash("Ya te has unido a esta liga.")
         return redirect(url_for("mostrar_ligas"))
-
-    num_participantes = db.session.scalar(
-        select(func.count())
-        .select_from(ParticipaLiga)
-        .where(ParticipaLiga.id_liga == id_liga)
-    )
-    if num_participantes >= liga.numero_participantes_maximo:
+    elif resultado == ResultadoUnion.LLENA:
         flash("¡La liga está al máximo!")
         return redirect(url_for("mostrar_ligas"))
 
-    if liga.password_hash is None:
-        unirse(current_user.id, id_liga)
-        return redirect(url_for("mostrar_liga", id_liga=liga.id))
-
-    else:
-        form = UnirseLigaForm()
-        if form.validate_on_submit():
-            if not liga.check_password(form.password.data):
-                flash("Contraseña incorrecta.")
-                return render_template("unirse_liga.html", liga=liga, form=form)
-
-            unirse(current_user.id, id_liga)
-            return redirect(url_for("mostrar_liga", id_liga=liga.id))
-
-        return render_template("unirse_liga.html", liga=liga, form=form)
-
-# Para evitar duplicidad de código en unirse_liga (privada y pública)
-def unirse(id_usuario: int, id_liga: int):
-    """
-    Añade al usuario a la liga y le asigna una carta de bienvenida.
-    """
-    db.session.add(ParticipaLiga(id_usuario=id_usuario, id_liga=id_liga))
-    db.session.commit()
-    # Es la carta de bienvenida
-    asignar_carta_aleatoria(id_usuario, id_liga)
     flash("Te has unido correctamente a la liga.")
+    return redirect(url_for("mostrar_liga", id_liga=liga.id))
 
 
 @app.route('/crear_liga', methods=["GET", "POST"])
@@ -397,11 +485,13 @@ def crear_liga():
     if form.validate_on_submit():
         liga = Liga(
             nombre=form.nombre.data,
-            numero_participantes_maximo=form.numero_participantes_maximo.data
+            numero_participantes_maximo=form.numero_participantes_maximo.data,
+            num_participantes=1     # El creador
         )
         liga.password = form.password.data
         db.session.add(liga)
-        db.session.commit()     # No quitar, si se quita al crear ParticipaLiga el id_liga es nulo
+        # El flush da el id de la liga; la liga, su contador y el creador se confirman juntos
+        db.session.flush()
         db.session.add(ParticipaLiga(id_usuario=current_user.id, id_liga=liga.id))
         db.session.commit()
         flash("Se ha creado la liga correctamente.")
@@ -431,7 +521,7 @@ def tirada_diaria():
     # Tirada diaria de cartas.
     # Hay que comprobar que el usuario estaba previamente loggeado.
     # Se debe comprobar que el usuario no ha realizado esta acción previamente en el mismo día.
-    # Si la ha realizado, se redirecciona a su perfil y se muestra el
+    # Si la ha realizado, se muestran las cartas que ya obtuvo y el
     # mensaje flash "Ya has obtenido cartas hoy, vuelve mañana."
     # En caso contrario, por cada liga en la que participa el usuario, se selecciona una carta aleatoria en
     # función de la rareza de las cartas y se le añade a las cartas del usuario. Si el usuario ya tenía esa carta,
@@ -442,85 +532,44 @@ def tirada_diaria():
     if (current_user.ultima_tirada is not None and
             current_user.ultima_tirada == hoy
     ):
-        flash("Ya has obtenido cartas hoy, vuelve mañana.")
-        return redirect(url_for("perfil_usuario", id_usuario=current_user.id))
+        return _tirada_repetida(hoy)
 
     es_cumple = (
             current_user.cumple.month == hoy.month and
             current_user.cumple.day == hoy.day
     )
 
-    ligas_participadas = db.session.scalars(
-        select(ParticipaLiga)
+    ids_liga = db.session.scalars(
+        select(ParticipaLiga.id_liga)
         .where(ParticipaLiga.id_usuario == current_user.id)
     ).all()
 
-    lista_liga_carta = []
-    for participacion in ligas_participadas:
-        liga = db.session.get(Liga, participacion.id_liga)
-        if es_cumple:
-            rarezas = ["comun", "infrecuente", "rara", "mitica"]
-            for rareza in rarezas:
-                carta = asignar_carta_aleatoria(current_user.id, participacion.id_liga, rareza=rareza)
-                lista_liga_carta.append((liga, carta))
-        else:
-            carta = asignar_carta_aleatoria(current_user.id, participacion.id_liga)
-            lista_liga_carta.append((liga, carta))
-
-        participacion.ultima_tirada = datetime.now()
-
-    if not lista_liga_carta:
+    if not ids_liga:
         flash("No participas en ninguna liga. Únete a una para recibir cartas.")
         return redirect(url_for("mostrar_ligas"))
 
-    current_user.ultima_tirada = hoy
-    db.session.commit()
+    # current_user es una foto cacheada: la tirada se reserva con un UPDATE condicional en la base
+    # de datos, y si otra peticion se nos ha adelantado devolvemos las cartas que obtuvo ella
+    if not reservar_tirada(current_user.id, hoy):
+        return _tirada_repetida(hoy)
 
-    return render_template("tirada_diaria.html", lista_liga_carta=lista_liga_carta)
-
-def asignar_carta_aleatoria(id_usuario: int, id_liga: int, rareza: str = None):
-    """
-    Asigna una carta aleatoria.
-    - Si se pasa una rareza como param, se elige una carta de esa rareza (para cumpleaños)
-    - Si ya tenía la carta en esa liga, se le suma una copia
-    """
-    if rareza is None:
-        r = random.random()
-        if r < 0.5:
-            rareza = "comun"
-        elif r < 0.8:
-            rareza = "infrecuente"
-        elif r < 0.95:
-            rareza = "rara"
-        else:
-            rareza = "mitica"
+    # Todas las cartas de todas las ligas se eligen y se guardan de golpe, en una sola transaccion.
+    # Si la tirada de hoy ya estaba preparada (admin_script preparar-tiradas), solo se reclama
+    lista_liga_carta = tirada_en_lote(current_user.id, ids_liga, es_cumple, hoy)
 
-    # Dada la rareza pilla todas las cartas de esa rareza
-    cartas_disponibles = db.session.scalars(
-        select(Carta)
-        .where(Carta.rareza == rareza)
-    ).all()
-
-    carta = random.choice(cartas_disponibles)
-    # Comprueba si la carta está o no en la liga del usuario
-    carta_liga = db.session.scalar(
-        select(CartaLiga)
-        .where(CartaLiga.id_usuario == id_usuario,
-               CartaLiga.id_liga == id_liga,
-               CartaLiga.id_jugador == carta.id_jugador)
-    )
+    # Renderizamos antes del commit: despues del commit los objetos caducan y el template
+    # volveria a consultar cada liga por separado
+    respuesta = render_template("tirada_diaria.html", lista_liga_carta=lista_liga_carta)
+    db.session.commit()
 
-    if carta_liga:
-        carta_liga.copias += 1
-    else:
-        nueva = CartaLiga(
-            id_usuario=id_usuario,
-            id_liga=id_liga,
-            id_jugador=carta.id_jugador,
-            numero_copias=1
-        )
-        db.session.add(nueva)
+    return respuesta
 
-    db.session.commit()
 
-    return carta
\ No newline at end of file
+def _tirada_repetida(hoy):
+    # Tirada de hoy ya hecha: se devuelven las mismas cartas con una sola lectura
+    flash("Ya has obtenido cartas hoy, vuelve mañana.")
+    lista_liga_carta = tirada_obtenida(current_user.id, hoy)
+    if not lista_liga_carta:
+        # Tirada hecha antes de guardarse las cartas obtenidas
+        return redirect(url_for("perfil_usuario", id_usuario=current_user.id))
+    return render_template("tirada_diaria.html", lista_liga_carta=lista_liga_carta, repetida=True)
@@ -0,0 +1,122 @@
+"""
+Cache de los usuarios conectados.
+
+Flask-Login carga el usuario de la sesion en cada peticion. En lugar de leer la fila completa de
+Usuario (con password_hash) cada vez, guardamos por proceso una foto compacta y de solo lectura
+del usuario (UsuarioSesion: id, email, cumple y ultima_tirada) durante USUARIOS_CACHE_TTL segundos.
+Las vistas que modifican el usuario piden el objeto del ORM con current_user.cargar().
+
+La foto de un usuario se descarta en cuanto se modifica o se borra su fila desde este proceso
+(al hacer flush y otra vez al hacer commit, para no quedarnos con la version anterior al commit).
+Los UPDATE directos sobre un usuario avisan con usuarios_modificados(). Los cambios hechos desde
+otro proceso o con UPDATE masivos se ven como mucho pasado el TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from flask import current_app
+from flask_login import UserMixin
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session
+from . import db
+from .modelos import Usuario
+
+
+class UsuarioSesion(UserMixin):
+    """
+    Foto de solo lectura de un usuario conectado
+    """
+    __slots__ = ("id", "email", "cumple", "ultima_tirada")
+
+    def __init__(self, id: int, email: str, cumple, ultima_tirada):
+        for campo, valor in zip(self.__slots__, (id, email, cumple, ultima_tirada)):
+            object.__setattr__(self, campo, valor)
+
+    def __setattr__(self, campo, valor):
+        raise AttributeError("El usuario de la sesion es de solo lectura: usa current_user.cargar()")
+
+    def cargar(self) -> Optional[Usuario]:
+        """
+        Objeto Usuario del ORM, para las vistas que lo modifican
+        """
+        return db.session.get(Usuario, self.id)
+
+
+class CacheUsuarios:
+    """
+    Fotos de los usuarios por id, con caducidad y un numero maximo de entradas (LRU)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usuarios = OrderedDict()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, id_usuario: int) -> Optional[UsuarioSesion]:
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._usuarios.get(id_usuario)
+            if entrada is not None and ahora - entrada[0] < current_app.config.get("USUARIOS_CACHE_TTL", 60):
+                self._usuarios.move_to_end(id_usuario)
+                self.aciertos += 1
+                return entrada[1]
+            self.fallos += 1
+
+        fila = db.session.execute(
+            select(Usuario.id, Usuario.email, Usuario.cumple, Usuario.ultima_tirada)
+            .where(Usuario.id == id_usuario)
+        ).one_or_none()
+        if fila is None:
+            return None
+        usuario = UsuarioSesion(*fila)
+        with self._lock:
+            self._usuarios[id_usuario] = (ahora, usuario)
+            self._usuarios.move_to_end(id_usuario)
+            while len(self._usuarios) > current_app.config.get("USUARIOS_CACHE_MAXIMO", 10000):
+                self._usuarios.popitem(last=False)
+        return usuario
+
+    def invalidar(self, *ids_usuario: int) -> None:
+        with self._lock:
+            for id_usuario in ids_usuario:
+                self._usuarios.pop(id_usuario, None)
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._usuarios.clear()
+
+    def estadisticas(self) -> dict:
+        return {"aciertos": self.aciertos, "fallos": self.fallos, "usuarios": len(self._usuarios)}
+
+
+usuarios_en_cache = CacheUsuarios()
+
+
+def usuarios_modificados(session: Session, *ids_usuario: int) -> None:
+    """
+    Descarta las fotos de esos usuarios, ahora y otra vez al hacer commit. Lo usan los eventos
+    del ORM y las vistas que modifican usuarios con un UPDATE directo.
+    """
+    if ids_usuario:
+        usuarios_en_cache.invalidar(*ids_usuario)
+        session.info.setdefault("usuarios_modificados", set()).update(ids_usuario)
+
+
+@event.listens_for(Session, "after_flush")
+def _usuarios_modificados(session, contexto):
+    usuarios_modificados(session, *{objeto.id for objeto in (*session.dirty, *session.deleted)
+                                    if isinstance(objeto, Usuario)})
+
+
+@event.listens_for(Session, "after_commit")
+def _usuarios_confirmados(session):
+    ids = session.info.pop("usuarios_modificados", None)
+    if ids:
+        usuarios_en_cache.invalidar(*ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _usuarios_descartados(session):
+    session.info.pop("usuarios_modificados", None)
@@ -0,0 +1,167 @@
+"""
+Motor de tiradas de cartas en lote.
+
+En lugar de hacer una consulta y un commit por cada carta, se eligen primero todas las cartas
+(con el pool en memoria), y despues se aplican todas las copias con un unico upsert y se
+cargan las ligas necesarias con una consulta (las cartas salen del catalogo en memoria). Asi el
+numero de consultas de una tirada no depende del numero de ligas del usuario.
+
+La tirada de cada dia se reserva con un UPDATE condicional de usuario.ultima_tirada antes de
+elegir nada, y sus cartas se guardan en tirada_obtenida con (fecha, id_usuario) como clave de
+idempotencia: si llegan varias peticiones a la vez (doble click, reintentos, dos pestañas) solo
+una tira, y las demas devuelven las cartas ya obtenidas con una sola lectura.
+"""
+import datetime
+import random
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import select, delete, update
+from . import db
+from .modelos import Usuario, Liga, Carta, CartaLiga, TiradaPreparada, TiradaObtenida
+from .pool_cartas import pool_cartas
+from .catalogo import catalogo
+from .sesion_usuario import usuarios_modificados
+from .utilidades_bd import insert_con_conflicto
+
+# En el cumpleaños se obtiene una carta de cada rareza, en este orden
+RAREZAS = ["comun", "infrecuente", "rara", "mitica"]
+
+
+def elegir_rareza() -> str:
+    """
+    Elige una rareza segun sus probabilidades: 50% comun, 30% infrecuente, 15% rara y 5% mitica
+    """
+    r = random.random()
+    if r < 0.5:
+        return "comun"
+    elif r < 0.8:
+        return "infrecuente"
+    elif r < 0.95:
+        return "rara"
+    return "mitica"
+
+
+def elegir_cartas(ids_liga: Iterable[int], es_cumple: bool) -> List[Tuple[int, int]]:
+    """
+    Elige las cartas de una tirada. Devuelve una lista de tuplas (id_liga, id_jugador)
+    """
+    tiradas = []
+    for id_liga in ids_liga:
+        rarezas = RAREZAS if es_cumple else [elegir_rareza()]
+        for rareza in rarezas:
+            tiradas.append((id_liga, pool_cartas.elegir(rareza)))
+    return tiradas
+
+
+def sumar_copias(id_usuario: int, copias: Dict[Tuple[int, int], int]) -> None:
+    """
+    Suma las copias {(id_liga, id_jugador): numero} a las cartas del usuario con un unico upsert
+    (INSERT ... ON CONFLICT DO UPDATE numero_copias = numero_copias + n). No hace commit.
+    """
+    if not copias:
+        return
+    stmt = insert_con_conflicto(CartaLiga)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CartaLiga.id_liga, CartaLiga.id_usuario, CartaLiga.id_jugador],
+        set_={"numero_copias": CartaLiga.numero_copias + stmt.excluded.numero_copias}
+    )
+    db.session.execute(stmt, [
+        {"id_liga": id_liga, "id_usuario": id_usuario, "id_jugador": id_jugador, "numero_copias": n}
+        for (id_liga, id_jugador), n in copias.items()
+    ])
+
+
+def reclamar_tirada_preparada(id_usuario: int, fecha: datetime.date) -> List[Tuple[int, int]]:
+    """
+    Reclama la tirada precalculada del usuario para "fecha" (ver app/tiradas_preparadas.py): borra
+    sus filas y devuelve la lista de (id_liga, id_jugador), vacia si no habia. Es un unico DELETE por
+    clave primaria, asi que dos peticiones a la vez no pueden reclamar la misma tirada. No hace commit.
+    """
+    filas = db.session.execute(
+        delete(TiradaPreparada)
+        .where(TiradaPreparada.fecha == fecha, TiradaPreparada.id_usuario == id_usuario)
+        .returning(TiradaPreparada.id_liga, TiradaPreparada.posicion, TiradaPreparada.id_jugador)
+    ).all()
+    return [(id_liga, id_jugador) for id_liga, _, id_jugador in sorted(filas)]
+
+
+def reservar_tirada(id_usuario: int, fecha: datetime.date) -> bool:
+    """
+    Reserva la tirada de "fecha" del usuario con un UPDATE condicional (ultima_tirada = fecha si
+    era distinta). Solo una de varias peticiones a la vez lo consigue: las demas esperan al bloqueo
+    de la fila y, tras el commit de la primera, ya no cumplen la condicion. Devuelve si se ha
+    reservado. No hace commit: si la tirada falla, el rollback deshace tambien la reserva.
+    """
+    reservadas = db.session.execute(
+        update(Usuario)
+        .where(Usuario.id == id_usuario, Usuario.ultima_tirada.is_distinct_from(fecha))
+        .values(ultima_tirada=fecha)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    usuarios_modificados(db.session, id_usuario)
+    return reservadas == 1
+
+
+def tirada_en_lote(id_usuario: int, ids_liga: List[int], es_cumple: bool,
+                   fecha: datetime.date) -> List[Tuple[Liga, Carta]]:
+    """
+    Hace la tirada de "fecha" del usuario en todas sus ligas a la vez (ya reservada con
+    reservar_tirada) y devuelve la lista de tuplas (Liga, Carta) que espera el template
+    "tirada_diaria.html". Si hay una tirada preparada para ese dia, se usan sus cartas; las ligas
+    que no tengan (p. ej. si el usuario se unio despues de prepararla) se tiran en el momento. Las
+    cartas obtenidas se guardan en tirada_obtenida para devolverlas si se repite la peticion. No
+    hace commit: todo se confirma en una unica transaccion junto con la reserva.
+    """
+    preparadas = reclamar_tirada_preparada(id_usuario, fecha)
+    # Las ligas que el usuario haya dejado desde que se preparo la tirada se descartan
+    tiradas = [(id_liga, id_jugador) for id_liga, id_jugador in preparadas if id_liga in ids_liga]
+    ligas_preparadas = {id_liga for id_liga, _ in tiradas}
+    tiradas += elegir_cartas([id_liga for id_liga in ids_liga if id_liga not in ligas_preparadas], es_cumple)
+    sumar_copias(id_usuario, Counter(tiradas))
+
+    posiciones = Counter()
+    filas = []
+    for id_liga, id_jugador in tiradas:
+        filas.append({"fecha": fecha, "id_usuario": id_usuario, "id_liga": id_liga,
+                      "posicion": posiciones[id_liga], "id_jugador": id_jugador})
+        posiciones[id_liga] += 1
+    if filas:
+        # Si se ha reiniciado ultima_tirada a mano, la nueva tirada sustituye a la guardada
+        stmt = insert_con_conflicto(TiradaObtenida)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[TiradaObtenida.fecha, TiradaObtenida.id_usuario, TiradaObtenida.id_liga,
+                            TiradaObtenida.posicion],
+            set_={"id_jugador": stmt.excluded.id_jugador}
+        ), filas)
+    return cargar_ligas_cartas(tiradas)
+
+
+def tirada_obtenida(id_usuario: int, fecha: datetime.date) -> List[Tuple[Liga, Carta]]:
+    """
+    Cartas que ya obtuvo el usuario en la tirada de "fecha", como (Liga, Carta), con una unica
+    consulta. Lista vacia si no hay ninguna guardada.
+    """
+    filas = db.session.execute(
+        select(Liga, TiradaObtenida.id_jugador)
+        .join(TiradaObtenida, TiradaObtenida.id_liga == Liga.id)
+        .where(TiradaObtenida.fecha == fecha, TiradaObtenida.id_usuario == id_usuario)
+        .order_by(TiradaObtenida.id_liga, TiradaObtenida.posicion)
+    ).all()
+    id2carta = catalogo.cartas(id_jugador for _, id_jugador in filas)
+    return [(liga, id2carta[id_jugador]) for liga, id_jugador in filas]
+
+
+def cargar_ligas_cartas(tiradas: List[Tuple[int, int]]) -> List[Tuple[Liga, Carta]]:
+    """
+    Carga en una consulta las ligas de una lista de (id_liga, id_jugador), con las fichas de las
+    cartas del catalogo
+    """
+    if not tiradas:
+        return []
+    ligas = db.session.scalars(
+        select(Liga).where(Liga.id.in_({id_liga for id_liga, _ in tiradas}))
+    ).all()
+    id2liga = {liga.id: liga for liga in ligas}
+    # Las cartas y sus jugadores salen del catalogo en memoria, sin consultar la base de datos
+    id2carta = catalogo.cartas(id_jugador for _, id_jugador in tiradas)
+    return [(id2liga[id_liga], id2carta[id_jugador]) for id_liga, id_jugador in tiradas]
@@ -0,0 +1,117 @@
+"""
+Preparacion de las tiradas diarias del dia siguiente.
+
+A medianoche todos los usuarios activos piden su tirada a la vez. Para que esas peticiones solo
+tengan que reclamar cartas ya elegidas (un DELETE ... RETURNING por clave primaria, ver
+reclamar_tirada_preparada en app/tirada.py), un proceso programado (admin_script preparar-tiradas,
+p. ej. desde cron cada noche) elige antes las cartas de cada usuario activo y las guarda en
+tirada_preparada, con las mismas probabilidades por rareza y la regla del cumpleaños que la tirada
+en el momento.
+
+Los usuarios se reparten en bloques de ids que preparan varios hilos a la vez, cada uno con su
+propia sesion y un commit por bloque. Las filas se insertan con ON CONFLICT DO NOTHING, asi que
+si el proceso se interrumpe se puede volver a lanzar: los bloques ya preparados se quedan como
+estaban y se completan los que faltan. Los usuarios sin tirada preparada (inactivos, o que se
+unen a una liga despues) siguen tirando en el momento.
+"""
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional
+from flask import current_app
+from sqlalchemy import select, delete, or_
+from . import db
+from .modelos import Usuario, ParticipaLiga, TiradaPreparada, TiradaObtenida
+from .tirada import elegir_cartas
+from .utilidades_bd import insert_con_conflicto
+
+
+def usuarios_activos(fecha: datetime.date, dias_activo: int) -> List[int]:
+    """
+    Ids de los usuarios que participan en alguna liga, han tirado en los ultimos "dias_activo" dias
+    antes de "fecha" (o no han tirado nunca) y aun no han hecho la tirada de "fecha"
+    """
+    desde = fecha - datetime.timedelta(days=dias_activo)
+    return list(db.session.scalars(
+        select(Usuario.id)
+        .where(Usuario.id.in_(select(ParticipaLiga.id_usuario)),
+               or_(Usuario.ultima_tirada.is_(None),
+                   Usuario.ultima_tirada.between(desde, fecha - datetime.timedelta(days=1))))
+        .order_by(Usuario.id)
+    ))
+
+
+def _preparar_bloque(app, fecha: datetime.date, ids_usuario: List[int]) -> int:
+    """
+    Elige y guarda las tiradas de "fecha" de un bloque de usuarios, en su propia sesion y con un
+    unico commit. Devuelve el numero de cartas nuevas preparadas.
+    """
+    with app.app_context():
+        participaciones = db.session.execute(
+            select(ParticipaLiga.id_usuario, ParticipaLiga.id_liga, Usuario.cumple)
+            .join(Usuario, Usuario.id == ParticipaLiga.id_usuario)
+            .where(ParticipaLiga.id_usuario.in_(ids_usuario))
+            .order_by(ParticipaLiga.id_usuario, ParticipaLiga.id_liga)
+        ).all()
+
+        filas = []
+        for id_usuario, id_liga, cumple in participaciones:
+            es_cumple = cumple.month == fecha.month and cumple.day == fecha.day
+            for posicion, (_, id_jugador) in enumerate(elegir_cartas([id_liga], es_cumple)):
+                filas.append({"fecha": fecha, "id_usuario": id_usuario, "id_liga": id_liga,
+                              "posicion": posicion, "id_jugador": id_jugador})
+        preparadas = 0
+        if filas:
+            # RETURNING solo devuelve las filas insertadas: las que ya estaban (al reanudar) no cuentan
+            preparadas = len(db.session.execute(
+                insert_con_conflicto(TiradaPreparada).on_conflict_do_nothing().returning(TiradaPreparada.fecha), filas
+            ).all())
+        db.session.commit()
+        return preparadas
+
+
+def preparar_tiradas(fecha: datetime.date = None, tam_bloque: int = None, hilos: int = None,
+                     progreso: Optional[Callable[[int, int], None]] = None) -> dict:
+    """
+    Prepara las tiradas de "fecha" (por defecto, mañana) de todos los usuarios activos, y borra las
+    tiradas preparadas que nadie reclamo y las cartas obtenidas (ver tirada_obtenida en
+    app/tirada.py) de dias anteriores. Tras cada bloque llama a progreso(usuarios_hechos,
+    usuarios_totales). Devuelve un resumen con los usuarios, las cartas nuevas preparadas, los
+    segundos empleados y los usuarios por segundo.
+    """
+    fecha = fecha or datetime.date.today() + datetime.timedelta(days=1)
+    tam_bloque = tam_bloque or current_app.config.get("TIRADAS_PREPARADAS_BLOQUE", 500)
+    hilos = hilos or current_app.config.get("TIRADAS_PREPARADAS_HILOS", 4)
+    inicio = time.perf_counter()
+
+    caducadas = db.session.execute(
+        delete(TiradaPreparada).where(TiradaPreparada.fecha < datetime.date.today())
+    ).rowcount
+    # Las cartas obtenidas solo hacen falta para responder a las peticiones repetidas del mismo dia
+    db.session.execute(delete(TiradaObtenida).where(TiradaObtenida.fecha < datetime.date.today()))
+    db.session.commit()
+
+    ids_usuario = usuarios_activos(fecha, current_app.config.get("TIRADAS_PREPARADAS_DIAS_ACTIVO", 7))
+    bloques = [ids_usuario[i:i + tam_bloque] for i in range(0, len(ids_usuario), tam_bloque)]
+
+    app = current_app._get_current_object()
+    cartas = 0
+    hechos = 0
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        futuros = {ejecutor.submit(_preparar_bloque, app, fecha, bloque): len(bloque) for bloque in bloques}
+        for futuro in as_completed(futuros):
+            cartas += futuro.result()
+            hechos += futuros[futuro]
+            if progreso is not None:
+                progreso(hechos, len(ids_usuario))
+
+    segundos = time.perf_counter() - inicio
+    return {
+        "fecha": fecha,
+        "usuarios": len(ids_usuario),
+        "bloques": len(bloques),
+        "cartas": cartas,
+        "caducadas": caducadas,
+        "segundos": segundos,
+        "usuarios_por_segundo": len(ids_usuario) / segundos if segundos else 0.0,
+    }
@@ -0,0 +1,347 @@
+"""
+Trabajos en segundo plano de admin_script, repartidos en fragmentos entre varios procesos.
+
+Cada trabajo (TRABAJOS) reparte su trabajo por rangos de ids de liga o de jugador: los fragmentos
+[desde, hasta) son independientes entre si, asi que se pueden ejecutar a la vez en un pool de
+TRABAJOS_PROCESOS procesos, cada uno con su propia conexion. Un trabajo tiene tres pasos:
+    1. preparar(parametros): en el proceso principal, calcula la clave de la ejecucion y el
+       contexto que necesitan los fragmentos (jornada, marcas de agua...).
+    2. fragmento(contexto, desde, hasta): en los procesos del pool, hace el trabajo de un rango
+       sin commit. El commit lo hace el ejecutor junto con el punto de control del fragmento
+       (tabla fragmento_trabajo), en la misma transaccion.
+    3. terminar(contexto, filas): en el proceso principal, cuando todos los fragmentos estan
+       hechos (registra la jornada, incrementa versiones...).
+
+Si algun fragmento falla, el resto sigue adelante y el trabajo queda a medias: al volver a lanzarlo
+con los mismos parametros solo se ejecutan los fragmentos que no estan hechos. Por cada fragmento
+se informa de las filas, los segundos y el proceso que lo ha ejecutado, y al final de la suma del
+tiempo de los fragmentos frente al tiempo real (lo que se gana al añadir procesos).
+
+En la ingesta ("ingestar"), los partidos se ingestan al preparar el trabajo y el fichero de
+historicos se reparte por id_jugador: cada fragmento lee el fichero entero, pero solo valida y
+escribe las lineas de sus jugadores y actualiza sus estadisticas.
+
+Los procesos se crean con "fork" (admin_script no tiene un bloque __main__ que se pueda volver a
+importar) despues de cerrar las conexiones abiertas, y cada uno abre las suyas.
+"""
+import datetime
+import hashlib
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Optional
+from flask import current_app
+from sqlalchemy import select, update, delete, func
+from . import db
+from .modelos import Liga, Jugador, FragmentoTrabajo
+from .ingesta import ingestar_ficheros, ingestar_historicos_rango, TAM_BLOQUE
+from .puntuaciones import jornada_de_hoy, preparar_jornada, aplicar_jornada, registrar_jornada
+from .puntuacion_cartas import marca_puntuacion, nueva_marca_puntuacion, puntuar_rango, registrar_puntuacion
+from .ligas import corregir_contadores
+from .estadisticas_jugador import actualizar_rango, CLAVE_VERSION as VERSION_HISTORICO
+from .versiones import incrementar_version
+
+
+class Trabajo:
+    """
+    Definicion de un trabajo: columna cuyos ids se reparten en fragmentos y sus tres pasos
+    """
+
+    def __init__(self, columna, preparar: Callable, fragmento: Callable, terminar: Callable):
+        self.columna = columna
+        self.preparar = preparar
+        self.fragmento = fragmento
+        self.terminar = terminar
+
+
+def _marca(valor: Optional[datetime.datetime]) -> str:
+    return valor.isoformat(timespec="seconds") if valor is not None else "-"
+
+
+# --- recomputar-jornada: puntos de la jornada y clasificacion, por ligas ---
+
+def _preparar_recomputo(parametros: dict):
+    jornada = parametros.get("jornada") or jornada_de_hoy()
+    marcas = preparar_jornada(jornada, parametros.get("incremental", False), parametros.get("forzar", False))
+    if marcas is None:
+        return f"recomputar-jornada:{jornada}", None
+    clave = f"recomputar-jornada:{jornada}:{_marca(marcas['marca'])}:{_marca(marcas['nueva_marca'])}"
+    return clave, {"jornada": jornada, **marcas}
+
+
+def _terminar_recomputo(contexto: dict, filas: int) -> dict:
+    registrar_jornada(contexto["jornada"], contexto["nueva_marca"])
+    return {"jornada": contexto["jornada"],
+            "modo": "incremental" if contexto["marca"] is not None else "completa"}
+
+
+# --- puntuar-cartas: puntuacion de las cartas, por jugadores ---
+
+def _preparar_puntuacion(parametros: dict):
+    marca = None if parametros.get("completo") else marca_puntuacion()
+    nueva_marca = nueva_marca_puntuacion()
+    clave = f"puntuar-cartas:{_marca(marca)}:{_marca(nueva_marca)}"
+    return clave, {"marca": marca, "nueva_marca": nueva_marca}
+
+
+def _terminar_puntuacion(contexto: dict, filas: int) -> dict:
+    registrar_puntuacion(contexto["nueva_marca"], filas > 0)
+    return {}
+
+
+# --- estadisticas-jugadores: estadisticas agregadas, por jugadores ---
+
+def _preparar_estadisticas(parametros: dict):
+    ids = parametros.get("ids_jugador")
+    if ids is None:
+        return "estadisticas-jugadores", {"ids_jugador": None}
+    ids = sorted(set(ids))
+    if not ids:
+        return "estadisticas-jugadores", None
+    resumen = hashlib.sha1(",".join(map(str, ids)).encode()).hexdigest()[:12]
+    return f"estadisticas-jugadores:{len(ids)}:{resumen}", {"ids_jugador": ids}
+
+
+def _terminar_estadisticas(contexto: dict, filas: int) -> dict:
+    if filas:
+        # Despues de confirmar todos los fragmentos: quien lea la nueva version ya ve los datos nuevos
+        incrementar_version(VERSION_HISTORICO)
+        db.session.commit()
+    return {}
+
+
+# --- ingestar: fichero de historicos, por jugadores ---
+
+def _fichero(ruta: Optional[str]) -> str:
+    # Identifica el contenido del fichero: si cambia, la ingesta es otra ejecucion
+    if not ruta:
+        return "-"
+    estado = os.stat(ruta)
+    return f"{os.path.abspath(ruta)}@{estado.st_size}:{int(estado.st_mtime)}"
+
+
+def _preparar_ingesta(parametros: dict):
+    ruta_partidos, ruta_historicos = parametros.get("ruta_partidos"), parametros.get("ruta_historicos")
+    tam_bloque = parametros.get("tam_bloque") or TAM_BLOQUE
+    clave = f"ingestar:{_fichero(ruta_partidos)}:{_fichero(ruta_historicos)}"
+    afectados = set()
+    if ruta_partidos:
+        # Los partidos son pocos y los historicos los referencian: se ingestan antes, en este proceso
+        ingesta = ingestar_ficheros(ruta_partidos, None, tam_bloque, estadisticas=False)
+        for ruta, num_linea, motivo in ingesta["rechazadas"]:
+            current_app.logger.warning("Rechazada %s:%s: %s", ruta, num_linea, motivo)
+        afectados = ingesta["jugadores_afectados"]
+    if not ruta_historicos and not afectados:
+        return clave, None
+    limites = tuple(db.session.execute(select(func.min(Jugador.id_jugador), func.max(Jugador.id_jugador))).one())
+    return clave, {"ruta_historicos": ruta_historicos, "tam_bloque": tam_bloque, "limites": limites,
+                   "afectados": sorted(afectados)}
+
+
+def _fragmento_ingesta(contexto: dict, desde: int, hasta: int) -> int:
+    filas, afectados = 0, set(contexto["afectados"])
+    if contexto["ruta_historicos"]:
+        # El primer fragmento se encarga tambien de las lineas que no son de ningun fragmento
+        ingesta = ingestar_historicos_rango(contexto["ruta_historicos"], desde, hasta, contexto["tam_bloque"],
+                                            contexto["limites"] if desde == contexto["limites"][0] else None)
+        for ruta, num_linea, motivo in ingesta["rechazadas"]:
+            current_app.logger.warning("Rechazada %s:%s: %s", ruta, num_linea, motivo)
+        filas, afectados = ingesta["filas"], afectados | ingesta["jugadores_afectados"]
+    # Las estadisticas de los jugadores del fragmento, en la misma transaccion que sus historicos
+    actualizar_rango(desde, hasta, afectados)
+    return filas
+
+
+def _terminar_ingesta(contexto: dict, filas: int) -> dict:
+    return _terminar_estadisticas(contexto, filas or len(contexto["afectados"]))
+
+
+TRABAJOS = {
+    "ingestar": Trabajo(Jugador.id_jugador, _preparar_ingesta, _fragmento_ingesta, _terminar_ingesta),
+    "recomputar-jornada": Trabajo(
+        Liga.id, _preparar_recomputo,
+        lambda contexto, desde, hasta: aplicar_jornada(contexto["jornada"], desde, hasta, contexto["marca"]),
+        _terminar_recomputo,
+    ),
+    "puntuar-cartas": Trabajo(
+        Jugador.id_jugador, _preparar_puntuacion,
+        lambda contexto, desde, hasta: len(puntuar_rango(contexto["marca"], desde, hasta)["modificados"]),
+        _terminar_puntuacion,
+    ),
+    "reconstruir-contadores": Trabajo(
+        Liga.id, lambda parametros: ("reconstruir-contadores", {}),
+        lambda contexto, desde, hasta: corregir_contadores(desde, hasta),
+        lambda contexto, filas: {},
+    ),
+    "estadisticas-jugadores": Trabajo(
+        Jugador.id_jugador, _preparar_estadisticas,
+        lambda contexto, desde, hasta: actualizar_rango(desde, hasta, contexto["ids_jugador"]),
+        _terminar_estadisticas,
+    ),
+}
+
+
+# --- Ejecucion de los fragmentos ---
+
+# Aplicacion con la que trabajan los fragmentos en los procesos del pool (o en el propio proceso)
+_app = None
+
+
+def _iniciar_proceso(app) -> None:
+    global _app
+    _app = app
+    # Las conexiones del proceso padre (si quedara alguna) no se pueden compartir: cada proceso abre las suyas
+    with app.app_context():
+        for motor in db.engines.values():
+            motor.dispose(close=False)
+
+
+def _ejecutar_fragmento(nombre: str, clave: str, contexto: dict, desde: int, hasta: int) -> dict:
+    """
+    Ejecuta un fragmento y marca su punto de control como hecho en la misma transaccion
+    """
+    with _app.app_context():
+        inicio = time.perf_counter()
+        resultado = {"desde": desde, "hasta": hasta, "proceso": os.getpid(), "filas": None, "error": None}
+        try:
+            filas = TRABAJOS[nombre].fragmento(contexto, desde, hasta)
+            resultado["segundos"] = time.perf_counter() - inicio
+            db.session.execute(
+                update(FragmentoTrabajo)
+                .where(FragmentoTrabajo.trabajo == clave, FragmentoTrabajo.desde == desde)
+                .values(estado="hecho", filas=filas, segundos=resultado["segundos"], error=None,
+                        terminado_en=datetime.datetime.now())
+            )
+            db.session.commit()
+            resultado["filas"] = filas
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception("Fallo en el fragmento [%s, %s) de %s", desde, hasta, clave)
+            resultado["segundos"] = time.perf_counter() - inicio
+            resultado["error"] = f"{type(e).__name__}: {e}"
+        return resultado
+
+
+def _rangos(columna, num_fragmentos: int) -> list:
+    """
+    Reparte los ids de "columna" en num_fragmentos rangos [desde, hasta) del mismo ancho
+    """
+    minimo, maximo = db.session.execute(select(func.min(columna), func.max(columna))).one()
+    if minimo is None:
+        return []
+    paso = max(1, math.ceil((maximo - minimo + 1) / num_fragmentos))
+    return [(desde, desde + paso) for desde in range(minimo, maximo + 1, paso)]
+
+
+def _fragmentos(clave: str, columna, num_fragmentos: int) -> list:
+    """
+    Puntos de control de la ejecucion: los de una ejecucion anterior a medias (para reanudarla) o,
+    si no la hay, los de una nueva
+    """
+    existentes = db.session.scalars(
+        select(FragmentoTrabajo).where(FragmentoTrabajo.trabajo == clave).order_by(FragmentoTrabajo.desde)
+    ).all()
+    if existentes and any(fragmento.estado != "hecho" for fragmento in existentes):
+        return [(f.desde, f.hasta, f.estado) for f in existentes]
+
+    db.session.execute(delete(FragmentoTrabajo).where(FragmentoTrabajo.trabajo == clave))
+    rangos = _rangos(columna, num_fragmentos)
+    db.session.add_all(FragmentoTrabajo(trabajo=clave, desde=desde, hasta=hasta, estado="pendiente")
+                       for desde, hasta in rangos)
+    db.session.commit()
+    return [(desde, hasta, "pendiente") for desde, hasta in rangos]
+
+
+def ejecutar_trabajo(nombre: str, parametros: dict = None, procesos: int = None, fragmentos: int = None,
+                     progreso: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Ejecuta (o reanuda) el trabajo "nombre" de TRABAJOS con "procesos" procesos (por defecto
+    TRABAJOS_PROCESOS; 0 para hacerlo en este proceso) y "fragmentos" fragmentos (por defecto
+    TRABAJOS_FRAGMENTOS_POR_PROCESO por proceso). Tras cada fragmento llama a progreso() con su
+    resultado (desde, hasta, filas, segundos, proceso, error, hechos, total). Devuelve un resumen
+    con el estado ("completado", "fallido" o "nada que hacer"), los fragmentos, las filas, el tiempo
+    real y la suma del tiempo de los fragmentos.
+    """
+    definicion = TRABAJOS[nombre]
+    procesos = current_app.config.get("TRABAJOS_PROCESOS", 0) if procesos is None else procesos
+    fragmentos = fragmentos or max(procesos, 1) * current_app.config.get("TRABAJOS_FRAGMENTOS_POR_PROCESO", 4)
+    inicio = time.perf_counter()
+
+    clave, contexto = definicion.preparar(parametros or {})
+    if contexto is None:
+        return {"trabajo": clave, "estado": "nada que hacer"}
+
+    puntos_control = _fragmentos(clave, definicion.columna, fragmentos)
+    pendientes = [(desde, hasta) for desde, hasta, estado in puntos_control if estado != "hecho"]
+    hechos = len(puntos_control) - len(pendientes)
+    resumen = {"trabajo": clave, "fragmentos": len(puntos_control), "reanudados": hechos,
+               "fallidos": [], "procesos": procesos}
+
+    def registrar(resultado: dict) -> None:
+        nonlocal hechos
+        if resultado["error"] is None:
+            hechos += 1
+        else:
+            resumen["fallidos"].append(resultado)
+        if progreso is not None:
+            progreso({**resultado, "hechos": hechos, "total": len(puntos_control)})
+
+    global _app
+    app = current_app._get_current_object()
+    if procesos == 0:
+        _app = app
+        for desde, hasta in pendientes:
+            registrar(_ejecutar_fragmento(nombre, clave, contexto, desde, hasta))
+    else:
+        # Ninguna conexion abierta al hacer fork: cada proceso abre las suyas
+        db.session.remove()
+        for motor in db.engines.values():
+            motor.dispose()
+        with ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_iniciar_proceso, initargs=(app,)) as ejecutor:
+            futuros = [ejecutor.submit(_ejecutar_fragmento, nombre, clave, contexto, desde, hasta)
+                       for desde, hasta in pendientes]
+            for futuro in as_completed(futuros):
+                registrar(futuro.result())
+
+    for fallido in resumen["fallidos"]:
+        db.session.execute(
+            update(FragmentoTrabajo)
+            .where(FragmentoTrabajo.trabajo == clave, FragmentoTrabajo.desde == fallido["desde"])
+            .values(estado="fallido", error=fallido["error"][:500], terminado_en=datetime.datetime.now())
+        )
+    db.session.commit()
+
+    filas, segundos_fragmentos = db.session.execute(
+        select(func.coalesce(func.sum(FragmentoTrabajo.filas), 0), func.coalesce(func.sum(FragmentoTrabajo.segundos), 0))
+        .where(FragmentoTrabajo.trabajo == clave)
+    ).one()
+    if not resumen["fallidos"]:
+        resumen.update(definicion.terminar(contexto, filas))
+    resumen.update({
+        "estado": "fallido" if resumen["fallidos"] else "completado",
+        "filas": filas,
+        "segundos": time.perf_counter() - inicio,
+        "segundos_fragmentos": float(segundos_fragmentos),
+    })
+    return resumen
+
+
+def estado_trabajos() -> list:
+    """
+    Resumen de los puntos de control guardados: por cada ejecucion, fragmentos hechos, pendientes
+    y fallidos, filas, segundos de los fragmentos y ultimo fragmento terminado
+    """
+    return db.session.execute(
+        select(FragmentoTrabajo.trabajo,
+               func.count().filter(FragmentoTrabajo.estado == "hecho"),
+               func.count().filter(FragmentoTrabajo.estado == "pendiente"),
+               func.count().filter(FragmentoTrabajo.estado == "fallido"),
+               func.coalesce(func.sum(FragmentoTrabajo.filas), 0),
+               func.coalesce(func.sum(FragmentoTrabajo.segundos), 0),
+               func.max(FragmentoTrabajo.terminado_en))
+        .group_by(FragmentoTrabajo.trabajo)
+        .order_by(func.max(FragmentoTrabajo.terminado_en).desc())
+    ).all()
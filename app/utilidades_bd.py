@@ -0,0 +1,15 @@
+"""
+Utilidades comunes para construir consultas que dependen del motor de base de datos
+"""
+from sqlalchemy.dialects import postgresql, sqlite
+from . import db
+
+
+def insert_con_conflicto(modelo):
+    """
+    Devuelve un INSERT del dialecto en uso que admite ON CONFLICT (upsert).
+    En produccion usamos PostgreSQL, pero SQLite tiene la misma sintaxis y nos sirve en local.
+    """
+    if db.engine.dialect.name == "sqlite":
+        return sqlite.insert(modelo)
+    return postgresql.insert(modelo)
@@ -0,0 +1,47 @@
+"""
+Versionado de los datos de catalogo (cartas, jugadores, historicos...).
+
+Las caches que viven en memoria de cada proceso (pool de cartas, catalogo, fragmentos...)
+guardan la version con la que se construyeron, y se recargan cuando la version de la
+base de datos cambia. Quien modifica esos datos (admin_script) es el encargado de
+incrementar la version dentro de su misma transaccion.
+"""
+import datetime
+from sqlalchemy import select
+from . import db
+from .modelos import VersionDatos
+from .utilidades_bd import insert_con_conflicto
+
+
+def version_actual(clave: str) -> int:
+    """
+    Version actual de los datos asociados a "clave" (0 si nunca se han modificado)
+    """
+    version = db.session.scalar(select(VersionDatos.version).where(VersionDatos.clave == clave))
+    return version or 0
+
+
+def versiones_actuales(*claves: str) -> dict:
+    """
+    Version y fecha de modificacion de cada clave, en una sola consulta (las claves que nunca
+    se han modificado no aparecen)
+    """
+    filas = db.session.execute(
+        select(VersionDatos.clave, VersionDatos.version, VersionDatos.actualizada_en)
+        .where(VersionDatos.clave.in_(claves))
+    )
+    return {clave: (version, actualizada_en) for clave, version, actualizada_en in filas}
+
+
+def incrementar_version(*claves: str) -> None:
+    """
+    Incrementa la version de cada clave. No hace commit: se confirma junto con
+    la transaccion que ha modificado los datos.
+    """
+    ahora = datetime.datetime.now()
+    for clave in claves:
+        stmt = insert_con_conflicto(VersionDatos).values(clave=clave, version=1, actualizada_en=ahora)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[VersionDatos.clave],
+            set_={"version": VersionDatos.version + 1, "actualizada_en": ahora}
+        ))
@@ -0,0 +1,140 @@
+"""
+Prueba de carga de los logins (hash de contraseñas, ver app/contrasenas.py).
+
+Con varios niveles de concurrencia de logins, lanza durante unos segundos logins sin parar y, a la
+vez, unos hilos de lectura que piden la lista de jugadores. Por cada nivel mide:
+    * Logins por segundo y logins rechazados porque el pool de hashes estaba saturado.
+    * Latencia p50/p95 de los logins y de las lecturas (para ver cuanto les afecta la avalancha).
+
+Uso (desde la raiz del proyecto):
+    python -m benchmarks.carga_login --procesos 4 --niveles 1 2 4 8 16
+    python -m benchmarks.carga_login --procesos 0      (hashes en el hilo de la peticion, para comparar)
+    python -m benchmarks.carga_login --metodo pbkdf2:sha256:600000 --uri postgresql+psycopg2://...
+
+¡Ojo! Salvo con --sin-sembrar, se borran y se vuelven a crear todas las tablas de la base de datos.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from sqlalchemy import update
+from app import create_app, db
+from app.contrasenas import generar_hash, pool_hash
+from app.migraciones import migrar
+from app.modelos import Usuario
+from .carga import configuracion_benchmark, percentil, commit_actual
+from .sembrar import sembrar, PASSWORD
+
+TAMAÑOS = {"jugadores": 500, "partidos": 20, "usuarios": 300, "ligas": 20}
+
+
+def medir_nivel(app, concurrencia: int, hilos_lectura: int, segundos: float, num_usuarios: int) -> dict:
+    fin = time.perf_counter() + segundos
+    logins, lecturas = [], []
+    rechazados = [0]
+    candado = threading.Lock()
+
+    def iniciar_sesiones():
+        rnd = random.Random()
+        while time.perf_counter() < fin:
+            cliente = app.test_client()
+            inicio = time.perf_counter()
+            respuesta = cliente.post("/acceder", data={"email": f"usuario{rnd.randint(1, num_usuarios)}@bench.es",
+                                                       "password": PASSWORD})
+            duracion = time.perf_counter() - inicio
+            with candado:
+                # Un login correcto redirige; si el pool esta saturado se vuelve a mostrar el formulario
+                if respuesta.status_code == 302:
+                    logins.append(duracion)
+                else:
+                    rechazados[0] += 1
+
+    def leer():
+        cliente = app.test_client()
+        while time.perf_counter() < fin:
+            inicio = time.perf_counter()
+            cliente.get("/jugadores")
+            with candado:
+                lecturas.append(time.perf_counter() - inicio)
+
+    hilos = [threading.Thread(target=iniciar_sesiones) for _ in range(concurrencia)]
+    hilos += [threading.Thread(target=leer) for _ in range(hilos_lectura)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    logins.sort()
+    lecturas.sort()
+    return {
+        "concurrencia_logins": concurrencia,
+        "logins_por_segundo": round(len(logins) / segundos, 1),
+        "logins_rechazados": rechazados[0],
+        "login_p50_ms": round(percentil(logins, 50) * 1000, 1),
+        "login_p95_ms": round(percentil(logins, 95) * 1000, 1),
+        "lectura_p50_ms": round(percentil(lecturas, 50) * 1000, 1),
+        "lectura_p95_ms": round(percentil(lecturas, 95) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", help="Base de datos (por defecto, un SQLite temporal)")
+    parser.add_argument("--sin-sembrar", action="store_true", help="No crear ni sembrar la base de datos")
+    parser.add_argument("--perfil", default="prod", help="Perfil de configuracion base")
+    parser.add_argument("--metodo", help="HASH_METODO (por defecto, el del perfil)")
+    parser.add_argument("--procesos", type=int, help="HASH_PROCESOS (por defecto, el del perfil)")
+    parser.add_argument("--niveles", type=int, nargs="+", default=[0, 1, 2, 4, 8, 16],
+                        help="Hilos haciendo login a la vez en cada medida (0: solo lecturas)")
+    parser.add_argument("--hilos-lectura", type=int, default=2)
+    parser.add_argument("--segundos", type=float, default=5)
+    parser.add_argument("--salida", default="resultados_login.json")
+    args = parser.parse_args()
+
+    configuracion = configuracion_benchmark(args.uri or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "login.db"),
+                                            args.perfil)
+    if args.metodo:
+        configuracion.HASH_METODO = args.metodo
+    if args.procesos is not None:
+        configuracion.HASH_PROCESOS = args.procesos
+        configuracion.HASH_MAXIMO_PENDIENTES = max(1, 4 * args.procesos)
+    app = create_app(configuracion)
+
+    with app.app_context():
+        if not args.sin_sembrar:
+            db.drop_all()
+            migrar()
+            sembrar(42, **TAMAÑOS)
+        # Todos los usuarios con un hash del metodo configurado, para no medir los rehash del primer login
+        db.session.execute(update(Usuario).values(password_hash=generar_hash(PASSWORD)))
+        db.session.commit()
+        num_usuarios = db.session.query(Usuario).count()
+
+    print(f"Metodo {app.config['HASH_METODO']}, {app.config['HASH_PROCESOS']} procesos de hash, "
+          f"{args.hilos_lectura} hilos de lectura")
+    resultados = []
+    for concurrencia in args.niveles:
+        r = medir_nivel(app, concurrencia, args.hilos_lectura, args.segundos, num_usuarios)
+        resultados.append(r)
+        print(f"{concurrencia:3} logins a la vez: {r['logins_por_segundo']:7.1f} logins/s "
+              f"({r['logins_rechazados']} rechazados), login p95 {r['login_p95_ms']:8.1f} ms, "
+              f"lectura p50 {r['lectura_p50_ms']:7.1f} ms p95 {r['lectura_p95_ms']:7.1f} ms")
+    pool_hash.cerrar()
+
+    with open(args.salida, "w", encoding="utf-8") as fichero:
+        json.dump({
+            "commit": commit_actual(),
+            "metodo": app.config["HASH_METODO"],
+            "procesos": app.config["HASH_PROCESOS"],
+            "hilos_lectura": args.hilos_lectura,
+            "segundos": args.segundos,
+            "niveles": resultados,
+        }, fichero, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
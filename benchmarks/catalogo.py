@@ -0,0 +1,139 @@
+"""
+Comparacion del catalogo de jugadores en memoria (app/catalogo.py) con el ORM.
+
+Siembra una base de datos con muchos jugadores y mide:
+    * Memoria: lo que dice el propio catalogo y lo que mide tracemalloc al cargarlo, frente a lo
+      que ocupan los mismos jugadores y cartas cargados como objetos del ORM.
+    * Tiempo de carga del catalogo entero.
+    * Tiempo de resolver los diccionarios id2carta / id2jugador de una pagina de cartas (por
+      defecto 8 ids al azar) con el ORM (la consulta que hacian las vistas) y con el catalogo.
+
+Uso (desde la raiz del proyecto):
+    python -m benchmarks.catalogo --jugadores 10000 --busquedas 2000
+    python -m benchmarks.catalogo --uri postgresql+psycopg2://... --jugadores 50000
+
+¡Ojo! Salvo con --sin-sembrar, se borran y se vuelven a crear todas las tablas de la base de datos.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from app import create_app, db
+from app.catalogo import catalogo
+from app.migraciones import migrar
+from app.modelos import Carta, Jugador
+from .carga import configuracion_benchmark, percentil, commit_actual
+from .sembrar import sembrar
+
+
+def medir_memoria(funcion) -> tuple:
+    """
+    Devuelve el resultado de "funcion" y los bytes que siguen reservados despues de llamarla
+    """
+    gc.collect()
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    resultado = funcion()
+    gc.collect()
+    despues = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return resultado, despues - antes
+
+
+def por_orm(ids: list) -> tuple:
+    cartas = db.session.scalars(
+        select(Carta).where(Carta.id_jugador.in_(ids)).options(selectinload(Carta.jugador))
+    ).all()
+    id2carta = {carta.id_jugador: carta for carta in cartas}
+    return id2carta, {id_jugador: carta.jugador for id_jugador, carta in id2carta.items()}
+
+
+def por_catalogo(ids: list) -> tuple:
+    id2carta = catalogo.cartas(ids)
+    return id2carta, {id_jugador: carta.jugador for id_jugador, carta in id2carta.items()}
+
+
+def medir(funcion, lotes: list) -> dict:
+    duraciones = []
+    for ids in lotes:
+        inicio = time.perf_counter()
+        funcion(ids)
+        duraciones.append((time.perf_counter() - inicio) * 1e6)
+        # Como en una peticion: cada una empieza con la sesion vacia
+        db.session.remove()
+    duraciones.sort()
+    return {
+        "p50_us": round(percentil(duraciones, 50), 1),
+        "p95_us": round(percentil(duraciones, 95), 1),
+        "busquedas_por_segundo": round(len(lotes) / (sum(duraciones) / 1e6), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", help="Base de datos (por defecto, un SQLite temporal)")
+    parser.add_argument("--sin-sembrar", action="store_true", help="No crear ni sembrar la base de datos")
+    parser.add_argument("--jugadores", type=int, default=10000)
+    parser.add_argument("--busquedas", type=int, default=2000, help="Paginas de cartas que se resuelven")
+    parser.add_argument("--por-pagina", type=int, default=8, help="Cartas por pagina")
+    parser.add_argument("--salida", default="resultados_catalogo.json")
+    args = parser.parse_args()
+
+    uri = args.uri or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "catalogo.db")
+    app = create_app(configuracion_benchmark(uri))
+    with app.app_context():
+        if not args.sin_sembrar:
+            db.drop_all()
+            migrar()
+            sembrar(42, jugadores=args.jugadores, partidos=20, usuarios=10, ligas=5)
+
+        _, bytes_orm = medir_memoria(lambda: db.session.scalars(
+            select(Carta).options(selectinload(Carta.jugador))
+        ).all())
+        db.session.remove()
+
+        catalogo.invalidar()
+        _, bytes_tracemalloc = medir_memoria(lambda: catalogo.jugador(0))
+        estadisticas = catalogo.estadisticas()
+
+        ids = list(db.session.scalars(select(Carta.id_jugador)))
+        rnd = random.Random(42)
+        lotes = [rnd.sample(ids, min(args.por_pagina, len(ids))) for _ in range(args.busquedas)]
+        resultados = {
+            "jugadores": db.session.query(Jugador).count(),
+            "cartas": len(ids),
+            "memoria": {
+                "catalogo_bytes": estadisticas["bytes"],
+                "catalogo_tracemalloc_bytes": bytes_tracemalloc,
+                "orm_tracemalloc_bytes": bytes_orm,
+            },
+            "carga_catalogo_s": estadisticas["segundos_recarga"],
+            "orm": medir(por_orm, lotes),
+            "catalogo": medir(por_catalogo, lotes),
+        }
+
+    memoria = resultados["memoria"]
+    print(f"{resultados['jugadores']} jugadores, {resultados['cartas']} cartas")
+    print(f"Memoria: catalogo {memoria['catalogo_bytes'] / 2**20:.1f} MiB "
+          f"(tracemalloc {memoria['catalogo_tracemalloc_bytes'] / 2**20:.1f} MiB), "
+          f"ORM {memoria['orm_tracemalloc_bytes'] / 2**20:.1f} MiB")
+    print(f"Carga del catalogo: {resultados['carga_catalogo_s']:.3f} s")
+    for camino in ("orm", "catalogo"):
+        r = resultados[camino]
+        print(f"{camino:9} p50 {r['p50_us']:9.1f} us  p95 {r['p95_us']:9.1f} us  "
+              f"{r['busquedas_por_segundo']:10.1f} paginas/s")
+
+    with open(args.salida, "w", encoding="utf-8") as fichero:
+        json.dump({"commit": commit_actual(), "por_pagina": args.por_pagina, **resultados},
+                  fichero, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
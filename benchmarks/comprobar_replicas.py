@@ -0,0 +1,89 @@
+"""
+Comprobacion del enrutado de lecturas a replicas (app/replicas.py).
+
+Crea dos bases de datos con los mismos datos (la siembra es determinista), una como primaria y
+otra como replica, y comprueba contando las consultas de cada motor que:
+    * Las vistas @solo_lectura leen de la replica.
+    * Las vistas que escriben (tirada_diaria) van a la primaria.
+    * Justo despues de escribir, el mismo usuario lee de la primaria (lectura despues de escritura),
+      mientras que otro usuario sigue leyendo de la replica.
+
+Uso (desde la raiz del proyecto):
+    python -m benchmarks.comprobar_replicas                      (dos ficheros SQLite temporales)
+    python -m benchmarks.comprobar_replicas --primaria postgresql+psycopg2://... --replica postgresql+psycopg2://...
+
+¡Ojo! Se borran y se vuelven a crear todas las tablas de las dos bases de datos.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from collections import Counter
+from sqlalchemy import event
+from app import create_app, db
+from app.migraciones import migrar
+from .carga import configuracion_benchmark
+from .sembrar import sembrar, PASSWORD
+
+TAMAÑOS = {"jugadores": 200, "partidos": 20, "usuarios": 20, "ligas": 10}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--primaria", help="Base de datos primaria (por defecto, un SQLite temporal)")
+    parser.add_argument("--replica", help="Base de datos replica (por defecto, otro SQLite temporal)")
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp()
+    uri_primaria = args.primaria or "sqlite:///" + os.path.join(directorio, "primaria.db")
+    uri_replica = args.replica or "sqlite:///" + os.path.join(directorio, "replica.db")
+
+    configuracion = configuracion_benchmark(uri_primaria)
+    configuracion.SQLALCHEMY_REPLICAS = [uri_replica]
+    configuracion.REPLICA_LECTURA_PRIMARIA_SEGUNDOS = 60
+    # Las rutas se registran en la primera app que se crea, asi que esta tiene que ir antes
+    app = create_app(configuracion)
+
+    # La replica se siembra por separado con la misma semilla: mismos datos que la primaria
+    for app_siembra in (app, create_app(configuracion_benchmark(uri_replica))):
+        with app_siembra.app_context():
+            db.drop_all(bind_key=None)
+            migrar()
+            sembrar(42, **TAMAÑOS)
+
+    consultas = Counter()
+    with app.app_context():
+        for clave, motor in db.engines.items():
+            nombre = "replica" if clave else "primaria"
+            event.listen(motor, "before_cursor_execute",
+                         lambda *a, nombre=nombre: consultas.update([nombre]))
+
+    def peticion(cliente, url):
+        consultas.clear()
+        respuesta = cliente.get(url)
+        return respuesta.status_code, consultas["primaria"], consultas["replica"]
+
+    usuario_1 = app.test_client()
+    usuario_1.post("/acceder", data={"email": "usuario1@bench.es", "password": PASSWORD})
+    usuario_2 = app.test_client()
+    usuario_2.post("/acceder", data={"email": "usuario2@bench.es", "password": PASSWORD})
+
+    comprobaciones = [
+        ("lista de jugadores desde la replica", peticion(usuario_1, "/jugadores"), lambda p, r: p == 0 and r > 0),
+        ("perfil de jugador desde la replica", peticion(usuario_1, "/perfil_jugador/1"), lambda p, r: p == 0 and r > 0),
+        ("tirada diaria en la primaria", peticion(usuario_1, "/tirada_diaria"), lambda p, r: p > 0 and r == 0),
+        ("lectura despues de escritura en la primaria", peticion(usuario_1, "/ligas"), lambda p, r: p > 0 and r == 0),
+        ("otro usuario sigue en la replica", peticion(usuario_2, "/ligas"), lambda p, r: p == 0 and r > 0),
+    ]
+
+    fallos = 0
+    for descripcion, (estado, primaria, replica), correcta in comprobaciones:
+        ok = estado < 500 and correcta(primaria, replica)
+        fallos += not ok
+        print(f"{'OK   ' if ok else 'FALLO'} {descripcion}: estado {estado}, "
+              f"{primaria} consultas en la primaria, {replica} en la replica")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Historial de puntuaciones (app/historial_puntuaciones.py): espacio y latencia de las consultas.
+
+Siembra una base de datos y aplica varias jornadas seguidas, cambiando la puntuacion de parte de
+las cartas entre una y otra. Despues mide:
+    * El tiempo de aplicar cada jornada (incluye el libro de movimientos y las fotos).
+    * Las filas del libro de movimientos y los bytes de las fotos de la clasificacion, frente a lo
+      que ocuparian las mismas clasificaciones en filas (id_liga, jornada, id_usuario, posicion,
+      puntuacion).
+    * La latencia p50/p95/p99 de la clasificacion de una liga en una jornada al azar y de la
+      evolucion de un usuario en una liga.
+
+Uso (desde la raiz del proyecto):
+    python -m benchmarks.historial_puntuaciones --jornadas 30
+    python -m benchmarks.historial_puntuaciones --uri postgresql+psycopg2://... --usuarios 20000
+
+¡Ojo! Salvo con --sin-sembrar, se borran y se vuelven a crear todas las tablas de la base de datos.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+from sqlalchemy import select, update, func
+from app import create_app, db
+from app.migraciones import migrar
+from app.modelos import Carta, ParticipaLiga, MovimientoPuntuacion, ClasificacionHistorica
+from app.puntuaciones import recomputar_jornada
+from app.historial_puntuaciones import clasificacion_en, evolucion_puntuacion
+from .carga import configuracion_benchmark, percentil, commit_actual
+from .sembrar import sembrar
+
+# Bytes aproximados de una fila (id_liga, jornada, id_usuario, posicion, puntuacion) de una tabla
+# de clasificaciones con una fila por participante, sin contar cabeceras ni indices
+BYTES_FILA_CLASIFICACION = 4 + 11 + 4 + 4 + 8
+
+
+def latencias(funcion, argumentos: list) -> dict:
+    duraciones = []
+    for args in argumentos:
+        inicio = time.perf_counter()
+        funcion(*args)
+        duraciones.append(time.perf_counter() - inicio)
+    duraciones.sort()
+    return {f"p{p}_ms": round(percentil(duraciones, p) * 1000, 3) for p in (50, 95, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", help="Base de datos (por defecto, un SQLite temporal)")
+    parser.add_argument("--sin-sembrar", action="store_true", help="No crear ni sembrar la base de datos")
+    parser.add_argument("--jornadas", type=int, default=20, help="Jornadas que se aplican")
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--ligas", type=int, default=200)
+    parser.add_argument("--tam-bloque", type=int, default=100, help="Ligas por bloque del recomputo")
+    parser.add_argument("--consultas", type=int, default=500, help="Consultas de cada tipo que se miden")
+    parser.add_argument("--salida", default="resultados_historial_puntuaciones.json")
+    args = parser.parse_args()
+
+    uri = args.uri or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "historial.db")
+    app = create_app(configuracion_benchmark(uri))
+    rnd = random.Random(42)
+    with app.app_context():
+        if not args.sin_sembrar:
+            db.drop_all()
+            migrar()
+            sembrar(42, jugadores=2000, partidos=60, usuarios=args.usuarios, ligas=args.ligas)
+
+        primera = datetime.date.today() + datetime.timedelta(days=1)
+        jornadas = [(primera + datetime.timedelta(days=i)).isoformat() for i in range(args.jornadas)]
+        segundos_jornadas = []
+        for jornada in jornadas:
+            # Entre jornada y jornada cambia la puntuacion de una de cada diez cartas
+            db.session.execute(
+                update(Carta)
+                .where(Carta.id_jugador % 10 == rnd.randrange(10))
+                .values(puntuacion=Carta.puntuacion + rnd.uniform(-2, 2),
+                        actualizada_en=datetime.datetime.now())
+            )
+            db.session.commit()
+            inicio = time.perf_counter()
+            recomputar_jornada(jornada, tam_bloque=args.tam_bloque, forzar=True)
+            segundos_jornadas.append(time.perf_counter() - inicio)
+
+        movimientos = db.session.scalar(select(func.count()).select_from(MovimientoPuntuacion))
+        fotos, participantes, bytes_fotos = db.session.execute(
+            select(func.count(), func.sum(ClasificacionHistorica.participantes),
+                   func.sum(func.length(ClasificacionHistorica.datos)))
+        ).one()
+
+        ids_liga = list(db.session.scalars(select(ClasificacionHistorica.id_liga).distinct()))
+        participaciones = db.session.execute(select(ParticipaLiga.id_usuario, ParticipaLiga.id_liga)).all()
+        clasificaciones = latencias(
+            clasificacion_en,
+            [(rnd.choice(ids_liga), rnd.choice(jornadas)) for _ in range(args.consultas)]
+        )
+        evoluciones = latencias(
+            evolucion_puntuacion,
+            [tuple(rnd.choice(participaciones)) for _ in range(args.consultas)]
+        )
+
+    segundos_jornadas.sort()
+    resultados = {
+        "jornadas": args.jornadas,
+        "segundos_por_jornada_p50": round(percentil(segundos_jornadas, 50), 3),
+        "movimientos": movimientos,
+        "fotos": fotos,
+        "participantes_en_fotos": participantes,
+        "bytes_fotos": bytes_fotos,
+        "bytes_en_filas": participantes * BYTES_FILA_CLASIFICACION,
+        "clasificacion_en": clasificaciones,
+        "evolucion_puntuacion": evoluciones,
+    }
+    print(f"{args.jornadas} jornadas, {resultados['segundos_por_jornada_p50']:.3f} s por jornada (p50)")
+    print(f"Libro: {movimientos} movimientos. Fotos: {fotos} con {participantes} participantes en "
+          f"{bytes_fotos / 1024:.1f} KiB (en filas serian unos {resultados['bytes_en_filas'] / 1024:.1f} KiB)")
+    for nombre in ("clasificacion_en", "evolucion_puntuacion"):
+        r = resultados[nombre]
+        print(f"{nombre:21} p50 {r['p50_ms']:7.3f} ms  p95 {r['p95_ms']:7.3f} ms  p99 {r['p99_ms']:7.3f} ms")
+
+    with open(args.salida, "w", encoding="utf-8") as fichero:
+        json.dump({"commit": commit_actual(), **resultados}, fichero, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
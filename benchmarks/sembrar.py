@@ -0,0 +1,172 @@
+"""
+Generador determinista de datos para los benchmarks.
+
+Con la misma semilla y los mismos tamaños se generan siempre los mismos jugadores, partidos,
+historicos, cartas, usuarios, ligas, participaciones y cartas de liga, para que los resultados
+de dos commits se puedan comparar. Todas las inserciones se hacen en bloque.
+
+Todos los usuarios se llaman usuario<N>@bench.es y tienen la contraseña PASSWORD.
+"""
+import datetime
+import random
+from sqlalchemy import insert, text
+from app import db
+from app.modelos import (Jugador, Partido, Historico, Carta, Usuario, Liga, ParticipaLiga, CartaLiga,
+                         MovimientoPuntuacion)
+from app.clasificacion import actualizar_clasificacion
+from app.historial_puntuaciones import guardar_clasificaciones
+from app.estadisticas_jugador import actualizar_estadisticas
+from app.contrasenas import generar_hash
+from app.versiones import incrementar_version
+from app.cache_fragmentos import cache_fragmentos
+from app.catalogo import catalogo
+
+PASSWORD = "password1"
+EQUIPOS = ["Lakers", "Celtics", "Bulls", "Warriors", "Heat", "Spurs", "Knicks", "Nets", "Suns", "Bucks"]
+POSICIONES = ["Base", "Escolta", "Alero", "Ala-Pivot", "Pivot"]
+PAISES = ["USA", "España", "Francia", "Serbia", "Grecia", "Canada", "Eslovenia"]
+# Mismas probabilidades que las tiradas: la mitad de las cartas son comunes
+RAREZAS = ["comun"] * 10 + ["infrecuente"] * 6 + ["rara"] * 3 + ["mitica"]
+
+TAMAÑOS_POR_DEFECTO = {
+    "jugadores": 500,
+    "partidos": 200,
+    "jugadores_por_partido": 20,
+    "usuarios": 300,
+    "ligas": 60,
+    "ligas_por_usuario": 3,
+    "cartas_por_participacion": 10,
+}
+
+
+def _en_bloques(filas, tam=5000):
+    for i in range(0, len(filas), tam):
+        yield filas[i:i + tam]
+
+
+def _insertar(modelo, filas) -> None:
+    for bloque in _en_bloques(filas):
+        db.session.execute(insert(modelo), bloque)
+
+
+def sembrar(semilla: int = 42, **tamaños) -> dict:
+    """
+    Llena la base de datos (que debe estar vacia) y devuelve los tamaños usados
+    """
+    tamaños = {**TAMAÑOS_POR_DEFECTO, **tamaños}
+    rnd = random.Random(semilla)
+    hoy = datetime.date.today()
+
+    _insertar(Jugador, [
+        {
+            "id_jugador": i,
+            "nombre": f"Jugador {i}",
+            "nombre_equipo": rnd.choice(EQUIPOS),
+            "posicion": rnd.choice(POSICIONES),
+            "altura": round(rnd.uniform(180, 225), 1),
+            "peso": round(rnd.uniform(75, 130), 1),
+            "fecha_nacimiento": datetime.date(1985, 1, 1) + datetime.timedelta(days=rnd.randrange(6000)),
+            "pais": rnd.choice(PAISES),
+            "url_imagen": f"https://example.com/jugadores/{i}.png",
+        }
+        for i in range(1, tamaños["jugadores"] + 1)
+    ])
+    _insertar(Carta, [
+        {"id_jugador": i, "puntuacion": round(rnd.uniform(0, 60), 1), "rareza": rnd.choice(RAREZAS)}
+        for i in range(1, tamaños["jugadores"] + 1)
+    ])
+
+    partidos = []
+    historicos = []
+    ids_jugador = list(range(1, tamaños["jugadores"] + 1))
+    for i in range(1, tamaños["partidos"] + 1):
+        local, visitante = rnd.sample(EQUIPOS, 2)
+        partidos.append({
+            "id_partido": i,
+            "fecha": hoy - datetime.timedelta(days=tamaños["partidos"] - i),
+            "equipo_local": local,
+            "equipo_visitante": visitante,
+            "gana_local": rnd.random() < 0.5,
+            "url": f"https://example.com/partidos/{i}",
+        })
+        for id_jugador in rnd.sample(ids_jugador, min(tamaños["jugadores_por_partido"], len(ids_jugador))):
+            historicos.append({
+                "id_jugador": id_jugador,
+                "id_partido": i,
+                "tiempo_jugador": rnd.randint(5, 48),
+                "puntos_marcados": rnd.randint(0, 40),
+                "puntuacion": round(rnd.uniform(0, 60), 2),
+            })
+    _insertar(Partido, partidos)
+    _insertar(Historico, historicos)
+
+    # Todos comparten el mismo hash: generarlo es deliberadamente lento. Se hace con el HASH_METODO
+    # configurado, para que el primer login no tenga que rehacerlo
+    password_hash = generar_hash(PASSWORD)
+    _insertar(Usuario, [
+        {
+            "id": i,
+            "email": f"usuario{i}@bench.es",
+            # Nadie cumple años hoy, para que las tiradas sean comparables entre ejecuciones
+            "cumple": datetime.date(2000, 1, 1) if (hoy.month, hoy.day) != (1, 1) else datetime.date(2000, 6, 1),
+            "password_hash": password_hash,
+            "ultima_tirada": None,
+        }
+        for i in range(1, tamaños["usuarios"] + 1)
+    ])
+
+    ids_liga = list(range(1, tamaños["ligas"] + 1))
+    participaciones = {}
+    for id_usuario in range(1, tamaños["usuarios"] + 1):
+        for id_liga in rnd.sample(ids_liga, min(tamaños["ligas_por_usuario"], len(ids_liga))):
+            participaciones[(id_usuario, id_liga)] = round(rnd.uniform(0, 1000), 1)
+
+    num_participantes = {id_liga: 0 for id_liga in ids_liga}
+    for _, id_liga in participaciones:
+        num_participantes[id_liga] += 1
+    _insertar(Liga, [
+        {
+            "id": id_liga,
+            "nombre": f"Liga {id_liga}",
+            # Algunas ligas se quedan llenas, otras con hueco
+            "numero_participantes_maximo": num_participantes[id_liga] + rnd.choice([0, 5, 50]),
+            "password_hash": None,
+            "num_participantes": num_participantes[id_liga],
+        }
+        for id_liga in ids_liga
+    ])
+    _insertar(ParticipaLiga, [
+        {"id_usuario": id_usuario, "id_liga": id_liga, "puntuacion_acumulada": puntuacion}
+        for (id_usuario, id_liga), puntuacion in participaciones.items()
+    ])
+    _insertar(CartaLiga, [
+        {"id_liga": id_liga, "id_usuario": id_usuario, "id_jugador": id_jugador,
+         "numero_copias": rnd.randint(1, 3)}
+        for (id_usuario, id_liga) in participaciones
+        for id_jugador in rnd.sample(ids_jugador, min(tamaños["cartas_por_participacion"], len(ids_jugador)))
+    ])
+
+    # Las puntuaciones sembradas son las de la jornada de ayer, con su movimiento y su foto de la clasificacion
+    ayer = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    ahora = datetime.datetime.now()
+    _insertar(MovimientoPuntuacion, [
+        {"id_usuario": id_usuario, "id_liga": id_liga, "jornada": ayer, "diferencia": puntuacion,
+         "puntuacion": puntuacion, "registrado_en": ahora}
+        for (id_usuario, id_liga), puntuacion in participaciones.items() if puntuacion
+    ])
+
+    actualizar_clasificacion()
+    guardar_clasificaciones(ayer)
+    actualizar_estadisticas()
+    if db.engine.dialect.name == "postgresql":
+        # Hemos insertado los ids a mano: avanzamos las secuencias para que los siguientes INSERT no choquen
+        for tabla, columna in [("jugador", "id_jugador"), ("usuario", "id"), ("liga", "id")]:
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{tabla}', '{columna}'), (SELECT MAX({columna}) FROM {tabla}))"
+            ))
+    incrementar_version("cartas")
+    db.session.commit()
+    # Si se vuelve a sembrar en el mismo proceso, las versiones empiezan de nuevo desde 1
+    cache_fragmentos.limpiar()
+    catalogo.invalidar()
+    return tamaños
@@ -0,0 +1,122 @@
+"""
+Pico de tiradas diarias de medianoche, con y sin tiradas preparadas (app/tiradas_preparadas.py).
+
+Siembra una base de datos, inicia sesion con muchos usuarios y lanza todas sus tiradas diarias
+a la vez desde varios hilos, dos veces:
+    1. Sin tiradas preparadas: cada peticion elige sus cartas en el momento.
+    2. Despues de preparar las tiradas del dia (midiendo el proceso de preparacion): cada
+       peticion solo reclama las suyas.
+Por cada ronda mide las tiradas por segundo, la latencia p50/p95/p99 y las tiradas que no
+terminaron bien.
+
+Uso (desde la raiz del proyecto):
+    python -m benchmarks.tiradas_preparadas --usuarios 1000 --hilos 16
+    python -m benchmarks.tiradas_preparadas --uri postgresql+psycopg2://... --usuarios 5000
+
+¡Ojo! Salvo con --sin-sembrar, se borran y se vuelven a crear todas las tablas de la base de datos.
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, update, delete
+from app import create_app, db
+from app.migraciones import migrar
+from app.modelos import Usuario, ParticipaLiga, TiradaObtenida
+from app.sesion_usuario import usuarios_en_cache
+from app.tiradas_preparadas import preparar_tiradas
+from .carga import configuracion_benchmark, percentil, commit_actual
+from .sembrar import sembrar, PASSWORD
+
+
+def iniciar_sesiones(app, emails: list, hilos: int) -> list:
+    def iniciar(email):
+        cliente = app.test_client()
+        cliente.post("/acceder", data={"email": email, "password": PASSWORD})
+        return cliente
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        return list(ejecutor.map(iniciar, emails))
+
+
+def ronda(app, emails: list, hilos: int) -> dict:
+    """
+    Reinicia la tirada de hoy de todos los usuarios y lanza todas sus tiradas a la vez
+    """
+    with app.app_context():
+        db.session.execute(update(Usuario).values(ultima_tirada=None))
+        db.session.execute(delete(TiradaObtenida))
+        db.session.commit()
+    usuarios_en_cache.limpiar()
+    clientes = iniciar_sesiones(app, emails, hilos)
+
+    def tirar(cliente):
+        inicio = time.perf_counter()
+        respuesta = cliente.get("/tirada_diaria")
+        return time.perf_counter() - inicio, respuesta.status_code == 200
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        resultados = list(ejecutor.map(tirar, clientes))
+    segundos = time.perf_counter() - inicio
+
+    duraciones = sorted(duracion for duracion, _ in resultados)
+    return {
+        "tiradas_por_segundo": round(len(resultados) / segundos, 1),
+        "p50_ms": round(percentil(duraciones, 50) * 1000, 2),
+        "p95_ms": round(percentil(duraciones, 95) * 1000, 2),
+        "p99_ms": round(percentil(duraciones, 99) * 1000, 2),
+        "fallidas": sum(1 for _, bien in resultados if not bien),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", help="Base de datos (por defecto, un SQLite temporal)")
+    parser.add_argument("--sin-sembrar", action="store_true", help="No crear ni sembrar la base de datos")
+    parser.add_argument("--usuarios", type=int, default=1000)
+    parser.add_argument("--ligas", type=int, default=50)
+    parser.add_argument("--hilos", type=int, default=16, help="Peticiones a la vez")
+    parser.add_argument("--hilos-preparacion", type=int, help="TIRADAS_PREPARADAS_HILOS (por defecto, el del perfil)")
+    parser.add_argument("--salida", default="resultados_tiradas_preparadas.json")
+    args = parser.parse_args()
+
+    uri = args.uri or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "tiradas.db")
+    app = create_app(configuracion_benchmark(uri))
+    with app.app_context():
+        if not args.sin_sembrar:
+            db.drop_all()
+            migrar()
+            sembrar(42, jugadores=500, partidos=20, usuarios=args.usuarios, ligas=args.ligas)
+        emails = list(db.session.scalars(
+            select(Usuario.email).where(Usuario.id.in_(select(ParticipaLiga.id_usuario))).order_by(Usuario.id)
+        ))
+
+    print(f"{len(emails)} usuarios con ligas, {args.hilos} peticiones a la vez")
+    sin_preparar = ronda(app, emails, args.hilos)
+
+    with app.app_context():
+        db.session.execute(update(Usuario).values(ultima_tirada=None))
+        db.session.execute(delete(TiradaObtenida))
+        db.session.commit()
+        preparacion = preparar_tiradas(datetime.date.today(), hilos=args.hilos_preparacion)
+    preparadas = ronda(app, emails, args.hilos)
+
+    print(f"Preparacion: {preparacion['cartas']} cartas de {preparacion['usuarios']} usuarios en "
+          f"{preparacion['segundos']:.2f} s ({preparacion['usuarios_por_segundo']:.0f} usuarios/s)")
+    for nombre, r in (("sin preparar", sin_preparar), ("preparadas", preparadas)):
+        print(f"{nombre:13} {r['tiradas_por_segundo']:8.1f} tiradas/s  p50 {r['p50_ms']:7.2f} ms  "
+              f"p95 {r['p95_ms']:7.2f} ms  p99 {r['p99_ms']:7.2f} ms  ({r['fallidas']} fallidas)")
+
+    preparacion["fecha"] = preparacion["fecha"].isoformat()
+    with open(args.salida, "w", encoding="utf-8") as fichero:
+        json.dump({"commit": commit_actual(), "hilos": args.hilos, "preparacion": preparacion,
+                   "sin_preparar": sin_preparar, "preparadas": preparadas},
+                  fichero, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
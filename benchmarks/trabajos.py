@@ -0,0 +1,116 @@
+"""
+Escalado de los trabajos de admin_script con el numero de procesos (app/trabajos.py).
+
+Ejecuta un trabajo (por defecto, recomputar la jornada de hoy entera) con distintos numeros de
+procesos, volviendo a sembrar la base de datos antes de cada nivel para que todos hagan el mismo
+trabajo. Por cada nivel mide el tiempo real, la suma del tiempo de los fragmentos y la aceleracion
+respecto al primer nivel. El trabajo "ingestar" vuelve a ingestar los historicos sembrados, desde
+un fichero JSON lines.
+
+Con --sin-sembrar solo se borran los puntos de control entre nivel y nivel, asi que a partir del
+segundo los trabajos pueden encontrarse ya hecha parte del trabajo.
+
+Con SQLite las escrituras de los procesos se hacen de una en una, asi que para ver el escalado
+real hay que usar PostgreSQL:
+    python -m benchmarks.trabajos --uri postgresql+psycopg2://... --niveles 0 1 2 4 8
+    python -m benchmarks.trabajos --trabajo estadisticas-jugadores --jugadores 20000
+
+¡Ojo! Salvo con --sin-sembrar, se borran y se vuelven a crear todas las tablas de la base de datos.
+"""
+import argparse
+import json
+import os
+import tempfile
+from sqlalchemy import select, delete
+from app import create_app, db
+from app.migraciones import migrar
+from app.modelos import Historico, FragmentoTrabajo
+from app.trabajos import TRABAJOS, ejecutar_trabajo
+from .carga import configuracion_benchmark, commit_actual
+from .sembrar import sembrar
+
+# Parametros con los que cada trabajo hace todo el trabajo en cada medida
+PARAMETROS = {
+    "ingestar": {},
+    "recomputar-jornada": {"forzar": True},
+    "puntuar-cartas": {"completo": True},
+    "reconstruir-contadores": {},
+    "estadisticas-jugadores": {},
+}
+
+
+def reiniciar(args) -> None:
+    """
+    Deja la base de datos como estaba antes del primer nivel
+    """
+    if args.sin_sembrar:
+        db.session.execute(delete(FragmentoTrabajo))
+        db.session.commit()
+        return
+    db.drop_all()
+    migrar()
+    sembrar(42, jugadores=args.jugadores, partidos=60, usuarios=args.usuarios, ligas=args.ligas)
+
+
+def escribir_historicos(ruta: str) -> None:
+    """
+    Escribe los historicos de la base de datos en un fichero JSON lines para el trabajo "ingestar"
+    """
+    with open(ruta, "w", encoding="utf-8") as fichero:
+        for fila in db.session.execute(
+            select(Historico.id_partido, Historico.id_jugador, Historico.tiempo_jugador,
+                   Historico.puntos_marcados, Historico.puntuacion)
+        ):
+            fichero.write(json.dumps({**fila._asdict(), "puntuacion": float(fila.puntuacion)}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", help="Base de datos (por defecto, un SQLite temporal)")
+    parser.add_argument("--sin-sembrar", action="store_true", help="No crear ni sembrar la base de datos")
+    parser.add_argument("--trabajo", choices=sorted(TRABAJOS), default="recomputar-jornada")
+    parser.add_argument("--niveles", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="Numeros de procesos que se miden (0: en el propio proceso)")
+    parser.add_argument("--fragmentos", type=int, help="Fragmentos (por defecto, segun los procesos)")
+    parser.add_argument("--jugadores", type=int, default=5000)
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--ligas", type=int, default=1000)
+    parser.add_argument("--salida", default="resultados_trabajos.json")
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp()
+    uri = args.uri or "sqlite:///" + os.path.join(directorio, "trabajos.db")
+    app = create_app(configuracion_benchmark(uri))
+    parametros = dict(PARAMETROS[args.trabajo])
+    resultados = []
+    with app.app_context():
+        base = None
+        for nivel, procesos in enumerate(args.niveles):
+            reiniciar(args)
+            if args.trabajo == "ingestar" and nivel == 0:
+                parametros["ruta_historicos"] = os.path.join(directorio, "historicos.jsonl")
+                escribir_historicos(parametros["ruta_historicos"])
+            resumen = ejecutar_trabajo(args.trabajo, parametros, procesos, args.fragmentos)
+            base = base or resumen["segundos"]
+            r = {
+                "procesos": procesos,
+                "fragmentos": resumen["fragmentos"],
+                "filas": resumen["filas"],
+                "segundos": round(resumen["segundos"], 3),
+                "segundos_fragmentos": round(resumen["segundos_fragmentos"], 3),
+                "aceleracion": round(base / resumen["segundos"], 2),
+                "estado": resumen["estado"],
+            }
+            resultados.append(r)
+            print(f"{procesos:3} procesos, {r['fragmentos']:3} fragmentos: {r['segundos']:8.3f} s reales, "
+                  f"{r['segundos_fragmentos']:8.3f} s en fragmentos, aceleracion x{r['aceleracion']:.2f} "
+                  f"({r['filas']} filas, {r['estado']})")
+
+    with open(args.salida, "w", encoding="utf-8") as fichero:
+        json.dump({"commit": commit_actual(), "trabajo": args.trabajo, "niveles": resultados},
+                  fichero, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,53 @@
 import os
 from dotenv import load_dotenv
+from sqlalchemy.pool import NullPool
 
 load_dotenv(override=True)
 
 
+def _entero(variable: str, por_defecto: int) -> int:
+    return int(os.environ.get(variable, por_defecto))
+
+
+def _booleano(variable: str) -> bool:
+    return os.environ.get(variable, "").strip().lower() in ("1", "true", "si", "s")
+
+
+def opciones_motor(pool_size: int, max_overflow: int, pool_recycle: int, timeout_sentencia_ms: int) -> dict:
+    """
+    SQLALCHEMY_ENGINE_OPTIONS para PostgreSQL. Cada valor se puede cambiar con una variable de
+    entorno (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_TIMEOUT_SENTENCIA_MS).
+
+    Con DB_PGBOUNCER=1 las conexiones pasan por un pooler externo (PgBouncer en modo transaccion):
+    SQLAlchemy no guarda conexiones (NullPool, el pool es PgBouncer) y no manda el parametro de
+    arranque "options", que PgBouncer rechaza; el statement_timeout se configura entonces en el
+    rol o en la base de datos (ALTER ROLE ... SET statement_timeout = ...).
+    """
+    if _booleano("DB_PGBOUNCER"):
+        return {"poolclass": NullPool}
+    timeout_sentencia_ms = _entero("DB_TIMEOUT_SENTENCIA_MS", timeout_sentencia_ms)
+    return {
+        "pool_size": _entero("DB_POOL_SIZE", pool_size),
+        "max_overflow": _entero("DB_MAX_OVERFLOW", max_overflow),
+        # Segundos que se espera a una conexion libre antes de dar error
+        "pool_timeout": _entero("DB_POOL_TIMEOUT", 10),
+        # Descarta conexiones muertas (reinicio de la base de datos, cortes de red) antes de usarlas
+        "pool_pre_ping": True,
+        # Renueva las conexiones antes de que las corten los timeouts del servidor o del balanceador
+        "pool_recycle": _entero("DB_POOL_RECYCLE", pool_recycle),
+        "connect_args": {"options": f"-c statement_timeout={timeout_sentencia_ms}"},
+    }
+
+
 class ConfiguracionFlask:
     """
-    Clase con todas las variables de configuraciones de Flask
+    Clase con todas las variables de configuraciones de Flask. Es la base de los perfiles de
+    desarrollo, pruebas y produccion (al final del fichero), que se eligen con la variable de
+    entorno NBA_PERFIL.
     """
 
+    PERFIL = "base"
+
     # Secret key: string largo para configurar la proteccion
     # de ciertos componentes de la app
     SECRET_KEY = os.environ.get('SECRET_KEY')
@@ -17,12 +56,148 @@ class ConfiguracionFlask:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     # Hacemos que se muestren las consultas que se realizan
-    SQLALCHEMY_ECHO = True
+    SQLALCHEMY_ECHO = False
+
+    # Opciones del motor de SQLAlchemy (pool de conexiones...). Ver opciones_motor
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+
+    # Replicas de solo lectura a las que van las vistas marcadas con @solo_lectura (ver app/replicas.py),
+    # separadas por comas en DATABASE_URIS_REPLICAS. Despues de escribir, las peticiones del mismo
+    # usuario leen de la primaria durante REPLICA_LECTURA_PRIMARIA_SEGUNDOS
+    SQLALCHEMY_REPLICAS = [uri for uri in os.environ.get("DATABASE_URIS_REPLICAS", "").split(",") if uri]
+    REPLICA_LECTURA_PRIMARIA_SEGUNDOS = 5
+
+    # Nivel del log de la aplicacion
+    NIVEL_LOG = "INFO"
+
+    # Cada cuantos segundos se comprueba si las cartas han cambiado en la base de datos
+    # para reconstruir el pool de cartas de las tiradas (ver app/pool_cartas.py)
+    POOL_CARTAS_TTL = 30
+
+    # Cada cuantos segundos se comprueba si las cartas han cambiado para recargar el catalogo de
+    # jugadores y cartas en memoria (ver app/catalogo.py)
+    CATALOGO_TTL = 30
+
+    # Segundos que se reutiliza la foto cacheada de un usuario conectado y numero maximo de
+    # usuarios en la cache de cada proceso (ver app/sesion_usuario.py)
+    USUARIOS_CACHE_TTL = 60
+    USUARIOS_CACHE_MAXIMO = 10000
+
+    # Hash de las contraseñas (ver app/contrasenas.py): algoritmo y coste, procesos del pool
+    # (0 para calcularlos en el hilo de la peticion), hashes en cola como maximo y segundos de
+    # espera por un hueco en la cola antes de rendirse
+    HASH_METODO = "scrypt:32768:8:1"
+    HASH_PROCESOS = 0
+    HASH_MAXIMO_PENDIENTES = 8
+    HASH_ESPERA_MAXIMA = 5
+
+    # Trabajos en segundo plano de admin_script (ver app/trabajos.py): procesos entre los que se
+    # reparten los fragmentos (0 para ejecutarlos en el propio proceso) y fragmentos por proceso
+    TRABAJOS_PROCESOS = 0
+    TRABAJOS_FRAGMENTOS_POR_PROCESO = 4
+
+    # Preparacion de las tiradas del dia siguiente (ver app/tiradas_preparadas.py): hilos que
+    # preparan bloques de usuarios a la vez, usuarios por bloque, y dias sin tirar tras los que un
+    # usuario deja de considerarse activo (sus tiradas se hacen en el momento, como antes)
+    TIRADAS_PREPARADAS_HILOS = 4
+    TIRADAS_PREPARADAS_BLOQUE = 500
+    TIRADAS_PREPARADAS_DIAS_ACTIVO = 7
+
+    # Formula con la que se calcula la puntuacion de las cartas a partir del historico
+    # ("media", "mediana" o "suma") y numero de ultimos partidos que se tienen en cuenta
+    PUNTUACION_CARTAS_FORMULA = "media"
+    PUNTUACION_CARTAS_VENTANA = 10
+    # Segundos que la marca de agua de la puntuacion se queda por detras del reloj: el historico de
+    # una ingesta que tarde mas que esto en hacer commit podria quedarse sin puntuar
+    PUNTUACION_CARTAS_MARGEN = 900
+
+    # Numero maximo de consultas SQL por peticion. Si una vista lo supera se avisa en el log
+    # (ver app/instrumentacion.py). None para desactivarlo
+    PRESUPUESTO_CONSULTAS = 10
+
+    # Numero de ultimos partidos con los que se calcula la forma de un jugador, y partidos
+    # por pagina en el historico del perfil del jugador
+    ESTADISTICAS_PARTIDOS_FORMA = 5
+    HISTORICO_POR_PAGINA = 10
+
+    # Jugadores por pagina en la lista de jugadores
+    JUGADORES_POR_PAGINA = 20
+
+    # API JSON (ver app/api.py): ids como mucho en cada peticion de lotes (y cartas por pagina de
+    # una coleccion) y puestos como mucho de cada liga en las clasificaciones
+    API_MAXIMO_IDS = 100
+    API_MAXIMO_PUESTOS = 100
+
+    # Cache de fragmentos de las paginas publicas (ver app/cache_fragmentos.py): almacen ("lru" en
+    # la memoria de cada proceso, "redis" compartido en CACHE_REDIS_URL o "ninguna"), tamaño maximo
+    # de la LRU, segundos que dura un fragmento en Redis y cada cuantos segundos se comprueban las
+    # versiones de los datos. CACHE_SEMILLA entra en las claves y en las ETag: cambiala al desplegar
+    # templates nuevos (p. ej. con el commit) para no servir paginas de la version anterior
+    CACHE_FRAGMENTOS = os.environ.get("CACHE_FRAGMENTOS", "lru")
+    CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+    CACHE_FRAGMENTOS_MAXIMO_BYTES = 32 * 1024 * 1024
+    CACHE_FRAGMENTOS_CADUCIDAD = 3600
+    CACHE_VERSIONES_TTL = 5
+    CACHE_SEMILLA = os.environ.get("CACHE_SEMILLA", "")
 
     # Si ponemos el flag DEBUG a true, Flask se ejecutará en modo 'debug'.
     # En este modo, se muestra el log de los errores que se produzcan.
     # NO USAR EN PRODUCCION
-    DEBUG = True
+    DEBUG = False
 
     SQLALCHEMY_DATABASE_URI = f"postgresql+psycopg2://{os.environ.get('USER')}:{os.environ.get('PASSWORD')}" \
                               f"@{os.environ.get('HOST')}/{os.environ.get('DATABASE')}"
+
+
+
+class ConfiguracionDesarrollo(ConfiguracionFlask):
+    """
+    Desarrollo en local: modo debug y todas las consultas en el log
+    """
+    PERFIL = "dev"
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+    NIVEL_LOG = "DEBUG"
+    SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True}
+
+
+class ConfiguracionPruebas(ConfiguracionFlask):
+    """
+    Pruebas y benchmarks: sin debug ni echo, contra la base de datos de DATABASE_URI_PRUEBAS
+    """
+    PERFIL = "test"
+    TESTING = True
+    # Hashes baratos para que las pruebas no se pasen el tiempo calculandolos
+    HASH_METODO = "pbkdf2:sha256:1000"
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URI_PRUEBAS", ConfiguracionFlask.SQLALCHEMY_DATABASE_URI)
+
+
+class ConfiguracionProduccion(ConfiguracionFlask):
+    """
+    Produccion: pool de conexiones dimensionado para varios hilos por worker, pre-ping, reciclado
+    de conexiones y statement_timeout en el servidor
+    """
+    PERFIL = "prod"
+    NIVEL_LOG = "INFO"
+    HASH_PROCESOS = _entero("HASH_PROCESOS", max(1, (os.cpu_count() or 2) // 2))
+    HASH_MAXIMO_PENDIENTES = _entero("HASH_MAXIMO_PENDIENTES", 4 * HASH_PROCESOS)
+    TRABAJOS_PROCESOS = _entero("TRABAJOS_PROCESOS", os.cpu_count() or 1)
+    SQLALCHEMY_ENGINE_OPTIONS = opciones_motor(pool_size=10, max_overflow=20, pool_recycle=1800,
+                                               timeout_sentencia_ms=5000)
+
+
+PERFILES = {
+    "dev": ConfiguracionDesarrollo,
+    "test": ConfiguracionPruebas,
+    "prod": ConfiguracionProduccion,
+}
+
+
+def configuracion_activa():
+    """
+    Clase de configuracion del perfil indicado en NBA_PERFIL (por defecto, desarrollo)
+    """
+    perfil = os.environ.get("NBA_PERFIL", "dev")
+    if perfil not in PERFILES:
+        raise ValueError(f"Perfil de configuracion desconocido: {perfil} (validos: {', '.join(PERFILES)})")
+    return PERFILES[perfil]